@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures lock contention: a number of processes repeatedly acquire the same
+lock, hold it for a short time, and release it. Compares the previous
+implementation (sleeping random.random() seconds between attempts) with the
+current one using exponential backoff with and without inotify wakeups.
+Run it with --dir on a network file system to measure it there; inotify
+wakeups only work between processes on the same machine.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+from nidaba.lock import lock
+
+
+class legacy_lock(lock):
+    """
+    The lock implementation before bounded backoff was introduced.
+    """
+    def acquire(self, timeout=None):
+        while True:
+            try:
+                os.symlink(self._lock_file, self._locked_file)
+                break
+            except:
+                if os.path.islink(self._locked_file) and \
+                   os.readlink(self._locked_file) == self._lock_file:
+                    break
+            time.sleep(random.random() + 0.001)
+        return True
+
+
+def worker(args):
+    impl, path, iterations, hold, inotify = args
+    waits = []
+    for _ in xrange(iterations):
+        if impl == 'legacy':
+            l = legacy_lock(path)
+        else:
+            l = lock(path, inotify=inotify)
+        start = time.time()
+        l.acquire()
+        waits.append(time.time() - start)
+        time.sleep(hold)
+        l.release()
+    return waits
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lock contention '
+                                     'benchmark.')
+    parser.add_argument('--dir', default=None,
+                        help='Directory of the lock file (default: a '
+                        'temporary directory).')
+    parser.add_argument('--processes', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--hold', type=float, default=0.005,
+                        help='Seconds the lock is held.')
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp(dir=args.dir)
+    path = os.path.join(tempdir, 'file')
+    try:
+        for processes in args.processes:
+            for impl, inotify in (('legacy', False), ('backoff', False),
+                                  ('backoff', True)):
+                pool = multiprocessing.Pool(processes)
+                start = time.time()
+                waits = sum(pool.map(worker, [(impl, path, args.iterations,
+                                               args.hold, inotify)] *
+                                     processes), [])
+                elapsed = time.time() - start
+                pool.close()
+                pool.join()
+                name = impl + (' + inotify' if inotify else '')
+                print('{:2d} processes, {:17s}: {:7.3f}s total, {:7.4f}s '
+                      'mean wait, {:7.4f}s max wait'.format(
+                          processes, name, elapsed, sum(waits) / len(waits),
+                          max(waits)))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
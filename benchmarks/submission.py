@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures the throughput of batch submission, i.e. the number of documents
+per second Batch.run() publishes to the broker. By default an in-memory
+broker and result backend are used so only the cost of building and
+serializing the task messages is measured; point --broker and --backend to a
+real deployment to include network round trips.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import time
+import uuid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch submission '
+                                     'throughput benchmark.')
+    parser.add_argument('--docs', type=int, default=2000,
+                        help='Number of documents per batch.')
+    parser.add_argument('--broker', default='memory://')
+    parser.add_argument('--backend', default='cache+memory://')
+    parser.add_argument('--chunk-size', type=int, nargs='+',
+                        default=[1, 100, 500])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    from nidaba.celery import app
+    app.conf.BROKER_URL = args.broker
+    app.conf.CELERY_RESULT_BACKEND = args.backend
+
+    from nidaba import Batch
+
+    docs = [(u'bench', u'{:05d}.tif'.format(i)) for i in xrange(args.docs)]
+    for chunk_size in args.chunk_size:
+        for threads in args.threads:
+            batch = Batch(unicode(uuid.uuid4()))
+            batch.add_step()
+            batch.add_tick()
+            batch.add_task('img.rgb_to_gray')
+            batch.add_tick()
+            for whsize in (10, 20, 30, 40):
+                batch.add_task('binarize.sauvola', whsize=whsize)
+            batch.add_tick()
+            batch.add_task('ocr.tesseract', languages=[u'eng'])
+            # input documents don't have to exist for submission
+            batch.docs = docs
+            start = time.time()
+            batch.run(chunk_size=chunk_size, threads=threads)
+            elapsed = time.time() - start
+            print('chunk size {:4d}, {} thread(s): {:8.1f} documents/s'.format(
+                chunk_size, threads, len(docs) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
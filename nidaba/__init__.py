@@ -1 +1 @@
-from nidaba import Batch
+from nidaba import Batch, Pipeline
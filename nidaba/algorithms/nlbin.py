@@ -0,0 +1,137 @@
+"""
+nidaba.algorithms.nlbin
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Module implementing the non-linear binarization of ocropus/kraken split into
+its separate stages. The expensive background estimation only depends on the
+zoom, perc, and range parameters and can therefore be shared between all
+binarizations of an image differing only in the remaining parameters.
+
+"""
+
+import numpy as np
+
+from PIL import Image
+from scipy.ndimage import filters, interpolation, morphology
+
+from nidaba.nidabaexceptions import NidabaAlgorithmException
+
+
+def flatten(im, zoom=0.5, perc=80, range=20):
+    """
+    Normalizes an image and removes its background estimated with a
+    percentile filter on a zoomed version of the image.
+
+    Args:
+        im (PIL.Image): Input image
+        zoom (float): Zoom factor for background estimation
+        perc (int): Percentage for the percentile filter
+        range (int): Range of the percentile filter
+
+    Returns:
+        numpy.array: The flattened image as a 2-dimensional array of floats
+                     between 0 and 1.
+
+    Raises:
+        NidabaAlgorithmException: The input image is empty.
+    """
+    if im.mode == 'RGBA':
+        im = im.convert('RGB')
+    elif im.mode not in ('L', 'RGB'):
+        im = im.convert('L')
+    raw = np.asarray(im)
+    # rescale image to between -1 or 0 and 1
+    raw = raw/np.float(np.iinfo(raw.dtype).max)
+    if raw.ndim == 3:
+        raw = np.mean(raw, 2)
+    # perform image normalization
+    image = raw-np.amin(raw)
+    if np.amax(image) == 0:
+        raise NidabaAlgorithmException('Image is empty')
+    image /= np.amax(image)
+
+    m = interpolation.zoom(image, zoom)
+    m = filters.percentile_filter(m, perc, size=(range, 2))
+    m = filters.percentile_filter(m, perc, size=(2, range))
+    m = interpolation.zoom(m, 1.0/zoom)
+    w, h = np.minimum(np.array(image.shape), np.array(m.shape))
+    return np.clip(image[:w, :h]-m[:w, :h]+1, 0, 1)
+
+
+def estimate(flat, escale=1.0, border=0.1):
+    """
+    Selects the pixels of a flattened image used for estimating the low and
+    high thresholds, i.e. the regions of significant variance outside the
+    border.
+
+    Args:
+        flat (numpy.array): A flattened image as returned by flatten()
+        escale (float): Scale for estimating a mask over the text region. All
+                        pixels are selected if it is not positive.
+        border (float): Fraction of the image ignored at each side
+
+    Returns:
+        numpy.array: A 1-dimensional array of the selected pixel values
+    """
+    d0, d1 = flat.shape
+    o0, o1 = int(border*d0), int(border*d1)
+    est = flat[o0:d0-o0, o1:d1-o1]
+    if escale > 0:
+        # by default, we use only regions that contain
+        # significant variance; this makes the percentile
+        # based low and high estimates more reliable
+        v = est-filters.gaussian_filter(est, escale*20.0)
+        v = filters.gaussian_filter(v**2, escale*20.0)**0.5
+        v = (v > 0.3*np.amax(v))
+        # dilation with a single pixel is the identity
+        size = max(int(escale*50), 1)
+        v = morphology.binary_dilation(v, structure=np.ones((size, 1)))
+        v = morphology.binary_dilation(v, structure=np.ones((1, size)))
+        est = est[v]
+    return est.ravel()
+
+
+def binarize(flat, est, threshold=0.5, low=5, high=90):
+    """
+    Thresholds a flattened image after rescaling it between the low and high
+    percentiles of the estimation pixels.
+
+    Args:
+        flat (numpy.array): A flattened image as returned by flatten()
+        est (numpy.array): Estimation pixels as returned by estimate()
+        threshold (float): Threshold of the rescaled image
+        low (int): Percentile for black estimation
+        high (int): Percentile for white estimation
+
+    Returns:
+        PIL.Image in mode 'L' containing the binarized image
+    """
+    lo = np.percentile(est, low)
+    hi = np.percentile(est, high)
+    flat = np.clip((flat - lo) / (hi - lo), 0, 1)
+    return Image.fromarray(np.array(255*(flat > threshold), 'B'), 'L')
+
+
+def nlbin(im, threshold=0.5, zoom=0.5, escale=1.0, border=0.1, perc=80,
+          range=20, low=5, high=90):
+    """
+    Performs binarization using non-linear processing. Equivalent to
+    kraken.binarization.nlbin().
+
+    Args:
+        im (PIL.Image): Input image
+        threshold (float):
+        zoom (float):
+        escale (float):
+        border (float):
+        perc (int):
+        range (int):
+        low (int):
+        high (int):
+
+    Returns:
+        PIL.Image in mode 'L' containing the binarized image
+    """
+    flat = flatten(im, zoom, perc, range)
+    return binarize(flat, estimate(flat, escale, border), threshold, low,
+                    high)
@@ -8,21 +8,19 @@ Module implementing variants of Otsu's method.
 
 import numpy as np
 
-def otsu(im):
+def otsu_threshold(hist):
     """
-    A naive native python implementation of Otsu thresholding (or at least the
-    algorithm Wikipedia describes as Otsu's method).
+    Calculates the threshold maximizing the between class variance of a
+    histogram as described by Otsu.
 
     Args:
-        im (PIL.Image): A PIL Image object in mode 'L' (8bpp grayscale)
+        hist (list): A list of 256 pixel counts
 
     Returns:
-        PIL.Image in mode '1' (1bpp b/w) containing the binarized image
+        int: The threshold. Pixels with values above it belong to the
+             foreground class.
     """
-
-    assert im.mode == 'L'
-    hist = im.histogram()
-    total = np.prod(im.size)
+    total = np.sum(hist)
     st = np.inner(range(0, len(hist)), hist)
 
     wb = 0.0
@@ -44,6 +42,21 @@ def otsu(im):
         if bcv > mvar:
             mvar = bcv
             thresh = i
+    return thresh
 
-    return im.point(lambda p: p > thresh and 255, mode='1')
 
+def otsu(im):
+    """
+    A naive native python implementation of Otsu thresholding (or at least the
+    algorithm Wikipedia describes as Otsu's method).
+
+    Args:
+        im (PIL.Image): A PIL Image object in mode 'L' (8bpp grayscale)
+
+    Returns:
+        PIL.Image in mode '1' (1bpp b/w) containing the binarized image
+    """
+
+    assert im.mode == 'L'
+    thresh = otsu_threshold(im.histogram())
+    return im.point(lambda p: p > thresh and 255, mode='1')
@@ -0,0 +1,85 @@
+"""
+nidaba.algorithms.sauvola
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Module implementing Sauvola's local thresholding on in-memory images.
+
+"""
+
+import numpy as np
+
+from PIL import Image
+
+
+def _window_sums(a, whsize):
+    """
+    Calculates the sum of all values in a (2*whsize+1)x(2*whsize+1) window
+    centered on each element of a 2-dimensional array using an integral image.
+    Windows are clipped at the array boundaries.
+
+    Args:
+        a (numpy.array): A 2-dimensional array of floats
+        whsize (int): Half width of the window
+
+    Returns:
+        A tuple (sums, counts) of arrays of the same shape as a containing the
+        window sums and the number of elements in each (clipped) window.
+    """
+    h, w = a.shape
+    integral = np.zeros((h + 1, w + 1), dtype=np.float64)
+    integral[1:, 1:] = a.cumsum(axis=0).cumsum(axis=1)
+
+    y0 = np.clip(np.arange(h) - whsize, 0, h)
+    y1 = np.clip(np.arange(h) + whsize + 1, 0, h)
+    x0 = np.clip(np.arange(w) - whsize, 0, w)
+    x1 = np.clip(np.arange(w) + whsize + 1, 0, w)
+
+    sums = (integral[y1][:, x1] - integral[y0][:, x1] -
+            integral[y1][:, x0] + integral[y0][:, x0])
+    counts = np.outer(y1 - y0, x1 - x0)
+    return sums, counts
+
+
+def sauvola_array(a, whsize=10, factor=0.35):
+    """
+    Binarizes a 2-dimensional array of grayscale values using Sauvola's
+    method.
+
+    Args:
+        a (numpy.array): A 2-dimensional array of 8 bit grayscale values
+        whsize (int): Half width of the local window.
+        factor (float): The threshold reduction factor due to variance.
+
+    Returns:
+        numpy.array: A boolean array with True for white pixels.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    sums, counts = _window_sums(a, whsize)
+    sqsums, _ = _window_sums(a * a, whsize)
+    mean = sums / counts
+    std = np.sqrt(np.maximum(sqsums / counts - mean * mean, 0))
+    return a >= mean * (1.0 - factor * (1.0 - std / 128.0))
+
+
+def sauvola(im, whsize=10, factor=0.35):
+    """
+    Binarizes an image using Sauvola's method, i.e. a pixel is set to black if
+    its value is below m * (1 - k * (1 - s/128)) with m and s being the mean
+    and standard deviation of its local window. The output is equivalent to
+    leptonica's pixSauvolaBinarize() except for the image border where windows
+    are clipped instead of extended.
+
+    Args:
+        im (PIL.Image): A PIL Image object in mode 'L' (8bpp grayscale)
+        whsize (int): Half width of the local window. The window is
+                      (2*whsize+1) pixels wide and high.
+        factor (float): The threshold reduction factor due to variance. 0 =<
+                        factor < 1.
+
+    Returns:
+        PIL.Image in mode '1' (1bpp b/w) containing the binarized image
+    """
+
+    assert im.mode == 'L'
+    white = sauvola_array(np.asarray(im), whsize, factor)
+    return Image.fromarray((white * 255).astype(np.uint8), 'L').convert('1')
@@ -0,0 +1,107 @@
+"""
+nidaba.algorithms.skew
+~~~~~~~~~~~~~~~~~~~~~~
+
+Module implementing skew estimation on reduced resolution previews using
+projection profiles and rotation of the full resolution image.
+
+"""
+
+from __future__ import division
+
+import numpy as np
+
+from PIL import Image, ImageChops
+
+from nidaba.algorithms.otsu import otsu
+
+
+def _foreground(im, reduction):
+    """
+    Creates a binarized preview of an image reduced by a factor and returns
+    the coordinates of its foreground (black) pixels.
+    """
+    if im.mode not in ('L', 'RGB'):
+        im = im.convert('L')
+    if reduction > 1:
+        im = im.resize((max(im.size[0] // reduction, 1),
+                        max(im.size[1] // reduction, 1)), Image.ANTIALIAS)
+    if im.mode != 'L':
+        im = im.convert('L')
+    fg = np.asarray(otsu(im).convert('L')) == 0
+    # the background is assumed to be the larger part of the page
+    if fg.sum() > fg.size / 2:
+        fg = ~fg
+    y, x = np.nonzero(fg)
+    return y, x
+
+
+def _score(y, x, angle):
+    """
+    Scores a skew angle by the sum of squares of the projection profile of
+    the foreground pixels sheared by the angle.
+    """
+    proj = np.round(y - x * np.tan(np.radians(angle))).astype(np.int64)
+    profile = np.bincount(proj - proj.min())
+    return np.inner(profile, profile)
+
+
+def estimate_skew(im, reduction=4, max_angle=7.0, step=1.0, precision=0.05):
+    """
+    Estimates the skew angle of an image by maximizing the variance of the
+    horizontal projection profile of a binarized, reduced resolution preview.
+    The angle is first searched with a coarse step and then refined around the
+    best angle with steps decreasing by an order of magnitude until the
+    precision is reached.
+
+    Args:
+        im (PIL.Image): Input image of arbitrary mode
+        reduction (int): Reduction factor of the preview (usually 2 or 4)
+        max_angle (float): Maximum absolute skew angle searched in degrees
+        step (float): Step of the coarse search in degrees
+        precision (float): Step of the final search in degrees
+
+    Returns:
+        float: Skew angle in degrees. Rotating the image counter-clockwise by
+               this angle removes the skew.
+    """
+    y, x = _foreground(im, reduction)
+    if len(y) == 0:
+        return 0.0
+    best = 0.0
+    lo, hi = -max_angle, max_angle
+    while True:
+        angles = np.arange(lo, hi + step / 2, step)
+        scores = [_score(y, x, a) for a in angles]
+        best = float(angles[int(np.argmax(scores))])
+        if step <= precision:
+            break
+        lo, hi = best - step, best + step
+        step = max(step / 10, precision)
+    return best
+
+
+def rotate(im, angle):
+    """
+    Rotates an image counter-clockwise around its center filling the corners
+    with white. The image dimensions are retained.
+
+    Args:
+        im (PIL.Image): Input image
+        angle (float): Angle in degrees
+
+    Returns:
+        PIL.Image: The rotated image
+    """
+    if not angle:
+        return im.copy()
+    mode = im.mode
+    if mode == '1':
+        im = im.convert('L')
+        resample = Image.NEAREST
+    else:
+        resample = Image.BICUBIC
+    # PIL fills the area outside of the source with black so the image is
+    # rotated inverted.
+    im = ImageChops.invert(ImageChops.invert(im).rotate(angle, resample))
+    return im.convert(mode) if mode != im.mode else im
@@ -7,12 +7,14 @@ This module encapsulates all shell callable functions of nidaba.
 from __future__ import absolute_import, print_function, unicode_literals
 
 from nidaba import Batch, storage
+from nidaba.nidaba import CHUNK_SIZE
 from nidaba.config import nidaba_cfg
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 
 import argparse
 import uuid
-import shutil
+import time
 import os.path
 
 
@@ -32,6 +34,13 @@ def main():
         'status', help='Displays the status of a job')
     statusparser.add_argument(
         'jobid', help='The unique job ID returned by batch.')
+    statusparser.add_argument(
+        '--follow', help='Prints the output files of each document as soon as\
+        it has been processed until the job has finished.',
+        action='store_true', default=False)
+    statusparser.add_argument(
+        '--progress', help='Displays the number of running, finished, and\
+        failed tasks of each method.', action='store_true', default=False)
     statusparser.set_defaults(func=status)
 
     # Command line parameters for configuration file display
@@ -66,6 +75,27 @@ def main():
     batchparser.add_argument('--grayscale', help=u'Input file are already 8bpp\
                              RGB grayscale.', action='store_true',
                              default=False)
+    batchparser.add_argument('--fuse', help=u'Runs consecutive image\
+                             processing tasks in a single task without writing\
+                             intermediate images to the storage medium.',
+                             action='store_true', default=False)
+    batchparser.add_argument('--force', help=u'Executes all tasks even if\
+                             their results are in the task result cache.',
+                             action='store_true', default=False)
+    batchparser.add_argument('--ingest', help=u'Adds input files to the job\
+                             as copy-on-write clones (reflink), hard links\
+                             (link), or copies (copy). auto clones them and\
+                             falls back to copying; hard links are only\
+                             used when selected. Input files must not be\
+                             modified in place while they are hard linked.',
+                             choices=['auto', 'reflink', 'link', 'copy'],
+                             default='auto')
+    batchparser.add_argument('--ingest-threads', help=u'Number of input files\
+                             added in parallel.', type=int, default=4)
+    batchparser.add_argument('--chunk-size', help=u'Number of documents\
+                             submitted at once. Documents are submitted while\
+                             the remaining input files are still added.',
+                             type=int, default=CHUNK_SIZE)
 
     batchparser.set_defaults(func=batch)
 
@@ -108,13 +138,14 @@ def batch(args):
 
     id = unicode(uuid.uuid4())
     batch = Batch(id)
+    for doc in args.files:
+        if not os.path.isfile(doc):
+            print('Input file {} does not exist.'.format(doc))
+            exit()
     print('Preparing filestore....', end=''),
     if storage.prepare_filestore(id) is None:
         print('failed.')
         exit()
-    for doc in args.files:
-        shutil.copy2(doc, storage.get_abs_path(id, os.path.basename(doc)))
-        batch.add_document((id, os.path.basename(doc)))
     print('done.')
     print('Building batch...', end='')
 
@@ -152,11 +183,52 @@ def batch(args):
         batch.add_step()
         batch.add_tick()
         batch.add_task('util.blend_hocr')
-    batch.run()
+    stats = {}
+    batch.run(fuse=args.fuse, force=args.force, chunk_size=args.chunk_size,
+              docs=_ingest(id, args.files, args.ingest, args.ingest_threads,
+                           stats), count=len(args.files))
     print('done.')
+    methods = u', '.join(u'{} {}'.format(v, k) for k, v in
+                         sorted(stats['methods'].iteritems()))
+    mib = stats['bytes'] / 1048576.0
+    print('Ingested {} files ({:.1f} MiB) in {:.2f}s ({:.1f} MiB/s; '
+          '{}).'.format(len(args.files), mib, stats['time'],
+                        mib / max(stats['time'], 1e-6), methods))
     print(id)
 
 
+def _ingest(id, files, mode, threads, stats):
+    """
+    Adds input files to a job in parallel, yielding their storage tuples as
+    soon as they have been added.
+
+    Args:
+        id (unicode): The job identifier
+        files (list): Paths of the input files
+        mode (unicode): Ingestion mode (see nidaba.storage.ingest)
+        threads (int): Number of files added in parallel
+        stats (dict): Receives the number of bytes ingested, the time taken,
+                      and the number of files per ingestion method.
+    """
+    def ingest(doc):
+        dest = os.path.basename(doc)
+        method = storage.ingest(doc, id, dest, mode)
+        return (id, dest), os.path.getsize(doc), method
+
+    stats.update({'bytes': 0, 'methods': {}})
+    start = time.time()
+    pool = ThreadPool(threads)
+    try:
+        for doc, size, method in pool.imap_unordered(ingest, files):
+            stats['bytes'] += size
+            stats['methods'][method] = stats['methods'].get(method, 0) + 1
+            yield doc
+    finally:
+        pool.close()
+        pool.join()
+        stats['time'] = time.time() - start
+
+
 def config(args):
     """
     Implements the config display subcommand.
@@ -174,16 +246,24 @@ def status(args):
     """
 
     batch = Batch(args.jobid)
+    if args.follow:
+        for ret in batch.iter_results():
+            _print_paths(ret)
     state = batch.get_state()
     print(state)
-    if state == 'SUCCESS':
+    if args.progress:
+        for method, counts in sorted(batch.get_progress().iteritems()):
+            print('\t{}: {} done, {} running, {} failed'.format(
+                method, counts['done'], counts['running'],
+                counts['failed']))
+    if state == 'SUCCESS' and not args.follow:
         ret = batch.get_results()
         if ret is None:
             print('Something somewhere went wrong.')
             print('Please contact your friendly nidaba support technician.')
         else:
             for doc in ret:
-                print('\t' + storage.get_abs_path(*doc).encode('utf-8'))
+                _print_paths(doc)
     elif state == 'FAILURE':
         ret = batch.get_errors()
         if ret is None:
@@ -195,3 +275,18 @@ def status(args):
                       fun[0]['doc'][1].encode('utf-8'), 
                       'which is based on',
                       fun[1]['root'][1].encode('utf-8'))
+
+
+def _print_paths(ret):
+    """
+    Prints the absolute paths of all output documents in a (possibly nested)
+    result of a batch.
+    """
+    if isinstance(ret, dict):
+        _print_paths(ret['doc'])
+    elif (len(ret) == 2 and isinstance(ret[0], basestring) and
+          isinstance(ret[1], basestring)):
+        print('\t' + storage.get_abs_path(*ret))
+    else:
+        for doc in ret:
+            _print_paths(doc)
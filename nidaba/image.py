@@ -4,13 +4,120 @@ nidaba.image
 
 Common image processing functions encapsulating the PIL or pythonica image
 interface to absolute file paths.
+
+Additionally a small in-process pipeline is provided running a sequence of
+operations on a single decoded image without writing intermediate results to
+the common storage medium.
 """
 
 from __future__ import absolute_import
 
 from PIL import Image
 
-from nidaba.algorithms.otsu import otsu
+from nidaba import leper
+from nidaba import tiles
+from nidaba.config import nidaba_cfg
+from nidaba.nidabaexceptions import NidabaAlgorithmException
+
+import nidaba.algorithms.otsu as otsu_alg
+import nidaba.algorithms.sauvola as sauvola_alg
+import nidaba.algorithms.nlbin as nlbin_alg
+import nidaba.algorithms.skew as skew_alg
+
+import os
+import shutil
+import tempfile
+
+# Extensions of the supported intermediate formats
+intermediate_formats = {u'pnm': u'.pnm'}
+
+
+def intermediate_path(path):
+    """
+    Appends the extension of the intermediate format defined in the
+    configuration to the path of an intermediate image (one that is only
+    consumed by later tasks). The regular extension is retained so
+    storage.insert_suffix() derives the same output names for later tasks as
+    for regular images. If no intermediate format is configured the path is
+    returned unaltered.
+
+    Arguments:
+        path: Path of an output image
+
+    Returns:
+        unicode: Path of the output image in the intermediate format
+    """
+    fmt = nidaba_cfg.get('intermediate_format')
+    if not fmt:
+        return path
+    if fmt not in intermediate_formats:
+        raise NidabaAlgorithmException('Unknown intermediate format ' + fmt)
+    return path + intermediate_formats[fmt]
+
+
+def save_image(img, path):
+    """
+    Writes an image to a path with the format implied by its extension.
+    Netpbm files are always written uncompressed in binary form.
+
+    Arguments:
+        img (PIL.Image): Image to write
+        path: Path of the output image
+    """
+    if os.path.splitext(path)[1].lower() in (u'.pnm', u'.pbm', u'.pgm',
+                                              u'.ppm'):
+        img.save(path, format='PPM')
+    else:
+        img.save(path)
+
+
+def load_image(path):
+    """
+    Opens an image. Binary 8 bit netpbm images are memory-mapped instead of
+    being read into memory; in the case of grayscale images the pixel data of
+    the returned image is the mapping itself.
+
+    Arguments:
+        path: Path of the input image
+
+    Returns:
+        PIL.Image: The image
+    """
+    r = tiles.map_raster(path)
+    if r is None:
+        return Image.open(path)
+    mode, raster = r
+    height, stride = raster.shape[:2]
+    if mode == '1':
+        width = tiles.image_size(path)[0]
+        rawmode = '1;I'
+    else:
+        width = stride
+        rawmode = mode
+        stride = raster.strides[0]
+    return Image.frombuffer(mode, (width, height), raster, 'raw', rawmode,
+                            stride, 1)
+
+
+def tile_size(imagepath):
+    """
+    Returns the tile size if an image is large enough to be processed in
+    tiles according to the ``tiling`` configuration, None otherwise.
+
+    Arguments:
+        imagepath: Path of the image
+
+    Returns:
+        int: Width and height of the tiles or None
+    """
+    cfg = nidaba_cfg.get('tiling')
+    if not cfg:
+        return None
+    width, height = tiles.image_size(imagepath)
+    if width * height > cfg.get('max_pixels', 0):
+        return cfg.get('tile_size', 1024)
+    return None
+
 
 def otsu(imagepath, resultpath):
     """
@@ -24,13 +131,17 @@ def otsu(imagepath, resultpath):
         unicode: Path of the actual output file
     """
 
-    img = Image.open(imagepath)
-    otsu(im).save(resultpath)
+    img = load_image(imagepath)
+    if img.mode != 'L':
+        img = img.convert('L')
+    save_image(otsu_alg.otsu(img), resultpath)
     return resultpath
 
+
 def rgb_to_gray(imagepath, resultpath):
     """
-    Converts an RGB or CMYK image into a 8bpp grayscale image.
+    Converts an RGB or CMYK image into a 8bpp grayscale image. Images
+    exceeding the configured size are processed in tiles.
 
     Arguments:
         imagepath: Path of the input image
@@ -38,8 +149,186 @@ def rgb_to_gray(imagepath, resultpath):
 
     Returns:
         unicode: Path of the actual output file
+
+    Raises:
+        NidabaAlgorithmException: A tiled image can not be read or written
+                                  incrementally and exceeds the decoding
+                                  limit.
     """
 
-    img = Image.open(imagepath)
-    img.convert('L').save(resultpath)
+    size = tile_size(imagepath)
+    if size:
+        return tiles.rgb_to_gray(imagepath, resultpath, size,
+                                 nidaba_cfg['tiling'].get('max_decode_pixels'))
+    img = load_image(imagepath)
+    save_image(img.convert('L'), resultpath)
     return resultpath
+
+
+def sauvola(imagepath, resultpath, whsize=10, factor=0.35):
+    """
+    Binarizes a grayscale image using Sauvola's algorithm. Images exceeding
+    the configured size are processed in tiles.
+
+    Arguments:
+        imagepath: Path of the input image
+        resultpath: Path of the output image
+        whsize (int): Half width of the local window
+        factor (float): The threshold reduction factor due to variance
+
+    Returns:
+        unicode: Path of the actual output file
+
+    Raises:
+        NidabaAlgorithmException: A tiled image can not be read or written
+                                  incrementally and exceeds the decoding
+                                  limit.
+    """
+
+    size = tile_size(imagepath)
+    if size:
+        return tiles.sauvola(imagepath, resultpath, whsize, factor, size,
+                             nidaba_cfg['tiling'].get('max_decode_pixels'))
+    img = load_image(imagepath)
+    if img.mode != 'L':
+        img = img.convert('L')
+    save_image(sauvola_alg.sauvola(img, whsize, factor), resultpath)
+    return resultpath
+
+
+def deskew(imagepath, resultpath, reduction=4, angle=None):
+    """
+    Removes skew from an image. The skew angle is estimated on a binarized
+    preview of reduced resolution and the full resolution image is rotated
+    once.
+
+    Arguments:
+        imagepath: Path of the input image
+        resultpath: Path of the output image
+        reduction (int): Reduction factor of the preview
+        angle (float): A previously estimated skew angle in degrees. If given
+                       no estimation is performed.
+
+    Returns:
+        (unicode, float): Path of the actual output file and the skew angle
+    """
+
+    img = load_image(imagepath)
+    if angle is None:
+        angle = skew_alg.estimate_skew(img, reduction)
+    save_image(skew_alg.rotate(img, angle), resultpath)
+    return resultpath, angle
+
+
+def _leper_op(func, img, *args):
+    """
+    Runs a leptonica function of the leper wrapper on an in-memory image. As
+    leper only operates on files the image is passed through an uncompressed
+    temporary file on the local disk.
+
+    Args:
+        func (callable): A leper function accepting an input and output path
+                         as its first arguments.
+        img (PIL.Image): The input image
+        *args: Additional arguments to func
+
+    Returns:
+        PIL.Image: The resulting image
+
+    Raises:
+        NidabaAlgorithmException: The leptonica function failed.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        inpath = os.path.join(tmpdir, u'in.pnm')
+        outpath = os.path.join(tmpdir, u'out.pnm')
+        img.save(inpath, format='PPM')
+        if func(inpath, outpath, *args) is None:
+            raise NidabaAlgorithmException('leptonica failed on ' +
+                                           func.__name__)
+        res = Image.open(outpath)
+        res.load()
+        return res
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _op_rgb_to_gray(img):
+    return img.convert('L')
+
+
+def _op_otsu(img, thresh=100, mincount=50, bgval=255, smoothx=2, smoothy=2):
+    return _leper_op(leper.otsu_binarize, img, thresh, mincount, bgval,
+                     smoothx, smoothy)
+
+
+def _op_sauvola(img, whsize=10, factor=0.35):
+    return _leper_op(leper.sauvola_binarize, img, whsize, factor)
+
+
+def _op_nlbin(img, threshold=0.5, zoom=0.5, escale=1.0, border=0.1, perc=80,
+              range=20, low=5, high=90):
+    return nlbin_alg.nlbin(img, threshold, zoom, escale, border, perc, range,
+                           low, high)
+
+
+def _op_deskew(img, reduction=0, skew_angle=None):
+    if skew_angle is None and not reduction:
+        return _leper_op(leper.deskew, img)
+    if skew_angle is None:
+        skew_angle = skew_alg.estimate_skew(img, reduction)
+    return skew_alg.rotate(img, skew_angle), {'skew_angle': skew_angle}
+
+
+def _op_dewarp(img):
+    return _leper_op(leper.dewarp, img)
+
+
+# Operations available in pipeline(). Each maps a PIL image and keyword
+# arguments to a new PIL image or a tuple of a new image and a dictionary of
+# tracking data.
+operations = {u'rgb_to_gray': _op_rgb_to_gray,
+              u'otsu': _op_otsu,
+              u'sauvola': _op_sauvola,
+              u'nlbin': _op_nlbin,
+              u'deskew': _op_deskew,
+              u'dewarp': _op_dewarp}
+
+
+def pipeline(imagepath, steps):
+    """
+    Runs a linear sequence of image operations on a single in-memory image.
+    The input image is decoded once and only the results of steps with an
+    output path are encoded and written.
+
+    Arguments:
+        imagepath: Path of the input image
+        steps (list): A list of tuples (operation, kwargs, resultpath) where
+                      operation is a key of ``operations``, kwargs a
+                      dictionary of arguments to the operation, and
+                      resultpath either the path to write the result of the
+                      step to or None.
+
+    Returns:
+        (list, dict): Paths of all output files written and the tracking data
+                      returned by the operations.
+
+    Raises:
+        NidabaAlgorithmException: Unknown operation or failure of an
+                                  operation.
+    """
+
+    img = load_image(imagepath)
+    written = []
+    tracking = {}
+    for op, kwargs, resultpath in steps:
+        if op not in operations:
+            raise NidabaAlgorithmException('Unknown operation ' + op)
+        img = operations[op](img, **kwargs)
+        if isinstance(img, tuple):
+            img, data = img
+            tracking.update(data)
+        if resultpath:
+            save_image(img, resultpath)
+            written.append(resultpath)
+    return written, tracking
@@ -7,9 +7,51 @@ Routines encapsulating the kraken OCR engine
 
 from __future__ import absolute_import
 
-from PIL import Image
+from nidaba.image import load_image, save_image
+from nidaba.algorithms import nlbin as nlbin_alg
 
-from kraken import binarization
+
+def nlbin_sweep(imagepath, variants):
+    """
+    Converts an 8bpp grayscale image into multiple black and white ones using
+    the non-linear processing algorithm from ocropus/kraken with different
+    parameters. The background estimation is only run once for each distinct
+    combination of zoom, perc, and range and the threshold estimation once
+    for each distinct combination of those and escale and border. Nothing is
+    retained between calls.
+
+    Args:
+        imagepath: Path of the input image
+        variants (list): A list of tuples (resultpath, kwargs) with kwargs
+                         being a dictionary of arguments to nlbin().
+
+    Returns:
+        list: Paths of the output files
+    """
+    img = load_image(imagepath)
+    variants = [(resultpath, dict(dict(threshold=0.5, zoom=0.5, escale=1.0,
+                                       border=0.1, perc=80, range=20, low=5,
+                                       high=90), **kwargs))
+                for resultpath, kwargs in variants]
+    # variants are processed grouped by their background estimation
+    # parameters so only a single flattened image is held at any time.
+    fkeys = []
+    for resultpath, kw in variants:
+        if (kw['zoom'], kw['perc'], kw['range']) not in fkeys:
+            fkeys.append((kw['zoom'], kw['perc'], kw['range']))
+    for fkey in fkeys:
+        flat = nlbin_alg.flatten(img, *fkey)
+        ests = {}
+        for resultpath, kw in variants:
+            if (kw['zoom'], kw['perc'], kw['range']) != fkey:
+                continue
+            ekey = (kw['escale'], kw['border'])
+            if ekey not in ests:
+                ests[ekey] = nlbin_alg.estimate(flat, *ekey)
+            save_image(nlbin_alg.binarize(flat, ests[ekey], kw['threshold'],
+                                          kw['low'], kw['high']), resultpath)
+        del flat, ests
+    return [resultpath for resultpath, kw in variants]
 
 
 def nlbin(imagepath, resultpath, threshold=0.5, zoom=0.5, escale=1.0,
@@ -33,7 +75,9 @@ def nlbin(imagepath, resultpath, threshold=0.5, zoom=0.5, escale=1.0,
     Returns:
         unicode: Path of the output file
     """
-    img = Image.open(imagepath)
-    binarization.nlbin(img, threshold, zoom, escale, border, perc, range, low,
-                       high).save(resultpath)
-    return resultpath
+    return nlbin_sweep(imagepath, [(resultpath, dict(threshold=threshold,
+                                                     zoom=zoom,
+                                                     escale=escale,
+                                                     border=border, perc=perc,
+                                                     range=range, low=low,
+                                                     high=high))])[0]
@@ -5,13 +5,71 @@ nidaba.lock
 
 This module contains an NFS-safe locking method that is hopefully interoperable
 with anything anybody is going to encounter out there.
+
+A lock is a symbolic link next to the locked file pointing to a name
+identifying the holder (host and PID). Creating a symbolic link is atomic on
+NFS, too. Waiters poll with bounded exponential backoff; on Linux they are
+additionally woken up by inotify when the lock is removed by a process on the
+same machine. Locks held by dead processes on the same host and locks older
+than their lease are broken.
 """
 
 from __future__ import absolute_import
 
 import os
 import time
+import errno
 import random
+import select
+import binascii
+
+from nidaba.config import nidaba_cfg
+from nidaba.nidabaexceptions import NidabaLockTimeoutException
+
+
+class _inotify_watch(object):
+    """
+    Watches a directory for removed and renamed entries using inotify through
+    ctypes. Only available on Linux; events are only delivered for changes
+    made on the local machine.
+    """
+
+    IN_MOVED_FROM = 0x40
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0x800
+    IN_CLOEXEC = 0x80000
+
+    _libc = None
+
+    def __init__(self, path):
+        if _inotify_watch._libc is None:
+            import ctypes
+            import ctypes.util
+            _inotify_watch._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                               use_errno=True)
+        libc = _inotify_watch._libc
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(errno.ENOSYS, 'inotify unavailable')
+        if libc.inotify_add_watch(self.fd, path.encode('utf-8'),
+                                  self.IN_DELETE | self.IN_MOVED_FROM) < 0:
+            os.close(self.fd)
+            raise OSError(errno.ENOSYS, 'inotify unavailable')
+
+    def wait(self, timeout):
+        """
+        Waits until an entry of the directory is removed or the timeout
+        expires.
+        """
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if r:
+            try:
+                os.read(self.fd, 4096)
+            except OSError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
 
 
 class lock(object):
@@ -19,32 +77,218 @@ class lock(object):
     A global lock implementation for files on the common storage medium. It is
     intended to be mainly used on NFS although it should work on any network
     file system.
+
+    Defaults of the keyword arguments are taken from the lock configuration
+    key.
     """
-    def __init__(self, locked_file):
+
+    # seconds after which the lock serializing the breakers of a lock is
+    # broken. Breaking a lock only takes a few file system operations.
+    break_lease = 60
+
+    def __init__(self, locked_file, timeout=None, lease=None, min_wait=None,
+                 max_wait=None, inotify=None):
         """
         Initialize a lock object.
 
         Args:
             locked_file (unicode): Path to the file to be locked
+            timeout (float): Maximum number of seconds acquire() waits for the
+                             lock. None waits indefinitely.
+            lease (float): Age in seconds after which a lock held by a
+                           process on another host is considered stale. None
+                           never breaks such locks.
+            min_wait (float): Initial interval between two attempts to
+                              acquire the lock in seconds.
+            max_wait (float): Upper bound of the interval between two attempts
+                              in seconds.
+            inotify (bool): Wake up waiters with inotify when the lock is
+                            released on the same machine.
         """
+        cfg = nidaba_cfg.get('lock') or {}
+        self.timeout = timeout if timeout is not None else cfg.get('timeout')
+        self.lease = lease if lease is not None else cfg.get('lease')
+        self.min_wait = min_wait if min_wait is not None else \
+            cfg.get('min_wait', 0.001)
+        self.max_wait = max_wait if max_wait is not None else \
+            cfg.get('max_wait', 0.1)
+        self.inotify = inotify if inotify is not None else \
+            cfg.get('inotify', True)
         self._locked_file = locked_file + u'.lock'
         self._lock_file = unicode(os.uname()[1]) + u'.' + \
             unicode(os.getpid()) + u'.lock'
 
-    def acquire(self):
+    def __enter__(self):
+        if not self.acquire():
+            raise NidabaLockTimeoutException('Timeout acquiring lock on '
+                                             '{}'.format(self._locked_file))
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _try_acquire(self):
+        try:
+            os.symlink(self._lock_file, self._locked_file)
+            return True
+        except OSError:
+            try:
+                return os.readlink(self._locked_file) == self._lock_file
+            except OSError:
+                return False
+
+    def _is_stale(self, holder, mtime):
         """
-        Acquires a lock on the selected file. Waits until the lock can be
-        acquired.
+        Checks if a lock held by holder and created at mtime is stale, i.e. its
+        holder is a dead process on this host or its lease expired.
         """
-        while True:
+        try:
+            host, pid, _ = holder.rsplit(u'.', 2)
+            pid = int(pid)
+        except ValueError:
+            host, pid = None, None
+        if host == unicode(os.uname()[1]):
             try:
-                os.symlink(self._lock_file, self._locked_file)
-                break
-            except:
-                if os.path.islink(self._locked_file) and \
-                   os.readlink(self._locked_file) == self._lock_file:
-                    break
-            time.sleep(random.random() + 0.001)
+                os.kill(pid, 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    return True
+        return self.lease is not None and time.time() - mtime > self.lease
+
+    def _break_stale(self, path=None):
+        """
+        Removes the lock (or another lock file at path) if it is stale.
+
+        Breakers of a lock are serialized by a second lock (the lock file with
+        a '.break' suffix) so no other breaker can replace the stale lock
+        between it being read and removed. The stale lock is then renamed to
+        a unique name and removed only if it still is the link read before.
+        Otherwise, which is only possible if a holder outlived its lease and
+        released the lock to acquire it again, the link is put back without
+        replacing a lock acquired in the meantime.
+        """
+        path = path or self._locked_file
+        try:
+            holder = os.readlink(path)
+            st = os.lstat(path)
+        except OSError:
+            return
+        if holder == self._lock_file or not self._is_stale(holder,
+                                                           st.st_mtime):
+            return
+        breaker = path + u'.break'
+        if not self._acquire_breaker(breaker):
+            return
+        try:
+            broken = u'{}.{}.{}.broken'.format(path, os.getpid(),
+                                               binascii.hexlify(os.urandom(4)))
+            try:
+                os.rename(path, broken)
+            except OSError:
+                return
+            try:
+                bst = os.lstat(broken)
+                if os.readlink(broken) != holder or bst.st_ino != st.st_ino \
+                   or bst.st_mtime != st.st_mtime:
+                    # hard links neither follow symbolic links nor replace
+                    # existing files.
+                    try:
+                        os.link(broken, path)
+                    except OSError:
+                        pass
+            finally:
+                os.remove(broken)
+        finally:
+            try:
+                if os.readlink(breaker) == self._lock_file:
+                    os.remove(breaker)
+            except OSError:
+                pass
+
+    def _acquire_breaker(self, breaker):
+        """
+        Tries once to acquire the lock serializing the breakers of a lock.
+        Breaker locks of dead processes and older than the break lease are
+        removed so the next attempt can take them.
+        """
+        try:
+            os.symlink(self._lock_file, breaker)
+            return True
+        except OSError:
+            pass
+        try:
+            holder = os.readlink(breaker)
+            mtime = os.lstat(breaker).st_mtime
+        except OSError:
+            return False
+        if holder != self._lock_file and \
+           (self._is_stale(holder, mtime) or
+                time.time() - mtime > self.break_lease):
+            try:
+                os.remove(breaker)
+            except OSError:
+                pass
+        return False
+
+    def _wait(self, attempt, timeout):
+        """
+        Calls attempt until it returns True, backing off exponentially between
+        calls.
+
+        Args:
+            attempt (callable): Tries to acquire the lock without blocking.
+            timeout (float): Maximum number of seconds to wait or None.
+
+        Returns:
+            bool: True if attempt succeeded, False on timeout.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        watch = None
+        if self.inotify:
+            try:
+                watch = _inotify_watch(os.path.dirname(
+                    os.path.abspath(self._locked_file)))
+            except (OSError, AttributeError):
+                watch = None
+        wait = self.min_wait
+        try:
+            while True:
+                if attempt():
+                    return True
+                sleep = random.uniform(wait / 2, wait)
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    sleep = min(sleep, remaining)
+                if watch:
+                    watch.wait(sleep)
+                else:
+                    time.sleep(sleep)
+                wait = min(wait * 2, self.max_wait)
+        finally:
+            if watch:
+                watch.close()
+
+    def _attempt(self):
+        self._break_stale()
+        return self._try_acquire()
+
+    def acquire(self, timeout=None):
+        """
+        Acquires a lock on the selected file. Waits until the lock can be
+        acquired or the timeout expires.
+
+        Args:
+            timeout (float): Overrides the timeout given on initialization.
+
+        Returns:
+            bool: True if the lock has been acquired, False on timeout.
+        """
+        if self._try_acquire():
+            return True
+        timeout = timeout if timeout is not None else self.timeout
+        return self._wait(self._attempt, timeout)
 
     def release(self):
         """
@@ -61,3 +305,138 @@ class lock(object):
             except:
                 pass
         return False
+
+
+class rwlock(lock):
+    """
+    A reader-writer lock for files on the common storage medium. Any number of
+    processes may hold a shared lock on a file at the same time while an
+    exclusive lock excludes all other holders. Writers are preferred: once a
+    writer waits for the lock no new shared locks are granted.
+
+    Writers take the exclusive lock of the lock class and then wait for the
+    readers to leave. Each reader holds a symbolic link of its own in a
+    directory next to the locked file (the lock file with a '.readers'
+    suffix) which is only created while no writer holds or waits for the
+    lock, so writers only list the readers of their file. The last reader
+    leaving removes the directory. Stale links of readers are broken like
+    stale locks.
+    """
+    def __init__(self, locked_file, shared=False, **kwargs):
+        """
+        Initialize a reader-writer lock object.
+
+        Args:
+            locked_file (unicode): Path to the file to be locked
+            shared (bool): Acquire a shared instead of an exclusive lock.
+            **kwargs: Keyword arguments of lock
+        """
+        super(rwlock, self).__init__(locked_file, **kwargs)
+        self.shared = shared
+        self._readers_dir = self._locked_file + u'.readers'
+        self._reader_file = None
+
+    def _readers(self):
+        """
+        Returns the paths of the links of all readers.
+        """
+        try:
+            files = os.listdir(self._readers_dir)
+        except OSError:
+            return []
+        return [os.path.join(self._readers_dir, f) for f in files if
+                f.endswith(u'.shared')]
+
+    def _remove_readers_dir(self):
+        """
+        Removes the directory of the reader links if it is empty so writers
+        waiting on the parent directory are woken up.
+        """
+        try:
+            os.rmdir(self._readers_dir)
+        except OSError:
+            pass
+
+    def _attempt_shared(self):
+        if os.path.lexists(self._locked_file):
+            self._break_stale()
+            return False
+        reader_file = os.path.join(self._readers_dir, u'{}.{}.shared'.format(
+            self._lock_file[:-len(u'.lock')],
+            binascii.hexlify(os.urandom(4))))
+        try:
+            os.mkdir(self._readers_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.symlink(self._lock_file, reader_file)
+        except OSError as e:
+            # the last reader removed the directory in the meantime
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        # a writer may have arrived between the check and the creation of
+        # the link. It is either seen here or sees the link itself.
+        if os.path.lexists(self._locked_file):
+            os.remove(reader_file)
+            self._remove_readers_dir()
+            return False
+        self._reader_file = reader_file
+        return True
+
+    def _attempt_exclusive(self):
+        readers = self._readers()
+        for reader in readers:
+            self._break_stale(reader)
+        if readers and self._readers():
+            return False
+        self._remove_readers_dir()
+        return True
+
+    def acquire(self, timeout=None):
+        """
+        Acquires a shared or exclusive lock on the selected file. Waits until
+        the lock can be acquired or the timeout expires.
+
+        Args:
+            timeout (float): Overrides the timeout given on initialization.
+
+        Returns:
+            bool: True if the lock has been acquired, False on timeout.
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        if self.shared:
+            if self._attempt_shared():
+                return True
+            return self._wait(self._attempt_shared, timeout)
+        start = time.time()
+        if not super(rwlock, self).acquire(timeout):
+            return False
+        if timeout is not None:
+            timeout = max(timeout - (time.time() - start), 0)
+        if self._attempt_exclusive() or \
+           self._wait(self._attempt_exclusive, timeout):
+            return True
+        super(rwlock, self).release()
+        return False
+
+    def release(self):
+        """
+        Releases the lock on the selected file.
+
+        Returns:
+            bool: True if the lock has been releases, False otherwise
+        """
+        if not self.shared:
+            return super(rwlock, self).release()
+        if self._reader_file is None:
+            return False
+        try:
+            os.remove(self._reader_file)
+            self._remove_readers_dir()
+            return True
+        except OSError:
+            return False
+        finally:
+            self._reader_file = None
@@ -16,13 +16,20 @@ from nidaba.nidabaexceptions import (NidabaInputException,
                                      NidabaNoSuchAlgorithmException,
                                      NidabaTickException, NidabaStepException)
 
-from itertools import product
+from itertools import product, islice
+from inspect import getargspec
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from celery import chain
 from celery import group
-from celery.result import AsyncResult
-from celery.states import state
+from celery import signature
 
 import json
+import time
+
+# number of documents submitted over a single broker connection unless given
+# otherwise.
+CHUNK_SIZE = 500
 
 
 class Batch(object):
@@ -54,22 +61,28 @@ class Batch(object):
         task 1 -> task 3 -> task 4
         task 1 -> task 3 -> task 5
 
+    Sequences sharing a common prefix are merged when the batch is run, i.e.
+    task 1 above is executed only once and its output is passed to both task 2
+    and task 3, which again each pass their output to task 4 and task 5.
+
     It is not garantueed that any particular task in another sequence has
     executed successfully before a task in a sequence is run, i.e. it is not
     ensured that all task 1's have finished before task 2 of the first sequence
     is executed, except the task(s) further up the sequence.
 
     Steps on the other hand ensure that all tasks of the previous step have
-    finished successfully. The output(s) of the expanded ticks is aggregated
-    into a single list and used as the input of the first tick of the step.
+    finished successfully for all documents of the batch. The output(s) of the
+    expanded ticks of all documents is aggregated into a single list of
+    storage tuples and used as the input of the first tick of the step.
+    Steps after the first one are therefore run only once per batch.
     Expanding on the example the following step is added:
 
         step 2:
             tick d: task 6
 
-    After the 4 sequence are finished their output is aggregated into a list
-    [d1, d2, d3, d4] and used as the input of task 6. The final output of task
-    6 is the output of the pipeline.
+    After the 4 sequences are finished for all n documents their output is
+    aggregated into a list [d1_1, d1_2, ..., dn_4] and used as the input of
+    task 6. The final output of task 6 is the output of the pipeline.
 
     The call order to create this example is:
 
@@ -95,9 +108,41 @@ class Batch(object):
         self.cur_step = None
         self.cur_tick = None
 
+    def _get_header(self):
+        """
+        Retrieves the header of the batch record or None if the batch is
+        unknown.
+        """
+        try:
+            return json.loads(celery.app.backend.get(self.id))
+        except Exception:
+            return None
+
+    def _get_document_fields(self, indices, field):
+        """
+        Retrieves a field of the entries of a set of documents of the batch
+        with a single request.
+
+        Args:
+            indices (list): Indices of the documents
+            field (unicode): One of 'doc', 'task_id', 'state', or 'result'
+
+        Returns:
+            list: The decoded values in the order of indices; None for unset
+                  fields.
+        """
+        values = tasks.helper.get_fields(tasks.helper.documents_key(self.id),
+                                         [u'{}:{}'.format(idx, field) for
+                                          idx in indices])
+        return [json.loads(v) if v is not None else None for v in values]
+
     def get_state(self):
         """Retrieves the current state of a batch.
 
+        Only the batch header, the length of the error list, the number of
+        finished documents, and the state of the later steps are retrieved so
+        the cost does not depend on the size of the batch.
+
         Returns:
             (unicode): A string containing one of the following states:
 
@@ -106,39 +151,101 @@ class Batch(object):
                 PENDING: The batch is currently running.
                 SUCCESS: The batch has completed successfully.
         """
-        batch = celery.app.backend.get(self.id)
-        try:
-            batch = json.loads(batch)
-        except Exception:
+        header = self._get_header()
+        if header is None:
             return u'NONE'
-        if len(batch['errors']) > 0:
+        if tasks.helper.count_records(tasks.helper.errors_key(self.id)) > 0:
             return u'FAILURE'
+        finished = tasks.helper.count_members(
+            tasks.helper.finished_key(self.id))
+        if finished < header['documents']:
+            return u'PENDING'
+        if header.get('later_steps'):
+            st = tasks.helper.get_fields(tasks.helper.documents_key(self.id),
+                                         [u'state'])[0]
+            if st is None:
+                return u'PENDING'
+            if json.loads(st) == u'FAILURE':
+                return u'FAILURE'
+        return u'SUCCESS'
+
+    def get_documents(self, start=0, count=None):
+        """
+        Retrieves the entries of a slice of the documents of the batch.
 
-        st = state('SUCCESS')
-        for id in batch['task_ids']:
-            if AsyncResult(id).state < st:
-                st = AsyncResult(id).state
-        return unicode(st)
+        Args:
+            start (int): Index of the first document
+            count (int): Maximum number of documents. All remaining documents
+                         are retrieved if None.
 
-    def get_errors(self):
+        Returns:
+            list: A list of dictionaries containing the input document under
+            the key 'doc', the celery task ID of its chain under 'task_id',
+            its state under 'state' (PENDING, SUCCESS, or FAILURE), and the
+            result of a successful chain under 'result'. None if the batch is
+            unknown.
+        """
+        header = self._get_header()
+        if header is None:
+            return None
+        stop = header['documents']
+        if count is not None:
+            stop = min(stop, start + count)
+        indices = range(start, stop)
+        fields = [u'doc', u'task_id', u'state', u'result']
+        values = tasks.helper.get_fields(tasks.helper.documents_key(self.id),
+                                         [u'{}:{}'.format(idx, f) for idx in
+                                          indices for f in fields])
+        values = [json.loads(v) if v is not None else None for v in values]
+        docs = []
+        for pos in xrange(0, len(values), len(fields)):
+            doc = dict(zip(fields, values[pos:pos + len(fields)]))
+            doc[u'state'] = doc[u'state'] or u'PENDING'
+            docs.append(doc)
+        return docs
+
+    def get_progress(self):
         """
-        Retrieves all errors of the batch.
+        Retrieves the progress counters of the batch with a single backend
+        request independent of the size of the batch.
+
+        Returns:
+            dict: A dictionary mapping each task method to a dictionary
+            containing the number of running, finished ('done'), and failed
+            tasks.
+        """
+        progress = {}
+        counters = tasks.helper.get_counters(
+            tasks.helper.progress_key(self.id))
+        for field, count in counters.iteritems():
+            method, _, st = field.rpartition(u':')
+            progress.setdefault(method, {u'running': 0, u'done': 0,
+                                         u'failed': 0})[st] = count
+        return progress
+
+    def get_errors(self, start=0, count=None):
+        """
+        Retrieves errors of the batch in the order they occured.
+
+        Args:
+            start (int): Index of the first error to retrieve
+            count (int): Maximum number of errors to retrieve. All remaining
+                         errors are retrieved if None.
 
         Returns:
             list: A list of tuples containing keyword arguments to the task, a
             dictionary containing debug tracking information (i.e. variables
             which are given to the tasks as keyword arguments but aren't
             arguments to the underlying function), and the exception message of
-            the failure.
+            the failure. None if there are no errors or the batch is unknown.
         """
-        batch = celery.app.backend.get(self.id)
-        try:
-            batch = json.loads(batch)
-        except:
+        if celery.app.backend.get(self.id) is None:
             return None
-        if len(batch['errors']) > 0:
-            return batch['errors']
-
+        stop = -1 if count is None else start + count - 1
+        errors = tasks.helper.get_records(tasks.helper.errors_key(self.id),
+                                          start, stop)
+        if len(errors) > 0:
+            return [json.loads(error) for error in errors]
         return None
 
     def get_results(self):
@@ -146,26 +253,77 @@ class Batch(object):
         Retrieves the storage tuples of a successful batch or None.
 
         Returns:
-            A list of dictionaries containing the output document name under
-            the key 'doc', the original document it is based upon under the key
-            'root', and all further tracking data that may be added during
-            execution.
+            A list containing the result of each document, i.e. a tracking
+            dictionary containing a list of dictionaries with the output
+            document name under the key 'doc', the original document it is
+            based upon under the key 'root', and all further tracking data
+            that may be added during execution. For batches with more than
+            one step a list containing only the result of the last step is
+            returned.
         """
-        batch = celery.app.backend.get(self.id)
-        try:
-            batch = json.loads(batch)
-        except Exception:
+        header = self._get_header()
+        if header is None or self.get_state() != 'SUCCESS':
             return None
+        if header.get('later_steps'):
+            result = tasks.helper.get_fields(
+                tasks.helper.documents_key(self.id), [u'result'])[0]
+            return [json.loads(result)]
+        return self._get_document_fields(range(header['documents']),
+                                         u'result')
+
+    def iter_results(self, interval=0.5, max_interval=10.0):
+        """
+        Yields the results of the documents of the batch as soon as their
+        processing has finished successfully, in order of completion.
 
-        if self.get_state() != 'SUCCESS':
-            return None
+        The states of all unfinished documents are polled with a single
+        backend request. The polling interval is doubled up to max_interval
+        while no document finishes and reset to interval otherwise. Failed
+        documents are skipped; their errors can be retrieved using
+        get_errors().
+
+        Args:
+            interval (float): Initial polling interval in seconds
+            max_interval (float): Maximum polling interval in seconds
 
-        outfiles = []
-        for id in batch['task_ids']:
-            ch = AsyncResult(id)
-            if ch.successful():
-                outfiles.append(ch.result)
-        return outfiles
+        Yields:
+            The result of a document as returned by get_results(). For
+            batches with more than one step the result of the last step is
+            yielded after all documents have been processed successfully.
+        """
+        header = self._get_header()
+        if header is None:
+            return
+        pending = range(header['documents'])
+        failed = False
+        delay = interval
+        while pending:
+            states = self._get_document_fields(pending, u'state')
+            finished = [idx for idx, st in zip(pending, states) if st ==
+                        u'SUCCESS']
+            for result in self._get_document_fields(finished, u'result'):
+                yield result
+            running = [idx for idx, st in zip(pending, states) if st not in
+                       (u'SUCCESS', u'FAILURE')]
+            if len(running) < len(pending):
+                delay = interval
+            if running:
+                time.sleep(delay)
+                delay = min(delay * 2, max_interval)
+            failed = failed or len(finished) + len(running) < len(pending)
+            pending = running
+        if failed or not header.get('later_steps'):
+            return
+        key = tasks.helper.documents_key(self.id)
+        delay = interval
+        while True:
+            st, result = tasks.helper.get_fields(key, [u'state', u'result'])
+            if st is not None:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, max_interval)
+        if json.loads(st) == u'SUCCESS':
+            yield json.loads(result)
 
     def add_document(self, doc):
         """Add a document to the batch.
@@ -236,55 +394,415 @@ class Batch(object):
             self.batch_def.append(self.cur_step)
         self.cur_step = []
 
-    def run(self):
+    def compile(self, fuse=False, force=False):
+        """Compiles the current batch definition into a pipeline.
+
+        The pipeline can be run repeatedly for different batch identifiers
+        and documents without validating the definition and building the task
+        signatures again.
+
+        Args:
+            fuse (bool): See run().
+            force (bool): See run().
+
+        Returns:
+            Pipeline: The compiled batch definition.
+        """
+        # flush most recent tick/step onto the batch definition
+        self.add_tick()
+        self.add_step()
+        return Pipeline(self.batch_def, fuse, force)
+
+    def run(self, fuse=False, force=False, chunk_size=CHUNK_SIZE, threads=1,
+            docs=None, count=None):
         """Executes the current batch definition.
 
         Expands the current batch definition to a series of celery chords and
         executes them asynchronously. Additionally a batch record is written to
         the celery result backend.
 
+        The expanded sequences of each step are merged into a prefix tree, so
+        each distinct task (with identical arguments operating on the same
+        input) is executed only once and its output is fanned out to all
+        following tasks. Image outputs read by later tasks are written in the
+        configured intermediate format, final outputs keep their format.
+
+        Args:
+            fuse (bool): Collapses linear runs of consecutive image processing
+                         tasks into a single pipeline task keeping
+                         intermediate images in memory. Intermediate results
+                         of fused tasks are not written to the storage
+                         medium.
+            force (bool): Executes all tasks even if their results are in the
+                          task result cache (see nidaba.tasks.helper).
+            chunk_size (int): Number of documents submitted over a single
+                              broker connection.
+            threads (int): Number of threads submitting chunks of documents
+                           in parallel.
+            docs (iterable): Input documents to use instead of the ones
+                             added with add_document(). They are not checked
+                             for existence. An iterator yielding documents as
+                             they become available, e.g. while they are
+                             copied to the storage medium, is consumed
+                             while submitting; its number of documents has to
+                             be given as count.
+            count (int): Number of documents of docs.
+
         Returns:
             (unicode): Batch identifier.
         """
-        # flush most recent tick/step onto the batch definition
-        self.add_tick()
-        self.add_step()
+        return self.compile(fuse, force).run(self.id, docs if docs is not
+                                             None else self.docs, chunk_size,
+                                             threads, count)
+
+
+class Pipeline(object):
+
+    """
+    A compiled batch definition.
+
+    Compilation validates the definition, resolves its tasks, and builds the
+    celery signatures of the batch once into a template. Running the pipeline
+    for a batch only fills in the batch identifier and the input documents,
+    so the same pipeline can be submitted repeatedly at little cost.
+    Pipelines are created using Batch.compile().
+    """
+
+    def __init__(self, batch_def, fuse=False, force=False):
+        """
+        Compiles a batch definition.
+
+        Args:
+            batch_def (list): A list of steps, each a list of ticks containing
+                              task keyword argument dictionaries (see
+                              Batch.add_task).
+            fuse (bool): See Batch.run().
+            force (bool): See Batch.run().
 
+        Raises:
+            NidabaStepException: The batch definition is empty.
+            NidabaNoSuchAlgorithmException: Invalid method given.
+        """
+        if not batch_def or not all(batch_def):
+            raise NidabaStepException('Empty batch definition.')
+        # the batch identifier is filled in when the pipeline is run
+        steps = []
+        for step in batch_def:
+            ticks = []
+            for tick in step:
+                for kwargs in tick:
+                    if u'nidaba.' + kwargs[u'method'] not in celery.app.tasks:
+                        raise NidabaNoSuchAlgorithmException('No such task '
+                                                             'in registry')
+                ticks.append([dict(kwargs, id=None) for kwargs in tick])
+            steps.append(ticks)
+
+        extra = {u'force': True} if force else {}
+        # The later steps run once per batch after all documents have passed
+        # the first step. Each is joined by a util.collect task passing on
+        # only the storage tuples of its outputs.
         groups = []
-        tick = []
-        # We first expand the tasks starting from the second step as these are
-        # the same for each input document.
-        if len(self.batch_def) > 1:
-            groups.append(tasks.util.sync.s())
-            for tset in self.batch_def[1:]:
-                for sequence in product(*tset):
-                    method = celery.app.tasks[
-                        'nidaba.' + sequence[0]['method']]
-                    ch = chain(method.s(**(sequence[0])))
-                    for seq in sequence[1:]:
-                        method = celery.app.tasks['nidaba.' + seq['method']]
-                        ch |= method.s(**seq)
-                    tick.append(ch)
-                groups.append(group(tick))
-                groups.append(tasks.util.sync.s())
-
-        # The expansion steps described above is redone for each input document
-        rets = []
-        for doc in self.docs:
-            tick = []
-            # the first step is handled differently as the input document has
-            # to be added explicitely.
-            for sequence in product([doc], *self.batch_def[0]):
-                method = celery.app.tasks['nidaba.' + sequence[1]['method']]
-                ch = chain(method.s(doc=sequence[0], root=sequence[0],
-                                    **(sequence[1])))
-                for seq in sequence[2:]:
-                    method = celery.app.tasks['nidaba.' + seq['method']]
-                    ch |= method.s(**seq)
-                tick.append(ch)
-            rets.append(
-                chain([group(tick)] + [tasks.util.sync.s()] +
-                      groups[:-1]).apply_async().id)
-        celery.app.backend.set(
-            self.id, json.dumps({'errors': [], 'task_ids': rets}))
-        return self.id
+        for idx, tset in enumerate(steps[1:], 2):
+            trie = _build_trie(product(*tset), fuse)
+            consumed = idx < len(steps)
+            groups.append(group(_level_signatures(trie, consumed, **extra)))
+            groups.append(tasks.util.collect.s())
+        self._steps = None
+        if groups:
+            groups.append(tasks.util.finish.s(id=None))
+            self._steps = _plain(chain(groups))
+
+        # The prefix tree of the first step is the same for all documents. The
+        # input document is passed as a tracking dictionary argument to its
+        # roots.
+        trie = _build_trie(product(*steps[0]), fuse)
+        consumed = len(steps) > 1
+        tick = _level_signatures(trie, consumed, **extra)
+        self._template = _plain(chain(group(tick), tasks.util.sync.s()))
+
+    def run(self, id, docs, chunk_size=CHUNK_SIZE, threads=1, count=None):
+        """
+        Executes the pipeline for a batch and writes its batch record to the
+        celery result backend. Documents are not checked for existence.
+
+        Args:
+            id (unicode): The batch identifier
+            docs (iterable): Input storage tuples (see Batch.run())
+            chunk_size (int): See Batch.run().
+            threads (int): See Batch.run().
+            count (int): Number of documents, required if docs is an
+                         iterator.
+
+        Returns:
+            (unicode): Batch identifier.
+        """
+        if count is None:
+            docs = list(docs)
+            count = len(docs)
+        # The header and the later steps have to be written before
+        # submission as the last document to finish starts the later steps.
+        if self._steps is not None:
+            tasks.helper.set_fields(tasks.helper.documents_key(id), {
+                u'steps': json.dumps(_instantiate(self._steps, id))})
+        celery.app.backend.set(id, json.dumps({'documents': count,
+                                               'later_steps': self._steps is
+                                               not None}))
+        template = _instantiate(self._template, id)
+        submitted = []
+
+        def record(docs):
+            for doc in docs:
+                submitted.append(doc)
+                yield doc
+
+        rets = _submit(template, record(docs), id, count if self._steps is
+                       not None else None, chunk_size, threads)
+        entries = {}
+        for idx, (doc, task_id) in enumerate(zip(submitted, rets)):
+            entries[u'{}:doc'.format(idx)] = json.dumps(doc)
+            entries[u'{}:task_id'.format(idx)] = json.dumps(task_id)
+        tasks.helper.set_fields(tasks.helper.documents_key(id), entries)
+        return id
+
+
+def _plain(sig):
+    """
+    Converts a (nested) signature into plain dictionaries and lists. Celery
+    mutates signatures when applying them, so a template is kept as a plain
+    structure and copied using this function for each application.
+    """
+    if isinstance(sig, dict):
+        return {k: _plain(v) for k, v in dict.items(sig)}
+    if isinstance(sig, (list, tuple)):
+        return [_plain(v) for v in sig]
+    return sig
+
+
+def _instantiate(template, id):
+    """
+    Copies a plain signature template filling in the batch identifier of all
+    task signatures.
+    """
+    if isinstance(template, dict):
+        sig = {k: _instantiate(v, id) for k, v in template.iteritems()}
+        if 'task' in sig and u'id' in sig.get('kwargs', {}):
+            sig['kwargs'][u'id'] = id
+        return sig
+    if isinstance(template, list):
+        return [_instantiate(v, id) for v in template]
+    return template
+
+
+def _submit(template, docs, batch_id, count=None, chunk_size=CHUNK_SIZE,
+            threads=1):
+    """
+    Applies a chain signature template to a list of documents. The results
+    of each document are recorded by a ``util.finish`` task appended to its
+    chain. Documents are published in chunks, each chunk using a single
+    producer (and broker connection).
+
+    Args:
+        template (dict): A plain chain signature template (see _plain)
+        docs (iterable): Input storage tuples. Chunks are published as soon
+                         as they are complete.
+        batch_id (unicode): The batch identifier
+        count (int): Number of documents after which the util.finish task
+                     starts the later steps of the batch. None for batches
+                     without later steps.
+        chunk_size (int): Number of documents published per producer
+        threads (int): Number of threads publishing chunks in parallel
+
+    Returns:
+        list: The task IDs of the documents.
+    """
+    def apply(idx, doc, **options):
+        sig = _plain(template)
+        sig['kwargs']['tasks'].append(tasks.util.finish.s(id=batch_id,
+                                                          index=idx,
+                                                          count=count))
+        sig = signature(sig, app=celery.app)
+        # the index is passed on as tracking data to mark the document as
+        # failed if any of its tasks fails (see NidabaTask)
+        return sig.apply_async(({u'doc': doc, u'root': doc,
+                                 u'doc_index': idx},),
+                               link_error=tasks.util.fail.s(id=batch_id,
+                                                            index=idx),
+                               **options).id
+
+    def publish(chunk):
+        # eagerly executed tasks are not published
+        if celery.app.conf.CELERY_ALWAYS_EAGER:
+            return [apply(idx, doc) for idx, doc in chunk]
+        with celery.app.producer_or_acquire() as producer:
+            return [apply(idx, doc, producer=producer) for idx, doc in
+                    chunk]
+
+    def chunks():
+        docs_iter = enumerate(docs)
+        while True:
+            chunk = list(islice(docs_iter, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            # chunks are read in this thread so errors of the document
+            # iterator propagate to the caller.
+            ids = [r.get() for r in [pool.apply_async(publish, (chunk,)) for
+                                     chunk in chunks()]]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        ids = map(publish, chunks())
+    return [id for chunk in ids for id in chunk]
+
+
+def _build_trie(sequences, fuse=False):
+    """
+    Merges expanded sequences into a prefix tree.
+
+    Args:
+        sequences (iterable): Sequences of task keyword argument dictionaries
+        fuse (bool): Collapses linear runs of fusable tasks, i.e. runs where
+                     each task except the last has exactly one child, into
+                     ``img.pipeline`` tasks.
+
+    Returns:
+        OrderedDict: A mapping of a unique key of each root task to a tuple
+                     (kwargs, children) with children being the mapping of
+                     the following tasks.
+    """
+    trie = OrderedDict()
+    for sequence in sequences:
+        level = trie
+        for kwargs in sequence:
+            key = json.dumps(kwargs, sort_keys=True)
+            if key not in level:
+                level[key] = (kwargs, OrderedDict())
+            level = level[key][1]
+    if fuse:
+        _fuse_trie(trie)
+    return trie
+
+
+def _fuse_trie(level):
+    """
+    Collapses linear runs of fusable tasks in a prefix tree in place.
+    """
+    for key, (kwargs, children) in level.items():
+        run = [kwargs]
+        while (run[-1]['method'] in tasks.img.fusable and len(children) == 1
+               and children.values()[0][0]['method'] in tasks.img.fusable):
+            ckwargs, children = children.values()[0]
+            run.append(ckwargs)
+        level[key] = (_fuse_sequence(run)[0], children)
+        _fuse_trie(children)
+
+
+def _trie_signature(kwargs, children, consumed=False, **extra):
+    """
+    Creates the celery signature for a node of the prefix tree. Nodes with a
+    single child are chained to it, nodes with multiple children are chained to
+    a group of them whose (possibly nested) outputs are flattened into a single
+    list.
+
+    Tasks supporting it are instructed to write their output in the
+    intermediate format if it is read by a later task.
+
+    Args:
+        kwargs (dict): Keyword arguments of the task of the node
+        children (OrderedDict): Children of the node
+        consumed (bool): The outputs of the leaves of the subtree are read by
+                         the following step.
+        **extra: Additional keyword arguments to the task
+
+    Returns:
+        celery.canvas.Signature: The signature of the subtree
+    """
+    method = celery.app.tasks['nidaba.' + kwargs['method']]
+    kwargs = dict(kwargs)
+    kwargs.update(extra)
+    if children or consumed:
+        if 'intermediate' in getargspec(method.run).args:
+            kwargs['intermediate'] = True
+    sig = method.s(**kwargs)
+    subs = _level_signatures(children, consumed)
+    if not subs:
+        return sig
+    elif len(subs) == 1:
+        return chain(sig, subs[0])
+    return chain(sig, group(subs), tasks.util.gather.s())
+
+
+def _level_signatures(level, consumed=False, **extra):
+    """
+    Creates the celery signatures for all nodes of a level of the prefix tree.
+    Multiple nlbin tasks operating on the same input are merged into a single
+    ``binarize.nlbin_sweep`` task sharing the background estimation. Each of
+    its outputs is passed on to the subtree of the respective nlbin task by a
+    ``util.pick`` task.
+
+    Args:
+        level (OrderedDict): The nodes of the level
+        consumed (bool): The outputs of the leaves of the subtrees are read by
+                         the following step.
+        **extra: Additional keyword arguments to the tasks of the level
+
+    Returns:
+        list: A list of celery signatures
+    """
+    nodes = level.values()
+    sweep = [n for n in nodes if n[0]['method'] == u'binarize.nlbin']
+    if len(sweep) < 2:
+        return [_trie_signature(k, c, consumed, **extra) for k, c in nodes]
+    sigs = [_trie_signature(k, c, consumed, **extra) for k, c in nodes if
+            k['method'] != u'binarize.nlbin']
+    variants = []
+    picks = []
+    for idx, (kwargs, children) in enumerate(sweep):
+        variant = {k: v for k, v in kwargs.iteritems() if k != u'id'}
+        if children or consumed:
+            variant[u'intermediate'] = True
+        variants.append(variant)
+        picks.append(_trie_signature({u'method': u'util.pick',
+                                      u'id': kwargs[u'id'], u'index': idx},
+                                     children, consumed))
+    kwargs = dict(extra)
+    kwargs.update({u'method': u'binarize.nlbin_sweep',
+                   u'id': sweep[0][0][u'id'], u'variants': variants})
+    sigs.append(chain(tasks.binarize.nlbin_sweep.s(**kwargs), group(picks),
+                      tasks.util.gather.s()))
+    return sigs
+
+
+def _fuse_sequence(sequence):
+    """
+    Collapses runs of two or more consecutive fusable tasks (see
+    nidaba.tasks.img.fusable) of an expanded sequence into single
+    ``img.pipeline`` tasks.
+
+    Args:
+        sequence (iterable): A sequence of task keyword argument dictionaries
+
+    Returns:
+        list: A list of task keyword argument dictionaries
+    """
+    fused = []
+    run = []
+    for kwargs in list(sequence) + [None]:
+        if kwargs is not None and kwargs['method'] in tasks.img.fusable:
+            run.append(kwargs)
+            continue
+        if len(run) > 1:
+            fused.append({u'method': u'img.pipeline', u'id': run[0]['id'],
+                          u'steps': [{k: v for k, v in t.iteritems() if k !=
+                                      u'id'} for t in run]})
+        else:
+            fused.extend(run)
+        run = []
+        if kwargs is not None:
+            fused.append(kwargs)
+    return fused
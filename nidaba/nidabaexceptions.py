@@ -88,3 +88,17 @@ class NidabaNoSuchStorageBin(Exception):
     def __init__(self, status_code):
         self.status_code = status_code
         Exception.__init__(self, status_code)
+
+
+class NidabaLockTimeoutException(Exception):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        Exception.__init__(self, status_code)
+
+
+class NidabaConfigException(Exception):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        Exception.__init__(self, status_code)
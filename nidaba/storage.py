@@ -1,16 +1,51 @@
 # -*- coding: utf-8 -*-
 # This module contains all file handling/storage management/ID mapping methods
+#
+# Files are stored by a storage backend selected by the storage_backend
+# configuration key. The filesystem backend keeps them in job directories on a
+# shared file system beneath storage_path. The objectstore backend keeps them
+# as content-addressed blobs in an object store and materializes them beneath
+# the (worker-local) storage_path on access; see ObjectStoreBackend.
 
 from __future__ import absolute_import
 
-from nidaba.lock import lock
+from nidaba.lock import rwlock
 from nidaba.config import nidaba_cfg
 from nidaba.nidabaexceptions import (NidabaStorageViolationException,
                                      NidabaNoSuchStorageBin)
 
 import os
+import stat
+import fcntl
+import json
+import zlib
+import mmap
+import time
+import shutil
+import numpy as np
+import errno
+import binascii
 import fnmatch
+import hashlib
 import re
+import threading
+import mimetypes
+
+from collections import OrderedDict
+
+# Extensions of the intermediate image formats (see
+# nidaba.image.intermediate_formats)
+intermediate_extensions = (u'.pnm',)
+
+# Suffix of temporary files created by _atomic_write
+tmp_suffix = u'.nidaba-tmp'
+
+# Directory of the manifest beneath each job directory
+manifest_dir = u'.manifest'
+
+# Directory beneath each local job directory of the object store backend
+# recording the versions of materialized files
+materialized_dir = u'.materialized'
 
 
 def _sanitize_path(base_path, *paths):
@@ -46,6 +81,992 @@ def _sanitize_path(base_path, *paths):
         raise NidabaStorageViolationException('Path not beneath STORAGE_PATH')
 
 
+# memoized absolute paths of storage_path values
+_roots = {}
+
+
+def _storage_root():
+    """
+    Returns the absolute path of the configured storage_path.
+    """
+    raw = nidaba_cfg['storage_path']
+    try:
+        return _roots[raw]
+    except KeyError:
+        _roots[raw] = os.path.abspath(os.path.expanduser(raw))
+        return _roots[raw]
+
+
+def _is_plain(path):
+    """
+    Checks if a relative path is in normal form, i.e. it consists only of
+    non-empty segments other than '.' and '..'. Joining such a path to a
+    directory with a slash yields the same path as os.path.abspath() which
+    is beneath the directory.
+    """
+    if not path or u'\x00' in path:
+        return False
+    for segment in path.split(u'/'):
+        if not segment or segment in (u'.', u'..'):
+            return False
+    return True
+
+
+def _job_path(jobID):
+    """
+    Returns the absolute path of a job directory.
+
+    Raises:
+        NidabaStorageViolationException: The job directory is not beneath the
+                                         storage_path.
+    """
+    root = _storage_root()
+    if _is_plain(jobID) and u'/' not in jobID:
+        return root.rstrip(u'/') + u'/' + jobID
+    return _sanitize_path(root, jobID)
+
+
+def _resolve(jobID, *path):
+    """
+    Returns the absolute path of a storage tuple (see get_abs_path). Paths in
+    normal form are concatenated without touching the file system or
+    normalizing them again; others are sanitized by _sanitize_path.
+    """
+    if len(path) < 1:
+        raise NidabaStorageViolationException('Path not beneath STORAGE_PATH')
+    if all(_is_plain(p) for p in path):
+        job_path = _job_path(jobID)
+        if job_path != _storage_root():
+            return u'/'.join((job_path,) + path)
+    # Run twice to ensure resulting path is beneath jobID.
+    return _sanitize_path(_sanitize_path(_storage_root(), jobID), *path)
+
+
+def _tmp_path(path):
+    """
+    Returns a unique temporary file name in the directory of path.
+    """
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, u'.{}.{}.{}.{}{}'.format(
+        basename, os.uname()[1], os.getpid(),
+        binascii.hexlify(os.urandom(4)), tmp_suffix))
+
+
+def _atomic_copy(src, path):
+    """
+    Copies a file including its modification time to path by copying it to a
+    temporary file in the destination directory and renaming that.
+    """
+    tmp = _tmp_path(path)
+    try:
+        shutil.copy2(src, tmp)
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        raise
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def _staging_path(shared, cfg):
+    """
+    Returns the path in the staging cache of an absolute path beneath the
+    storage_path.
+    """
+    root = _storage_root().rstrip(u'/')
+    return os.path.abspath(os.path.expanduser(cfg['path'])).rstrip(u'/') + \
+        shared[len(root):]
+
+
+def _is_fresh(staged, shared):
+    """
+    Checks if two stat results are of the same version of a file, i.e. have
+    the same size and modification time.
+    """
+    return staged.st_size == shared.st_size and \
+        abs(staged.st_mtime - shared.st_mtime) < 0.001
+
+
+class _staging_index(object):
+    """
+    An in-process index of the files in a staging cache ordered from least
+    to most recently used. It is built by walking the staging directory once
+    and updated as files are staged afterwards. Files staged by other
+    processes sharing the directory are added when this process uses them,
+    so the size limit is only approximately maintained in that case.
+    """
+    def __init__(self, staging_root):
+        self.root = staging_root.rstrip(u'/')
+        self.files = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+        files = []
+        for root, dirs, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(tmp_suffix):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_atime, path, st.st_size))
+        for atime, path, size in sorted(files):
+            self.files[path] = size
+            self.size += size
+
+    def touch(self, path, size):
+        """
+        Adds a file or marks it as most recently used.
+        """
+        with self._lock:
+            self.size += size - self.files.pop(path, 0)
+            self.files[path] = size
+
+    def evict(self, max_size, keep=None):
+        """
+        Removes the least recently used files except keep until the size of
+        the cache is below max_size bytes. Files differing from their copy on
+        the storage medium are kept.
+        """
+        kept = []
+        with self._lock:
+            while self.size > max_size and self.files:
+                path, size = self.files.popitem(last=False)
+                self.size -= size
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed by another process
+                    continue
+                if path == keep:
+                    kept.append((path, st.st_size))
+                    continue
+                # outputs of tasks which haven't been persisted yet are kept
+                shared = _storage_root().rstrip(u'/') + path[len(self.root):]
+                try:
+                    if not _is_fresh(st, os.stat(shared)):
+                        raise OSError(errno.ESTALE, 'Not persisted')
+                except OSError:
+                    kept.append((path, st.st_size))
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            for path, size in kept:
+                self.files[path] = size
+                self.size += size
+
+
+# staging cache indices by staging directory
+_staging_indices = {}
+_staging_indices_lock = threading.Lock()
+
+
+def _get_staging_index(cfg):
+    staging_root = os.path.abspath(os.path.expanduser(cfg['path']))
+    try:
+        return _staging_indices[staging_root]
+    except KeyError:
+        with _staging_indices_lock:
+            if staging_root not in _staging_indices:
+                _staging_indices[staging_root] = _staging_index(staging_root)
+            return _staging_indices[staging_root]
+
+
+def _touch(path, size, cfg, evict=True):
+    """
+    Records the use of a file in the staging cache and evicts the least
+    recently used files except it if the cache exceeds max_size bytes.
+    """
+    if cfg.get('max_size') is None:
+        return
+    index = _get_staging_index(cfg)
+    index.touch(path, size)
+    if evict and index.size > cfg['max_size']:
+        index.evict(cfg['max_size'], path)
+
+
+def _atomic_write(path, data):
+    """
+    Writes data to a file by writing a unique temporary file in the same
+    directory and renaming it to path. Readers therefore see either the
+    previous or the new content, never a partially written file. The
+    temporary file is fsynced before renaming if the storage_fsync
+    configuration key is set.
+
+    Args:
+        path (unicode): Absolute path of the destination file
+        data (str): Data to write
+
+    Raises:
+        OSError, IOError: The temporary file could not be written or renamed.
+    """
+    tmp = _tmp_path(path)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+            if nidaba_cfg.get('storage_fsync'):
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        raise
+
+
+def _compression(dest):
+    """
+    Returns the compression configuration if a document is designated for
+    compression, None otherwise.
+    """
+    cfg = nidaba_cfg.get('compression')
+    if cfg and any(fnmatch.fnmatch(os.path.basename(dest), pattern) for
+                   pattern in cfg.get('patterns', [])):
+        return cfg
+    return None
+
+
+def _compress(data, cfg):
+    """
+    Compresses data with the codec (gzip or zlib) of a compression
+    configuration.
+    """
+    # window bits of 31 write a gzip header and trailer
+    wbits = 31 if cfg.get('codec', u'gzip') == u'gzip' else 15
+    c = zlib.compressobj(cfg.get('level', 6), zlib.DEFLATED, wbits)
+    return c.compress(data) + c.flush()
+
+
+def _is_compressed(head):
+    """
+    Checks if data starts with a gzip or zlib header.
+    """
+    if head[:2] == b'\x1f\x8b':
+        return True
+    return len(head) > 1 and head[0] == b'\x78' and \
+        (ord(head[0]) * 256 + ord(head[1])) % 31 == 0
+
+
+def _compress_file(path, cfg):
+    """
+    Compresses a file in place unless it is already compressed. Nonexistent
+    files are ignored.
+    """
+    try:
+        with open(path, 'rb') as fp:
+            if _is_compressed(fp.read(2)):
+                return
+            fp.seek(0)
+            data = fp.read()
+    except IOError:
+        return
+    _atomic_write(path, _compress(data, cfg))
+
+
+def _decompress(data):
+    """
+    Decompresses gzip or zlib compressed data. Data which isn't compressed is
+    returned unaltered.
+    """
+    if not _is_compressed(data[:2]):
+        return data
+    try:
+        # window bits of 47 detect the gzip or zlib header automatically
+        return zlib.decompress(data, 47)
+    except zlib.error:
+        # plain data starting with a valid zlib header by chance
+        return data
+
+
+class _decompressing_reader(object):
+    """
+    A read-only file object decompressing a gzip or zlib compressed file on
+    the fly.
+    """
+    def __init__(self, fp, chunk_size):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._d = zlib.decompressobj(47)
+        self._buf = b''
+        self._eof = False
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            chunk = self._fp.read(self._chunk_size)
+            if not chunk:
+                self._buf += self._d.flush()
+                self._eof = True
+            else:
+                self._buf += self._d.decompress(chunk)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FilesystemBackend(object):
+    """
+    Stores files in job directories on a (shared) file system beneath
+    storage_path. Job directories are assumed to not be removed while the
+    process is running.
+
+    Each job directory contains a manifest of its files in the .manifest
+    subdirectory which serves list_content() without walking the job
+    directory. Every process appends entries (JSON objects with the keys
+    path, size, task, and time, one per line) for the files it writes
+    through write_content() or persist() to a segment file of its own, so
+    appends never contend across machines. Later entries of a path supersede
+    earlier ones. Jobs without a manifest, e.g. created by an earlier
+    version, get one built from the directory contents on their first
+    listing.
+    """
+
+    def __init__(self):
+        # (storage root, job ID) pairs of existing job directories
+        self._valid_jobs = set()
+        # (storage root, job ID) pairs of jobs with a manifest
+        self._indexed_jobs = set()
+
+    def _segment(self, jobID):
+        """
+        Returns the path of the manifest segment of this process.
+        """
+        return _resolve(jobID, manifest_dir, u'{}.{}.json'.format(
+            os.uname()[1], os.getpid()))
+
+    def _has_manifest(self, jobID):
+        key = (_storage_root(), jobID)
+        if key in self._indexed_jobs:
+            return True
+        if os.path.isdir(_resolve(jobID, manifest_dir)):
+            self._indexed_jobs.add(key)
+            return True
+        return False
+
+    def _record(self, jobID, entries):
+        """
+        Appends entries to the manifest segment of this process.
+        """
+        if not entries or not self._has_manifest(jobID):
+            return
+        lines = b''.join(json.dumps(entry).encode('utf-8') + b'\n' for
+                         entry in entries)
+        with open(self._segment(jobID), 'ab') as fp:
+            fp.write(lines)
+
+    def _entry(self, jobID, path, task=None):
+        st = os.stat(_resolve(jobID, path))
+        return {u'path': path, u'size': st.st_size, u'task': task,
+                u'time': st.st_mtime}
+
+    def _build_manifest(self, jobID):
+        """
+        Creates the manifest of a job from the contents of its directory.
+        Files written concurrently are recorded by their writers as the
+        manifest directory is created before the job directory is read.
+        """
+        try:
+            os.mkdir(_resolve(jobID, manifest_dir))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._indexed_jobs.add((_storage_root(), jobID))
+        jpath = _job_path(jobID)
+        entries = []
+        for root, dirs, files in os.walk(jpath):
+            if root == jpath and manifest_dir in dirs:
+                dirs.remove(manifest_dir)
+            for f in files:
+                if f.endswith(tmp_suffix):
+                    continue
+                path = os.path.relpath(os.path.join(root, f), jpath)
+                try:
+                    entries.append(self._entry(jobID, path))
+                except OSError:
+                    pass
+        self._record(jobID, entries)
+
+    def get_manifest(self, jobID):
+        if not self.is_valid_job(jobID):
+            return None
+        if not self._has_manifest(jobID):
+            self._build_manifest(jobID)
+        manifest = {}
+        mpath = _resolve(jobID, manifest_dir)
+        for segment in os.listdir(mpath):
+            if not segment.endswith(u'.json'):
+                continue
+            with open(os.path.join(mpath, segment), 'rb') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partially written by a concurrent append
+                        continue
+                    prev = manifest.get(entry[u'path'])
+                    if prev is None or prev[u'time'] <= entry[u'time']:
+                        manifest[entry[u'path']] = entry
+        return manifest
+
+    def _stage(self, shared, cfg):
+        """
+        Returns the path of a file in the staging cache, copying it from the
+        storage medium if the cached copy is missing or outdated. Paths of
+        nonexistent files are returned as is to be written by tasks and
+        persisted later.
+        """
+        staged = _staging_path(shared, cfg)
+        try:
+            st = os.stat(shared)
+        except OSError:
+            _makedirs(os.path.dirname(staged))
+            return staged
+        if stat.S_ISDIR(st.st_mode):
+            _makedirs(staged)
+            return staged
+        try:
+            sst = os.stat(staged)
+            if _is_fresh(sst, st):
+                # marks the copy as recently used for eviction; the access
+                # time orders the files when the index is built again.
+                os.utime(staged, (time.time(), sst.st_mtime))
+                _touch(staged, sst.st_size, cfg, False)
+                return staged
+        except OSError:
+            _makedirs(os.path.dirname(staged))
+        _atomic_copy(shared, staged)
+        os.utime(staged, (time.time(), st.st_mtime))
+        _touch(staged, st.st_size, cfg)
+        return staged
+
+    def get_abs_path(self, jobID, *path):
+        shared = _resolve(jobID, *path)
+        cfg = nidaba_cfg.get('staging')
+        if cfg:
+            return self._stage(shared, cfg)
+        return shared
+
+    def get_storage_path(self, path):
+        cfg = nidaba_cfg.get('staging')
+        if cfg:
+            staging_root = os.path.abspath(os.path.expanduser(
+                cfg['path'])).rstrip(u'/') + u'/'
+            if path.startswith(staging_root):
+                path = _storage_root().rstrip(u'/') + u'/' + \
+                    path[len(staging_root):]
+        root = _storage_root().rstrip(u'/') + u'/'
+        if path.startswith(root):
+            id, sep, rest = path[len(root):].partition(u'/')
+            if sep and _is_plain(id) and _is_plain(rest) and \
+               self.is_valid_job(id):
+                return (id, rest)
+        base_path = _sanitize_path(nidaba_cfg['storage_path'], u'')
+        if os.path.commonprefix([os.path.normpath(base_path),
+                                 os.path.normpath(path)]) != base_path:
+            raise NidabaStorageViolationException('Path not beneath '
+                                                  'STORAGE_PATH')
+        path = path.replace(base_path, u'', 1)
+        m = re.match('^(?P<id>.+?)\/(?P<p>.+)', path)
+        id = os.path.split(m.groupdict()['id'])[1]
+        if self.is_valid_job(id):
+            return (id, m.groups()[1])
+        else:
+            raise NidabaNoSuchStorageBin('ID ' + m.groupdict()['id'] + ' not\
+                                         known.')
+
+    def is_valid_job(self, jobID):
+        key = (_storage_root(), jobID)
+        if key in self._valid_jobs:
+            return True
+        if os.path.isdir(_job_path(jobID)):
+            self._valid_jobs.add(key)
+            return True
+        return False
+
+    def is_file(self, jobID, path):
+        return os.path.isfile(_resolve(jobID, path))
+
+    def prepare_filestore(self, jobID):
+        if self.is_valid_job(jobID):
+            return None
+        try:
+            os.mkdir(_job_path(jobID))
+            os.mkdir(_resolve(jobID, manifest_dir))
+            self._valid_jobs.add((_storage_root(), jobID))
+            self._indexed_jobs.add((_storage_root(), jobID))
+            return jobID
+        except Exception:
+            return None
+
+    def list_content(self, jobID, pattern=u'*'):
+        if not self.is_valid_job(jobID):
+            return None
+        return fnmatch.filter(self.get_manifest(jobID).keys(), pattern)
+
+    def retrieve_content(self, jobID, documents=None):
+        if not self.is_valid_job(jobID):
+            return None
+        if documents:
+            if isinstance(documents, basestring):
+                documents = [documents]
+            fdict = {}
+            # files are replaced atomically by write_content so locks are only
+            # required for consistent reads of multiple documents or files
+            # modified in place by other means.
+            locks = []
+            try:
+                if nidaba_cfg.get('storage_locking'):
+                    for doc in sorted(set(documents)):
+                        locks.append(rwlock(_resolve(jobID, doc),
+                                            shared=True).__enter__())
+                for doc in documents:
+                    with open(self.get_abs_path(jobID, doc), 'rb') as f:
+                        fdict[doc] = f.read()
+            finally:
+                map(lambda x: x.release(), locks)
+            return fdict
+
+    def write_content(self, jobID, dest, data):
+        if not self.is_valid_job(jobID):
+            return None
+        if not isinstance(data, basestring):
+            return None
+        try:
+            path = _resolve(jobID, dest)
+            if nidaba_cfg.get('storage_locking'):
+                with rwlock(path):
+                    _atomic_write(path, data)
+            else:
+                _atomic_write(path, data)
+            self._record(jobID, [self._entry(jobID, dest)])
+        except:
+            return None
+        cfg = nidaba_cfg.get('staging')
+        if cfg:
+            try:
+                staged = _staging_path(path, cfg)
+                _makedirs(os.path.dirname(staged))
+                _atomic_write(staged, data)
+                os.utime(staged, (time.time(), os.stat(path).st_mtime))
+                _touch(staged, len(data), cfg)
+            except (OSError, IOError):
+                pass
+        return len(data)
+
+    def retrieve_buffer(self, jobID, documents=None):
+        if not self.is_valid_job(jobID):
+            return None
+        if documents:
+            if isinstance(documents, basestring):
+                documents = [documents]
+            fdict = {}
+            locks = []
+            try:
+                if nidaba_cfg.get('storage_locking'):
+                    for doc in sorted(set(documents)):
+                        locks.append(rwlock(_resolve(jobID, doc),
+                                            shared=True).__enter__())
+                for doc in documents:
+                    # get_abs_path() materializes files of remote backends
+                    with open(self.get_abs_path(jobID, doc), 'rb') as f:
+                        if os.fstat(f.fileno()).st_size == 0:
+                            fdict[doc] = memoryview(b'')
+                            continue
+                        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    # python 2's mmap objects only implement the old buffer
+                    # protocol; numpy arrays export the new one.
+                    fdict[doc] = memoryview(np.frombuffer(mm, dtype=np.uint8))
+            finally:
+                map(lambda x: x.release(), locks)
+            return fdict
+
+    def open_stream(self, jobID, document, chunk_size=None):
+        if not self.is_valid_job(jobID):
+            return None
+        if chunk_size is None:
+            chunk_size = nidaba_cfg.get('storage_chunk_size', 65536)
+        return open(self.get_abs_path(jobID, document), 'rb', chunk_size)
+
+    def persist(self, jobID, path, task=None):
+        cfg = nidaba_cfg.get('staging')
+        if cfg:
+            # writes outputs of tasks through to the storage medium
+            shared = _resolve(jobID, path)
+            staged = _staging_path(shared, cfg)
+            try:
+                sst = os.stat(staged)
+            except OSError:
+                sst = None
+            if sst:
+                try:
+                    fresh = _is_fresh(sst, os.stat(shared))
+                except OSError:
+                    fresh = False
+                if not fresh:
+                    _makedirs(os.path.dirname(shared))
+                    _atomic_copy(staged, shared)
+                _touch(staged, sst.st_size, cfg)
+        try:
+            self._record(jobID, [self._entry(jobID, path, task)])
+        except OSError:
+            pass
+
+    def link_content(self, jobID, path, dest_jobID, dest, task=None):
+        src = _resolve(jobID, path)
+        dst = _resolve(dest_jobID, dest)
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise
+            _atomic_copy(src, dst)
+        self._record(dest_jobID, [self._entry(dest_jobID, dest, task)])
+
+    def get_digest(self, jobID, path):
+        return None
+
+
+class LocalObjectStore(object):
+    """
+    An object store keeping each object in a file beneath a local (or
+    network) directory.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+    def _path(self, key):
+        return _sanitize_path(self.path, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as fp:
+                return fp.read()
+        except IOError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        _atomic_write(path, data)
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def list(self, prefix):
+        base = self._path(prefix)
+        keys = []
+        for root, dirs, files in os.walk(base):
+            keys.extend(prefix + os.path.relpath(os.path.join(root, f), base)
+                        for f in files if not f.endswith(tmp_suffix))
+        return keys
+
+
+class MemoryObjectStore(object):
+    """
+    An in-process object store with the semantics of S3-like services. Used
+    for testing.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self.objects.get(key)
+
+    def put(self, key, data):
+        with self._lock:
+            self.objects[key] = bytes(data)
+
+    def exists(self, key):
+        with self._lock:
+            return key in self.objects
+
+    def list(self, prefix):
+        with self._lock:
+            return [k for k in self.objects if k.startswith(prefix)]
+
+
+class ObjectStoreBackend(FilesystemBackend):
+    """
+    Stores files as content-addressed blobs in an object store. The blob of a
+    file is kept under the key objects/<sha1 of content>, the mapping of a
+    storage tuple to its blob under refs/<job>/<path>, and a marker of each
+    job under jobs/<job>. Refs are JSON objects with the keys digest, size,
+    task, and time which make up the manifest of the job.
+
+    Tasks operate on local paths beneath storage_path which acts as a
+    worker-local working directory: get_abs_path() materializes the blob of
+    an existing file there and persist() uploads a file written by a task.
+    NidabaTask persists the outputs of all tasks. The digest, size, and
+    modification time of each materialized or persisted file are recorded
+    beneath the .materialized directory of the local job directory, so
+    copies of documents replaced in the meantime are materialized again
+    while files written locally and not persisted yet are kept.
+    """
+
+    def __init__(self, store):
+        super(ObjectStoreBackend, self).__init__()
+        self.store = store
+
+    def _rel(self, jobID, path):
+        """
+        Validates a path and normalizes it relative to the job.
+        """
+        abs_path = _resolve(jobID, path)
+        if not _is_plain(path):
+            path = os.path.relpath(abs_path, _job_path(jobID))
+        return path
+
+    def _ref(self, jobID, path):
+        return u'refs/{}/{}'.format(jobID, self._rel(jobID, path))
+
+    def _get_ref(self, jobID, path):
+        """
+        Returns the ref of a storage tuple as a dictionary or None.
+        """
+        ref = self.store.get(self._ref(jobID, path))
+        if ref is None:
+            return None
+        try:
+            return json.loads(ref)
+        except ValueError:
+            # refs containing only the digest
+            return {u'digest': ref.decode('ascii'), u'size': None,
+                    u'task': None, u'time': None}
+
+    def _put_ref(self, jobID, path, data, task=None):
+        """
+        Stores data as a blob unless it already exists and points the ref of
+        a storage tuple to it.
+        """
+        digest = unicode(hashlib.sha1(data).hexdigest())
+        if not self.store.exists(u'objects/' + digest):
+            self.store.put(u'objects/' + digest, data)
+        self.store.put(self._ref(jobID, path), json.dumps({
+            u'digest': digest, u'size': len(data), u'task': task,
+            u'time': time.time()}))
+        return digest
+
+    def _job_dir(self, jobID):
+        job_path = _job_path(jobID)
+        if not os.path.isdir(job_path):
+            try:
+                os.makedirs(job_path)
+            except OSError:
+                pass
+        return job_path
+
+    def _get_mark(self, jobID, path):
+        """
+        Returns the version record of a local file or None.
+        """
+        try:
+            with open(_resolve(jobID, materialized_dir, path), 'rb') as fp:
+                return json.loads(fp.read())
+        except (IOError, ValueError):
+            return None
+
+    def _set_mark(self, jobID, path, digest, abs_path):
+        """
+        Records the digest of the content of a local file along with its
+        size and modification time.
+        """
+        st = os.stat(abs_path)
+        mark = _resolve(jobID, materialized_dir, path)
+        _makedirs(os.path.dirname(mark))
+        _atomic_write(mark, json.dumps({u'digest': digest,
+                                        u'size': st.st_size,
+                                        u'time': st.st_mtime}))
+
+    def get_abs_path(self, jobID, *path):
+        abs_path = _resolve(jobID, *path)
+        if not self.is_valid_job(jobID):
+            return abs_path
+        rel = self._rel(jobID, os.path.join(*path))
+        ref = self._get_ref(jobID, rel)
+        if ref is None:
+            self._job_dir(jobID)
+            return abs_path
+        digest = ref[u'digest']
+        try:
+            st = os.stat(abs_path)
+        except OSError:
+            st = None
+        if st is not None:
+            mark = self._get_mark(jobID, rel)
+            # files without a matching record have been written locally
+            if mark is None or mark[u'size'] != st.st_size or \
+               abs(mark[u'time'] - st.st_mtime) >= 0.001 or \
+               mark[u'digest'] == digest:
+                return abs_path
+        data = self.store.get(u'objects/' + digest)
+        _makedirs(os.path.dirname(abs_path))
+        _atomic_write(abs_path, data)
+        self._set_mark(jobID, rel, digest, abs_path)
+        return abs_path
+
+    def is_valid_job(self, jobID):
+        key = (_storage_root(), jobID)
+        if key in self._valid_jobs:
+            return True
+        _job_path(jobID)
+        if self.store.exists(u'jobs/' + jobID):
+            self._valid_jobs.add(key)
+            return True
+        return False
+
+    def is_file(self, jobID, path):
+        return self.store.exists(self._ref(jobID, path))
+
+    def prepare_filestore(self, jobID):
+        if self.is_valid_job(jobID):
+            return None
+        self.store.put(u'jobs/' + jobID, b'')
+        self._job_dir(jobID)
+        return jobID
+
+    def list_content(self, jobID, pattern=u'*'):
+        if not self.is_valid_job(jobID):
+            return None
+        prefix = u'refs/{}/'.format(jobID)
+        return fnmatch.filter([k[len(prefix):] for k in
+                               self.store.list(prefix)], pattern)
+
+    def get_manifest(self, jobID):
+        if not self.is_valid_job(jobID):
+            return None
+        prefix = u'refs/{}/'.format(jobID)
+        manifest = {}
+        for key in self.store.list(prefix):
+            path = key[len(prefix):]
+            ref = self._get_ref(jobID, path)
+            if ref is None:
+                continue
+            manifest[path] = {u'path': path, u'size': ref[u'size'],
+                              u'task': ref[u'task'], u'time': ref[u'time']}
+        return manifest
+
+    def retrieve_content(self, jobID, documents=None):
+        if not self.is_valid_job(jobID):
+            return None
+        if documents:
+            if isinstance(documents, basestring):
+                documents = [documents]
+            fdict = {}
+            for doc in documents:
+                ref = self._get_ref(jobID, doc)
+                if ref is None:
+                    raise IOError('No such file: {}'.format(doc))
+                fdict[doc] = self.store.get(u'objects/' + ref[u'digest'])
+            return fdict
+
+    def write_content(self, jobID, dest, data):
+        if not self.is_valid_job(jobID):
+            return None
+        if not isinstance(data, basestring):
+            return None
+        self._put_ref(jobID, dest, data)
+        # drop a stale materialized copy
+        abs_path = _resolve(jobID, dest)
+        if os.path.exists(abs_path):
+            os.remove(abs_path)
+        return len(data)
+
+    def persist(self, jobID, path, task=None):
+        abs_path = _resolve(jobID, path)
+        if not os.path.isfile(abs_path):
+            return
+        with open(abs_path, 'rb') as fp:
+            data = fp.read()
+        digest = self._put_ref(jobID, path, data, task)
+        self._set_mark(jobID, self._rel(jobID, path), digest, abs_path)
+
+    def link_content(self, jobID, path, dest_jobID, dest, task=None):
+        ref = self._get_ref(jobID, path)
+        if ref is None:
+            raise IOError(errno.ENOENT, 'No such file: {}'.format(path))
+        self.store.put(self._ref(dest_jobID, dest), json.dumps({
+            u'digest': ref[u'digest'], u'size': ref[u'size'], u'task': task,
+            u'time': time.time()}))
+
+    def get_digest(self, jobID, path):
+        ref = self._get_ref(jobID, path)
+        return ref[u'digest'] if ref else None
+
+
+# storage backend instances by configuration
+_backends = {}
+
+
+def get_backend():
+    """
+    Returns the storage backend selected by the storage_backend configuration
+    key. It is either unset (filesystem), or a dictionary with the key 'type'
+    being 'filesystem' or 'objectstore'. The latter requires the key 'store',
+    either a directory path of a local object store or 'memory' for an
+    in-process object store.
+
+    Returns:
+        FilesystemBackend or ObjectStoreBackend: The storage backend
+    """
+    cfg = nidaba_cfg.get('storage_backend')
+    if not cfg:
+        if None not in _backends:
+            _backends[None] = FilesystemBackend()
+        return _backends[None]
+    key = json.dumps(cfg, sort_keys=True)
+    if key not in _backends:
+        if cfg[u'type'] == u'filesystem':
+            _backends[key] = FilesystemBackend()
+        elif cfg[u'type'] == u'objectstore':
+            if cfg[u'store'] == u'memory':
+                store = MemoryObjectStore()
+            else:
+                store = LocalObjectStore(cfg[u'store'])
+            _backends[key] = ObjectStoreBackend(store)
+        else:
+            raise NidabaStorageViolationException('Unknown storage backend '
+                                                  '{}'.format(cfg[u'type']))
+    return _backends[key]
+
+
 def is_file(jobID, path):
     """
     Checks if a storage tuple is a regular file.
@@ -61,7 +1082,7 @@ def is_file(jobID, path):
         Exception: Who the fuck knows. The python standard library doesn't
                    document such paltry information as exceptions.
     """
-    return os.path.isfile(get_abs_path(jobID, path))
+    return get_backend().is_file(jobID, path)
 
 
 def get_abs_path(jobID, *path):
@@ -69,7 +1090,9 @@ def get_abs_path(jobID, *path):
     Returns the absolute path of a file.
 
     Takes a job ID and a sequence of path components and checks if their
-    absolute path is in the directory of that particular job ID.
+    absolute path is in the directory of that particular job ID. Backends
+    without a shared file system materialize existing files at the returned
+    path.
 
     Args:
         jobID (unicode): A unique job ID
@@ -85,11 +1108,7 @@ def get_abs_path(jobID, *path):
                                          nidaba configuration or not in its job
                                          directory.
     """
-    if len(path) < 1:
-        raise NidabaStorageViolationException('Path not beneath STORAGE_PATH')
-    # Run twice to ensure resulting path is beneath jobID.
-    return _sanitize_path(_sanitize_path(nidaba_cfg['storage_path'], jobID),
-                          *path)
+    return get_backend().get_abs_path(jobID, *path)
 
 
 def get_storage_path(path):
@@ -107,25 +1126,158 @@ def get_storage_path(path):
                                          into a storage tuple.
         NidabaNoSuchStorageBin: The given path is not beneath a valid job ID.
     """
-    base_path = _sanitize_path(nidaba_cfg['storage_path'], u'')
-    if os.path.commonprefix([os.path.normpath(base_path),
-                             os.path.normpath(path)]) != base_path:
-        raise NidabaStorageViolationException('Path not beneath STORAGE_PATH')
-    path = path.replace(base_path, u'', 1)
-    m = re.match('^(?P<id>.+?)\/(?P<p>.+)', path)
-    id = os.path.split(m.groupdict()['id'])[1]
-    if is_valid_job(id):
-        return (id, m.groups()[1])
-    else:
-        raise NidabaNoSuchStorageBin('ID ' + m.groupdict()['id'] + ' not\
-                                     known.')
+    return get_backend().get_storage_path(path)
+
+
+def persist(jobID, path, task=None):
+    """
+    Stores a file written to the absolute path of a storage tuple (see
+    get_abs_path) by means other than write_content() in the storage backend.
+    The filesystem backend records it in the manifest of the job. Files
+    designated for compression (see write_content()) are compressed first.
+    Nonexistent files are ignored.
+
+    Args:
+        jobID (unicode): Identifier of the bin
+        path (unicode): A path of a file beneath jobID
+        task (unicode): Name of the task which produced the file
+    """
+    cfg = _compression(path)
+    if cfg:
+        _compress_file(get_abs_path(jobID, path), cfg)
+    get_backend().persist(jobID, path, task)
+
+
+def link_content(jobID, path, dest_jobID, dest, task=None):
+    """
+    Makes the content of a document available under another storage tuple,
+    possibly of another job, without copying it where possible. The
+    filesystem backend creates a hard link (or copies the file if that
+    fails), the object store backend points a new ref to the same blob.
+
+    Args:
+        jobID (unicode): Identifier of the bin of the source document
+        path (unicode): Path of the source document beneath jobID
+        dest_jobID (unicode): Identifier of the bin of the destination
+        dest (unicode): Path of the destination beneath dest_jobID
+        task (unicode): Name of the task which produced the document
+
+    Raises:
+        OSError, IOError: The source document doesn't exist or the
+                          destination could not be written.
+    """
+    get_backend().link_content(jobID, path, dest_jobID, dest, task)
+
+
+def get_digest(jobID, path):
+    """
+    Returns the SHA1 digest of the content of a document if it is known to
+    the storage backend without reading the document, i.e. for the object
+    store backend.
+
+    Args:
+        jobID (unicode): Identifier of the bin
+        path (unicode): Path of the document beneath jobID
+
+    Returns:
+        unicode: The hex digest or None.
+    """
+    return get_backend().get_digest(jobID, path)
+
+
+# ioctl request cloning a file on Linux (FICLONE)
+_ficlone = 0x40049409
+
+
+def _reflink(src, path):
+    """
+    Creates a copy-on-write clone of a file (btrfs, XFS, ...).
+    """
+    with open(src, 'rb') as fsrc:
+        with open(path, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _ficlone, fsrc.fileno())
+            except (IOError, OSError):
+                fdst.close()
+                os.unlink(path)
+                raise
+    shutil.copystat(src, path)
+
+
+def _copy(src, path, buffer_size):
+    """
+    Copies a file with a large buffer, renaming it into place.
+    """
+    tmp = _tmp_path(path)
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(tmp, 'wb') as fdst:
+                shutil.copyfileobj(fsrc, fdst, buffer_size)
+        shutil.copystat(src, tmp)
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        raise
+
+
+def ingest(src, jobID, dest, mode=u'auto', buffer_size=4194304):
+    """
+    Adds a file outside the storage medium to a job.
+
+    Args:
+        src (unicode): Path of the file to add
+        jobID (unicode): Identifier of the bin
+        dest (unicode): Path of the document beneath jobID
+        mode (unicode): One of reflink (copy-on-write clone), link (hard
+                        link), copy, or auto which tries reflink and then
+                        copy. Hard links share the file with its source, so
+                        the source must not be modified in place afterwards;
+                        they are only used if explicitly selected.
+        buffer_size (int): Buffer size in bytes used for copying.
+
+    Returns:
+        (unicode): The method used to add the file.
+
+    Raises:
+        OSError, IOError: The file could not be added using the method(s)
+                          selected.
+    """
+    path = get_abs_path(jobID, dest)
+    methods = [u'reflink', u'copy'] if mode == u'auto' else [mode]
+    for method in methods:
+        try:
+            if method == u'reflink':
+                _reflink(src, path)
+            elif method == u'link':
+                os.link(src, path)
+            elif method == u'copy':
+                _copy(src, path, buffer_size)
+            else:
+                raise ValueError('Unknown ingestion mode {}'.format(method))
+            break
+        except (OSError, IOError):
+            if method == methods[-1]:
+                raise
+    persist(jobID, dest)
+    return method
 
 
 def insert_suffix(orig_path, *suffix):
     """
-    Inserts one or more suffixes just before the file extension.
+    Inserts one or more suffixes just before the file extension. The extension
+    of an intermediate format appended to the extension of an image (see
+    nidaba.image.intermediate_path) is removed.
     """
     pathname, extension = os.path.splitext(orig_path)
+    if extension in intermediate_extensions:
+        stem, inner = os.path.splitext(pathname)
+        mime = mimetypes.guess_type(u'a' + inner.lower(), strict=False)[0]
+        if mime and mime.startswith(u'image/'):
+            pathname, extension = stem, inner
     for i in suffix:
         pathname += u'_' + i
     return pathname + extension
@@ -144,7 +1296,7 @@ def is_valid_job(jobID):
     Raises:
         Standard python library caveats apply.
     """
-    return os.path.isdir(_sanitize_path(nidaba_cfg['storage_path'], jobID))
+    return get_backend().is_valid_job(jobID)
 
 
 def prepare_filestore(jobID):
@@ -158,19 +1310,34 @@ def prepare_filestore(jobID):
         None: Failure
         (unicode): String containing the job ID
     """
-    if is_valid_job(jobID):
-        return None
-    try:
-        jobPath = _sanitize_path(nidaba_cfg['storage_path'], jobID)
-        os.mkdir(jobPath)
-        return jobID
-    except Exception:
-        return None
+    return get_backend().prepare_filestore(jobID)
+
+
+def get_manifest(jobID):
+    """
+    Returns the manifest of a job, i.e. information on all files written
+    through write_content() or persist(). The filesystem backend builds it
+    from the contents of the job directory if it doesn't exist yet; the
+    object store backend from the refs of the job. Size and time of refs
+    written by earlier versions are None.
+
+    Args:
+        jobID (unicode): Identifier of the bin
+
+    Returns:
+        None: Failure
+        Dictionary: A dictionary mapping file names to dictionaries with the
+                    keys path, size, task (the producing task or None), and
+                    time (modification time).
+    """
+    return get_backend().get_manifest(jobID)
 
 
 def list_content(jobID, pattern=u'*'):
     """
-    Lists all files to a job ID, optionally applying a glob-like filter.
+    Lists all files to a job ID, optionally applying a glob-like filter. The
+    filesystem backend lists the files in the manifest of the job (see
+    get_manifest()).
 
     Args:
         jobID (unicode): Identifier of the bin
@@ -179,14 +1346,7 @@ def list_content(jobID, pattern=u'*'):
     Returns:
         list: A list of unicode strings of the matching files.
     """
-    if not is_valid_job(jobID):
-        return None
-    flist = []
-    jpath = _sanitize_path(nidaba_cfg['storage_path'], jobID)
-    for root, dirs, files in os.walk(jpath):
-        flist.extend([os.path.relpath(os.path.join(root, s), jpath)
-                      for s in files])
-    return fnmatch.filter(flist, pattern)
+    return get_backend().list_content(jobID, pattern)
 
 
 def retrieve_content(jobID, documents=None):
@@ -202,20 +1362,67 @@ def retrieve_content(jobID, documents=None):
         None: Failure
         Dictionary: A dictionary mapping file identifiers to their contents.
     """
-    if not is_valid_job(jobID):
-        return None
-    if documents:
-        if isinstance(documents, basestring):
-            documents = [documents]
-        fdict = {}
-        dpath = _sanitize_path(nidaba_cfg['storage_path'], jobID)
-        locks = [lock(_sanitize_path(dpath, doc)) for doc in documents]
-        map(lambda x: x.acquire(), locks)
-        for doc in documents:
-            with open(_sanitize_path(dpath, doc), 'rb') as f:
-                fdict[doc] = f.read()
-        map(lambda x: x.release(), locks)
-        return fdict
+    res = get_backend().retrieve_content(jobID, documents)
+    if res and nidaba_cfg.get('compression'):
+        res = {k: _decompress(v) if _compression(k) else v for k, v in
+               res.iteritems()}
+    return res
+
+
+def retrieve_buffer(jobID, documents=None):
+    """
+    Retrieves read-only buffers of a single or a list of documents without
+    reading them into memory. The buffers are memory-mapped views of the
+    files; as write_content() replaces files instead of modifying them they
+    keep their content until they are garbage collected.
+
+    Buffers can be used without copying by numpy.asarray() and
+    PIL.Image.frombuffer(). Use open_stream() for parsers requiring file
+    objects such as lxml. Compressed documents (see write_content()) are
+    decompressed into memory.
+
+    Args:
+        jobID (unicode): Identifier of the bin
+        documents (tuple or list of tuples): Documents to map
+
+    Returns:
+        None: Failure
+        Dictionary: A dictionary mapping file identifiers to memoryviews of
+                    their contents.
+    """
+    res = get_backend().retrieve_buffer(jobID, documents)
+    if res and nidaba_cfg.get('compression'):
+        for k, v in res.iteritems():
+            if _compression(k) and _is_compressed(v[:2].tobytes()):
+                res[k] = memoryview(_decompress(v.tobytes()))
+    return res
+
+
+def open_stream(jobID, document, chunk_size=None):
+    """
+    Opens a document for reading in chunks.
+
+    Args:
+        jobID (unicode): Identifier of the bin
+        document (unicode): Document to open
+        chunk_size (int): Size of the read buffer in bytes. Defaults to the
+                          storage_chunk_size configuration key or 64KiB.
+
+    Returns:
+        None: Failure
+        file: A file object opened in binary mode. Compressed documents (see
+              write_content()) are decompressed while reading. It has to be
+              closed by the caller.
+    """
+    fp = get_backend().open_stream(jobID, document, chunk_size)
+    if fp and _compression(document):
+        head = fp.read(2)
+        fp.seek(0)
+        if _is_compressed(head):
+            if chunk_size is None:
+                chunk_size = nidaba_cfg.get('storage_chunk_size', 65536)
+            return _decompressing_reader(fp, chunk_size)
+    return fp
 
 
 def retrieve_text(jobID, documents=None):
@@ -234,37 +1441,38 @@ def retrieve_text(jobID, documents=None):
     return {t: res[t].decode('utf-8') for t in res}
 
 
-def write_content(jobID, dest, data):
+def write_content(jobID, dest, data, compress=True):
     """
     Writes data to a document at a destination beneath a jobID. Writes bytes,
-    does not accept unicode objects; use write_text() for that.
+    does not accept unicode objects; use write_text() for that. Existing
+    documents are replaced atomically.
+
+    Documents matching the patterns of the compression configuration key are
+    compressed with its codec, as are task outputs persisted by persist().
+    retrieve_content(), retrieve_text(), retrieve_buffer(), and open_stream()
+    decompress them transparently; other readers have to handle compressed
+    content themselves (lxml does so for gzip).
 
     Args:
         jobID (unicode): Identifier of the bin.
         dest (tuple): Documents to write to.
         data (str): Data to write.
+        compress (bool): Set to False to store a document designated for
+                         compression uncompressed, e.g. one which is
+                         memory-mapped by its readers.
 
     Returns:
         int: Length of data written
         None: Failure
     """
-    if not is_valid_job(jobID):
-        return None
-    if not isinstance(data, basestring):
-        return None
-    try:
-        with open(_sanitize_path(nidaba_cfg['storage_path'],
-                                 os.path.join(jobID, dest)), 'wb') as f:
-            l = lock(f.name)
-            l.acquire()
-            f.write(data)
-            l.release()
-    except:
-        return None
-    return len(data)
+    cfg = _compression(dest)
+    if compress and cfg and isinstance(data, basestring):
+        ret = get_backend().write_content(jobID, dest, _compress(data, cfg))
+        return len(data) if ret is not None else None
+    return get_backend().write_content(jobID, dest, data)
 
 
-def write_text(jobID, dest, text):
+def write_text(jobID, dest, text, compress=True):
     """
     Writes text data encoded as UTF-8 to a file beneath a jobID.
 
@@ -272,8 +1480,10 @@ def write_text(jobID, dest, text):
         jobID (unicode): Identifier of the bin.
         dest (tuple): Documents to write to.
         text (unicode): Data to write.
+        compress (bool): Set to False to store a document designated for
+                         compression uncompressed (see write_content()).
 
     Returns:
         int: Length of data written
     """
-    return write_content(jobID, dest, text.encode('utf-8'))
+    return write_content(jobID, dest, text.encode('utf-8'), compress)
@@ -19,9 +19,70 @@ from nidaba.tasks.helper import NidabaTask
 
 import re
 
+
+def _nlbin_path(input_path, method, threshold=0.5, zoom=0.5, escale=1.0,
+                border=0.1, perc=80, range=20, low=5, high=90):
+    """
+    Validates a set of nlbin parameters and calculates the output path for
+    them.
+
+    Raises:
+        NidabaInvalidParameterException: Input parameters are outside the valid
+                                         range.
+    """
+    if not (1 <= perc <= 100 and 1 <= low <= 100 and 1 <= high <= 100):
+        raise NidabaInvalidParameterException('Parameters (' + unicode(perc) +
+                                              ',' + unicode(low) + ',' +
+                                              unicode(high) + ',' +
+                                              'outside of valid range')
+    return storage.insert_suffix(input_path, method, unicode(threshold),
+                                 unicode(zoom), unicode(escale),
+                                 unicode(border), unicode(perc),
+                                 unicode(range), unicode(low), unicode(high))
+
+
+def _otsu_path(input_path, method, thresh=100, mincount=50, bgval=255,
+               smoothx=2, smoothy=2):
+    """
+    Validates a set of otsu parameters and calculates the output path for
+    them.
+
+    Raises:
+        NidabaInvalidParameterException: Input parameters are outside the valid
+                                         range.
+    """
+    if smoothx < 0 or smoothy < 0 or bgval < 0 or thresh < 0 or mincount < 0:
+        raise NidabaInvalidParameterException('Parameters (' + unicode(thresh)
+                                              + ',' + unicode(mincount) + ',' +
+                                              unicode(bgval) + ',' +
+                                              unicode(smoothx) + ',' +
+                                              unicode(smoothy) + ',' +
+                                              ') outside of valid range')
+    return storage.insert_suffix(input_path, method, unicode(thresh),
+                                 unicode(mincount), unicode(bgval),
+                                 unicode(smoothx), unicode(smoothy))
+
+
+def _sauvola_path(input_path, method, whsize=10, factor=0.35):
+    """
+    Validates a set of sauvola parameters and calculates the output path for
+    them.
+
+    Raises:
+        NidabaInvalidParameterException: Input parameters are outside the valid
+                                         range.
+    """
+    if whsize < 2 or factor >= 1.0 or factor < 0:
+        raise NidabaInvalidParameterException('Parameters (' + unicode(whsize)
+                                              + ',' + unicode(factor) +
+                                              ') outside of valid range')
+    return storage.insert_suffix(input_path, method, unicode(whsize),
+                                 re.sub(ur'[^0-9]', u'', unicode(factor)))
+
+
 @app.task(base=NidabaTask, name=u'nidaba.binarize.nlbin')
 def nlbin(doc, method=u'nlbin', threshold=0.5, zoom=0.5, escale=1.0,
-          border=0.1, perc=80, range=20, low=5, high=90):
+          border=0.1, perc=80, range=20, low=5, high=90, intermediate=False):
     """
     Binarizes an input document utilizing ocropus'/kraken's nlbin algorithm.
 
@@ -37,6 +98,8 @@ def nlbin(doc, method=u'nlbin', threshold=0.5, zoom=0.5, escale=1.0,
         range (int):
         low (int):
         high (int):
+        intermediate (bool): Writes the output in the configured intermediate
+                             format as it is only read by later tasks.
 
     Returns:
         (unicode, unicode): Storage tuple of the output file
@@ -47,24 +110,61 @@ def nlbin(doc, method=u'nlbin', threshold=0.5, zoom=0.5, escale=1.0,
 
     """
     input_path = storage.get_abs_path(*doc)
-    output_path = storage.insert_suffix(input_path, method, unicode(threshold),
-                                        unicode(zoom), unicode(escale),
-                                        unicode(border), unicode(perc),
-                                        unicode(range), unicode(low),
-                                        unicode(high))
-    if (1 > perc > 100) or (1 > low > 100) or (1 > high > 100):
-        raise NidabaInvalidParameterException('Parameters (' + unicode(perc) +
-                                              ',' + unicode(low) + ',' +
-                                              unicode(high) + ',' +
-                                              'outside of valid range')
+    output_path = _nlbin_path(input_path, method, threshold, zoom, escale,
+                              border, perc, range, low, high)
+    if intermediate:
+        output_path = image.intermediate_path(output_path)
     return storage.get_storage_path(kraken.nlbin(input_path, output_path,
                                                  threshold, zoom, escale,
                                                  border, perc, range, low,
                                                  high))
 
+
+@app.task(base=NidabaTask, name=u'nidaba.binarize.nlbin_sweep')
+def nlbin_sweep(doc, method=u'nlbin', variants=None, intermediate=False):
+    """
+    Binarizes an input document with multiple parameter sets of the nlbin
+    algorithm. The background estimation is shared between all variants with
+    the same zoom, perc, and range parameters. Output files are named
+    identically to the ones of the nlbin task. Batches run multiple nlbin
+    tasks on the same input through this task.
+
+    Args:
+        doc (unicode, unicode): The input document tuple.
+        id (unicode): The nidaba batch identifier this task is a part of
+        method (unicode): The suffix string appended to all output files.
+        variants (list): A list of dictionaries containing arguments to the
+                         nlbin task (method, threshold, zoom, escale, border,
+                         perc, range, low, high, intermediate). The method
+                         and intermediate arguments of the sweep are used
+                         for variants not defining them.
+        intermediate (bool): Writes the outputs in the configured intermediate
+                             format as they are only read by later tasks.
+
+    Returns:
+        [(unicode, unicode), ...]: Storage tuples of the output files in the
+                                   order of the variants.
+
+    Raises:
+        NidabaInvalidParameterException: Input parameters are outside the valid
+                                         range.
+    """
+    input_path = storage.get_abs_path(*doc)
+    outputs = []
+    for v in variants:
+        v = dict(v)
+        inter = v.pop('intermediate', intermediate)
+        output_path = _nlbin_path(input_path, v.pop('method', method), **v)
+        if inter:
+            output_path = image.intermediate_path(output_path)
+        outputs.append((output_path, v))
+    return [storage.get_storage_path(path) for path in
+            kraken.nlbin_sweep(input_path, outputs)]
+
+
 @app.task(base=NidabaTask, name=u'nidaba.binarize.otsu')
 def otsu(doc, method=u'otsu', thresh=100, mincount=50, bgval=255,
-         smoothx=2, smoothy=2):
+         smoothx=2, smoothy=2, intermediate=False):
     """
     Binarizes an input document utilizing a naive implementation of Otsu's
     thresholding.
@@ -73,6 +173,8 @@ def otsu(doc, method=u'otsu', thresh=100, mincount=50, bgval=255,
         doc (unicode, unicode): The input document tuple.
         id (unicode): The nidaba batch identifier this task is a part of
         method (unicode): The suffix string appended to all output files.
+        intermediate (bool): Writes the output in the configured intermediate
+                             format as it is only read by later tasks.
 
     Returns:
         (unicode, unicode): Storage tuple of the output file
@@ -83,16 +185,10 @@ def otsu(doc, method=u'otsu', thresh=100, mincount=50, bgval=255,
 
     """
     input_path = storage.get_abs_path(*doc)
-    output_path = storage.insert_suffix(input_path, method, unicode(thresh),
-                                        unicode(mincount), unicode(bgval),
-                                        unicode(smoothx), unicode(smoothy))
-    if smoothx < 0 or smoothy < 0 or bgval < 0 or thresh < 0 or mincount < 0:
-        raise NidabaInvalidParameterException('Parameters (' + unicode(thresh)
-                                              + ',' + unicode(mincount) + ',' +
-                                              unicode(bgval) + ',' +
-                                              unicode(smoothx) + ',' +
-                                              unicode(smoothy) + ',' +
-                                              ') outside of valid range')
+    output_path = _otsu_path(input_path, method, thresh, mincount, bgval,
+                             smoothx, smoothy)
+    if intermediate:
+        output_path = image.intermediate_path(output_path)
     return storage.get_storage_path(leper.otsu_binarize(input_path,
                                                         output_path, thresh,
                                                         mincount, bgval,
@@ -100,11 +196,16 @@ def otsu(doc, method=u'otsu', thresh=100, mincount=50, bgval=255,
 
 
 @app.task(base=NidabaTask, name=u'nidaba.binarize.sauvola')
-def sauvola(doc, method=u'sauvola', whsize=10, factor=0.35):
+def sauvola(doc, method=u'sauvola', whsize=10, factor=0.35,
+            intermediate=False):
     """
     Binarizes an input document utilizing Sauvola thresholding as described in
     [0]. Expects 8bpp grayscale images as input.
 
+    Images exceeding the tiling limit of the configuration are binarized by
+    nidaba's tiled implementation instead of leptonica. As its results differ
+    at the image border the suffix 'tiled' is added to its output files.
+
     [0] Sauvola, Jaakko, and Matti Pietikäinen. "Adaptive document image
     binarization." Pattern recognition 33.2 (2000): 225-236.
 
@@ -117,6 +218,8 @@ def sauvola(doc, method=u'sauvola', whsize=10, factor=0.35):
                       value is 2.
         factor (float): The threshold reduction factor due to variance. 0 =<
                         factor < 1.
+        intermediate (bool): Writes the output in the configured intermediate
+                             format as it is only read by later tasks.
 
     Returns:
         (unicode, unicode): Storage tuple of the output file
@@ -126,13 +229,17 @@ def sauvola(doc, method=u'sauvola', whsize=10, factor=0.35):
                                          range.
     """
     input_path = storage.get_abs_path(*doc)
-    if whsize < 2 or factor >= 1.0 or factor < 0:
-        raise NidabaInvalidParameterException('Parameters (' + unicode(whsize)
-                                              + ',' + unicode(factor) +
-                                              ') outside of valid range')
-    output_path = storage.insert_suffix(input_path, method, unicode(whsize),
-                                        re.sub(ur'[^0-9]', u'',
-                                               unicode(factor)))
+    output_path = _sauvola_path(input_path, method, whsize, factor)
+    # leptonica requires the whole image in memory; very large ones are
+    # binarized in tiles instead.
+    tiled = image.tile_size(input_path)
+    if tiled:
+        output_path = storage.insert_suffix(output_path, u'tiled')
+    if intermediate:
+        output_path = image.intermediate_path(output_path)
+    if tiled:
+        return storage.get_storage_path(image.sauvola(input_path, output_path,
+                                                      whsize, factor))
     return storage.get_storage_path(leper.sauvola_binarize(input_path,
                                                            output_path, whsize,
                                                            factor))
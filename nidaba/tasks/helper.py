@@ -10,10 +10,38 @@ logging of errors.
 from __future__ import absolute_import
 
 from celery import Task
+from celery.backends.redis import RedisBackend
 from inspect import getcallargs, getargspec
 from nidaba.celery import app
+from nidaba.config import nidaba_cfg
+from nidaba.nidabaexceptions import NidabaConfigException
+from nidaba import storage
 
+import os
 import json
+import time
+import hashlib
+import threading
+
+# key of the hash of the task result cache in the result backend. It maps
+# cache keys to JSON arrays of the return value of the task and the time it
+# was stored. The sorted set under cache_key + '-age' contains the cache keys
+# scored by that time.
+cache_key = u'nidaba-cache'
+
+# key of the hash of the digests of input documents of cached tasks. It maps
+# jobID/path to JSON arrays of the size, modification time, and SHA1 digest
+# of the document. Entries are evicted like cache entries.
+digests_key = u'nidaba-cache-digests'
+
+# process-local stand-in for redis hashes, lists, sets, and sorted sets if
+# tasks are executed eagerly
+_local_hashes = {}
+_local_lists = {}
+_local_sets = {}
+_local_zsets = {}
+_local_lock = threading.Lock()
+
 
 class NidabaTask(Task):
 
@@ -22,6 +50,25 @@ class NidabaTask(Task):
     execution chain. This means that no task should accept arbitrary (**kwargs)
     arguments as they won't be forwarded to the actual function and will be
     retained through the whole chain.
+
+    Tasks may add tracking data by returning a dictionary containing the
+    output document under the key 'doc' and any additional tracking values.
+
+    If the ``cache`` configuration key is set, results of tasks operating on a
+    single input document and creating a single output document are
+    memoized. A task whose name, arguments, and input file content match a
+    previous execution is not run again; the earlier output is linked into the
+    job directory of the input document instead. The tracking value 'force'
+    disables lookups for a batch.
+
+    The number of running, finished, and failed tasks of each method of a
+    batch are counted in the result backend (see progress_key). Errors are
+    appended to a list in the result backend (see errors_key) and the
+    document of the batch given by the tracking value 'doc_index' is marked
+    as failed (see fail_document), as are the later steps of a batch if the
+    tracking value 'later_steps' is set. Error callbacks of chains are not
+    called for tasks inside the groups of a chain, so this is the only
+    reliable place to record the failure.
     """
     abstract = True
     acks_late = True
@@ -42,13 +89,552 @@ class NidabaTask(Task):
                 nkwargs[k] = v
             else:
                 tracking_kwargs[k] = v
+        batch_id = tracking_kwargs.get('id')
+        method = nkwargs.get('method', self.name)
+        key = None
+        if nidaba_cfg.get('cache'):
+            callargs = dict(zip(fspec.args, args), **nkwargs)
+            key = _cache_key(self.name, callargs)
+        if key and not tracking_kwargs.get('force'):
+            ret = _cache_lookup(key, callargs['doc'])
+            if ret is not None:
+                if isinstance(ret, dict):
+                    tracking_kwargs.update(ret)
+                else:
+                    tracking_kwargs['doc'] = ret
+                _count(batch_id, method, u'done')
+                _persist(ret, self.name)
+                return tracking_kwargs
+        _count(batch_id, method, u'running')
         try:
             ret = super(NidabaTask, self).__call__(*args, **nkwargs)
         except Exception as e:
+            _count(batch_id, method, u'failed', u'running')
             # write error to backend and reraise exception
-            batch_struct = json.loads(app.backend.get(tracking_kwargs['id']))
-            batch_struct['errors'].append((nkwargs, tracking_kwargs, e.message))
-            app.backend.set(tracking_kwargs['id'], json.dumps(batch_struct))
+            append_records(errors_key(tracking_kwargs['id']),
+                           [json.dumps((nkwargs, tracking_kwargs, e.message))])
+            if tracking_kwargs.get('doc_index') is not None:
+                fail_document(batch_id, tracking_kwargs['doc_index'])
+            elif tracking_kwargs.get('later_steps'):
+                set_fields(documents_key(batch_id),
+                           {u'state': json.dumps(u'FAILURE')})
             raise
-        tracking_kwargs['doc'] = ret
+        _count(batch_id, method, u'done', u'running')
+        _persist(ret, self.name)
+        if key:
+            _cache_store(key, ret)
+        if isinstance(ret, dict):
+            tracking_kwargs.update(ret)
+        else:
+            tracking_kwargs['doc'] = ret
         return tracking_kwargs
+
+
+def _redis_client():
+    """
+    Returns the redis client of the result backend or None if tasks are
+    executed eagerly. Records, counters, and the task result cache are then
+    kept in the current process.
+
+    Raises:
+        NidabaConfigException: The result backend is not redis.
+    """
+    if app.conf.CELERY_ALWAYS_EAGER:
+        return None
+    if not isinstance(app.backend, RedisBackend):
+        raise NidabaConfigException('The result backend has to be redis '
+                                    '(CELERY_RESULT_BACKEND)')
+    return app.backend.client
+
+
+def incr_counters(key, amounts):
+    """
+    Atomically adds to integer fields of a hash in the result backend.
+
+    Args:
+        key (unicode): Key of the hash
+        amounts (dict): Mapping of field names to the amount added
+
+    Returns:
+        dict: A mapping of the field names to their new values.
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            counters = _local_hashes.setdefault(key, {})
+            for field, amount in amounts.iteritems():
+                counters[field] = counters.get(field, 0) + amount
+            return {field: counters[field] for field in amounts}
+    fields = amounts.keys()
+    pipe = client.pipeline()
+    for field in fields:
+        pipe.hincrby(key, field, amounts[field])
+    return dict(zip(fields, pipe.execute()))
+
+
+def get_counters(key):
+    """
+    Retrieves all fields of a hash of counters from the result backend with a
+    single request.
+
+    Args:
+        key (unicode): Key of the hash
+
+    Returns:
+        dict: A mapping of field names to integers.
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            return dict(_local_hashes.get(key, {}))
+    return {k.decode('utf-8'): int(v) for k, v in
+            client.hgetall(key).iteritems()}
+
+
+def set_fields(key, mapping):
+    """
+    Sets fields of a hash in the result backend using a single HMSET.
+
+    Args:
+        key (unicode): Key of the hash
+        mapping (dict): Mapping of field names to strings
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            _local_hashes.setdefault(key, {}).update(mapping)
+        return
+    client.hmset(key, mapping)
+
+
+def get_fields(key, fields):
+    """
+    Retrieves fields of a hash in the result backend using a single HMGET.
+
+    Args:
+        key (unicode): Key of the hash
+        fields (list): A list of field names
+
+    Returns:
+        list: The values of the fields in the order of fields. Missing fields
+              are None.
+    """
+    if not fields:
+        return []
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            values = _local_hashes.get(key, {})
+            return [values.get(field) for field in fields]
+    return client.hmget(key, fields)
+
+
+def set_field_if_missing(key, field, value):
+    """
+    Sets a field of a hash in the result backend unless it exists using a
+    single HSETNX.
+
+    Args:
+        key (unicode): Key of the hash
+        field (unicode): Field name
+        value (unicode): Value of the field
+
+    Returns:
+        bool: True if the field has been set, False if it existed.
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            values = _local_hashes.setdefault(key, {})
+            if field in values:
+                return False
+            values[field] = value
+            return True
+    return bool(client.hsetnx(key, field, value))
+
+
+def delete_fields(key, fields):
+    """
+    Deletes fields of a hash in the result backend using a single HDEL.
+
+    Args:
+        key (unicode): Key of the hash
+        fields (list): A list of field names
+    """
+    if not fields:
+        return
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            values = _local_hashes.get(key, {})
+            for field in fields:
+                values.pop(field, None)
+        return
+    client.hdel(key, *fields)
+
+
+def add_scored(key, mapping):
+    """
+    Adds members to a sorted set in the result backend using a single ZADD.
+    Scores of existing members are updated.
+
+    Args:
+        key (unicode): Key of the sorted set
+        mapping (dict): Mapping of members to their scores
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            _local_zsets.setdefault(key, {}).update(mapping)
+        return
+    args = []
+    for member, score in mapping.iteritems():
+        args.extend((score, member))
+    # the argument order of zadd() differs between redis-py's client classes
+    client.execute_command('ZADD', key, *args)
+
+
+def pop_scored(key, max_score=None, max_count=None):
+    """
+    Removes the members of a sorted set in the result backend with a score
+    of at most max_score and the lowest-scored members exceeding max_count.
+
+    Args:
+        key (unicode): Key of the sorted set
+        max_score (float): Maximum score of the retained members or None
+        max_count (int): Maximum number of retained members or None
+
+    Returns:
+        list: The removed members.
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            zset = _local_zsets.get(key, {})
+            members = sorted(zset, key=zset.get)
+            removed = [m for m in members if max_score is not None and
+                       zset[m] <= max_score]
+            members = members[len(removed):]
+            if max_count is not None and len(members) > max_count:
+                removed.extend(members[:len(members) - max_count])
+            for member in removed:
+                del zset[member]
+            return removed
+    removed = []
+    if max_score is not None:
+        removed = client.zrangebyscore(key, '-inf', max_score)
+    if max_count is not None:
+        count = client.zcard(key) - len(removed)
+        if count > max_count:
+            removed.extend(client.zrange(key, len(removed), len(removed) +
+                                         count - max_count - 1))
+    if removed:
+        client.zrem(key, *removed)
+    return removed
+
+
+def add_members(key, members):
+    """
+    Adds members to a set in the result backend and returns the size of the
+    set with a single request.
+
+    Args:
+        key (unicode): Key of the set
+        members (list): A list of strings
+
+    Returns:
+        int: The number of members of the set after adding.
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            values = _local_sets.setdefault(key, set())
+            values.update(members)
+            return len(values)
+    pipe = client.pipeline()
+    pipe.sadd(key, *members)
+    pipe.scard(key)
+    return pipe.execute()[1]
+
+
+def count_members(key):
+    """
+    Returns the size of a set in the result backend.
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            return len(_local_sets.get(key, ()))
+    return client.scard(key)
+
+
+def append_records(key, records):
+    """
+    Appends strings to a list in the result backend using a single RPUSH.
+
+    Args:
+        key (unicode): Key of the list
+        records (list): A list of strings
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            _local_lists.setdefault(key, []).extend(records)
+        return
+    client.rpush(key, *records)
+
+
+def get_records(key, start=0, stop=-1):
+    """
+    Retrieves a slice of a list in the result backend. Like redis' LRANGE
+    both indices are inclusive and may be negative.
+
+    Args:
+        key (unicode): Key of the list
+        start (int): Index of the first element
+        stop (int): Index of the last element
+
+    Returns:
+        list: A list of strings.
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            records = _local_lists.get(key, [])
+            return records[start:stop + 1 if stop != -1 else None]
+    return client.lrange(key, start, stop)
+
+
+def count_records(key):
+    """
+    Returns the length of a list in the result backend.
+    """
+    client = _redis_client()
+    if client is None:
+        with _local_lock:
+            return len(_local_lists.get(key, []))
+    return client.llen(key)
+
+
+def errors_key(batch_id):
+    """
+    Returns the key of the error list of a batch. Each element is a JSON
+    array containing the task arguments, the tracking data, and the error
+    message of a failed task.
+    """
+    return batch_id + u'-errors'
+
+
+def documents_key(batch_id):
+    """
+    Returns the key of the document hash of a batch. For the document with
+    index i it contains the fields i:doc (input document) and i:task_id
+    (celery task ID of its chain) written on submission, i:state and
+    i:result written on completion (i:state also by the first failing task
+    of the document). Batches with more than one step additionally contain
+    the signature template of the later steps under 'steps', their state
+    and result under 'state' and 'result', and the field 'started' once the
+    last document has finished. All values are JSON encoded.
+    """
+    return batch_id + u'-documents'
+
+
+def finished_key(batch_id):
+    """
+    Returns the key of the set of indices of the finished, i.e. successful
+    or failed, documents of a batch. As a set it is not affected by
+    redelivered tasks finishing a document again.
+    """
+    return batch_id + u'-finished'
+
+
+def finish_document(batch_id, index, count=None):
+    """
+    Adds a document to the finished documents of a batch.
+
+    Args:
+        batch_id (unicode): The batch identifier
+        index (int): Index of the document in the batch
+        count (int): Number of documents of a batch with later steps
+
+    Returns:
+        bool: True exactly once per batch with later steps, for the document
+              finishing last. Its caller has to start or fail the later
+              steps.
+    """
+    finished = add_members(finished_key(batch_id), [index])
+    if count is None or finished < count:
+        return False
+    return set_field_if_missing(documents_key(batch_id), u'started',
+                                json.dumps(True))
+
+
+def fail_document(batch_id, index):
+    """
+    Marks a document of a batch as failed and finished. The later steps of
+    the batch are marked as failed if it is the last document to finish.
+
+    Args:
+        batch_id (unicode): The batch identifier
+        index (int): Index of the document in the batch
+    """
+    key = documents_key(batch_id)
+    set_fields(key, {u'{}:state'.format(index): json.dumps(u'FAILURE')})
+    try:
+        header = json.loads(app.backend.get(batch_id))
+    except Exception:
+        header = {}
+    count = header.get('documents') if header.get('later_steps') else None
+    if finish_document(batch_id, index, count):
+        set_fields(key, {u'state': json.dumps(u'FAILURE')})
+
+
+def progress_key(batch_id):
+    """
+    Returns the key of the progress counters of a batch. Its fields are of the
+    form method:state with state being one of running, done, or failed.
+    """
+    return batch_id + u'-progress'
+
+
+def _count(batch_id, method, incr, decr=None):
+    if batch_id is None:
+        return
+    amounts = {method + u':' + incr: 1}
+    if decr:
+        amounts[method + u':' + decr] = -1
+    incr_counters(progress_key(batch_id), amounts)
+
+
+def _is_storage_tuple(doc):
+    return (isinstance(doc, (list, tuple)) and len(doc) == 2 and
+            all(isinstance(x, basestring) for x in doc))
+
+
+def _persist(ret, task):
+    """
+    Stores the output files of a task in the storage backend.
+    """
+    if isinstance(ret, dict):
+        ret = ret.get('doc')
+    if _is_storage_tuple(ret):
+        ret = [ret]
+    if not isinstance(ret, (list, tuple)):
+        return
+    for doc in ret:
+        if _is_storage_tuple(doc):
+            storage.persist(doc[0], doc[1], task)
+
+
+def _digest(doc):
+    """
+    Returns the SHA1 digest of the content of a document. Digests are taken
+    from the storage backend if it knows them or from the digests stored in
+    the result backend if the size and modification time of the document
+    are unchanged. Otherwise the document is read and its digest stored.
+    """
+    digest = storage.get_digest(*doc)
+    if digest is not None:
+        return digest
+    path = storage.get_abs_path(*doc)
+    st = os.stat(path)
+    field = doc[0] + u'/' + doc[1]
+    stored = get_fields(digests_key, [field])[0]
+    if stored is not None:
+        size, mtime, digest = json.loads(stored)
+        if size == st.st_size and mtime == st.st_mtime:
+            return digest
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1048576), b''):
+            h.update(chunk)
+    digest = unicode(h.hexdigest())
+    _cache_put(digests_key, field, [st.st_size, st.st_mtime, digest])
+    return digest
+
+
+def _cache_key(name, kwargs):
+    """
+    Calculates the cache key of a task execution from the task name, its
+    arguments, and the path beneath the job directory and the content digest
+    of the input document.
+
+    Args:
+        name (unicode): Name of the task
+        kwargs (dict): Arguments to the task function
+
+    Returns:
+        unicode: A hex digest or None if the task does not operate on a
+                 single input document.
+    """
+    doc = kwargs.get('doc')
+    if not _is_storage_tuple(doc) or not storage.is_file(*doc):
+        return None
+    args = {k: v for k, v in kwargs.iteritems() if k != 'doc'}
+    return unicode(hashlib.sha1(json.dumps([name, args, doc[1],
+                                            _digest(doc)],
+                                           sort_keys=True)).hexdigest())
+
+
+def _cache_put(key, field, value):
+    """
+    Stores a value in a cache hash, evicting entries older than max_age
+    seconds and the oldest entries exceeding max_entries.
+    """
+    now = time.time()
+    set_fields(key, {field: json.dumps(value)})
+    add_scored(key + u'-age', {field: now})
+    max_age = nidaba_cfg['cache'].get('max_age')
+    max_entries = nidaba_cfg['cache'].get('max_entries')
+    if max_age is None and max_entries is None:
+        return
+    delete_fields(key, pop_scored(key + u'-age', None if max_age is None else
+                                  now - max_age, max_entries))
+
+
+def _cache_lookup(key, doc):
+    """
+    Looks up a cached task result and links its output document into the job
+    directory of the input document.
+
+    Args:
+        key (unicode): Cache key as returned by _cache_key
+        doc (tuple): Input document of the task
+
+    Returns:
+        The cached return value of the task or None.
+    """
+    entry = get_fields(cache_key, [key])[0]
+    if entry is None:
+        return None
+    ret, created = json.loads(entry)
+    max_age = nidaba_cfg['cache'].get('max_age')
+    if max_age is not None and created < time.time() - max_age:
+        return None
+    out = ret['doc'] if isinstance(ret, dict) else ret
+    if not storage.is_file(*out):
+        return None
+    dest = (doc[0], out[1])
+    if not storage.is_file(*dest):
+        try:
+            storage.link_content(out[0], out[1], dest[0], dest[1])
+        except (OSError, IOError):
+            return None
+    if isinstance(ret, dict):
+        ret['doc'] = dest
+        return ret
+    return dest
+
+
+def _cache_store(key, ret):
+    """
+    Adds a task result to the cache.
+
+    Args:
+        key (unicode): Cache key as returned by _cache_key
+        ret: Return value of the task
+    """
+    out = ret.get('doc') if isinstance(ret, dict) else ret
+    if not _is_storage_tuple(out):
+        return
+    _cache_put(cache_key, key, [ret, time.time()])
@@ -15,10 +15,20 @@ from nidaba import leper
 from nidaba import image
 from nidaba.celery import app
 from nidaba.tasks.helper import NidabaTask
+from nidaba.tasks import binarize
+
+from inspect import getcallargs, getargspec
+
+
+def _img_path(input_path, method, **kwargs):
+    """
+    Calculates the output path of the parameterless image tasks.
+    """
+    return storage.insert_suffix(input_path, method)
 
 
 @app.task(base=NidabaTask, name=u'nidaba.img.rgb_to_gray')
-def rgb_to_gray(doc, method=u'rgb_to_gray'):
+def rgb_to_gray(doc, method=u'rgb_to_gray', intermediate=False):
     """
     Converts an arbitrary bit depth image to grayscale and writes it back
     appending a suffix.
@@ -27,17 +37,21 @@ def rgb_to_gray(doc, method=u'rgb_to_gray'):
         doc (unicode, unicode): The input document tuple
         id (unicode): The nidaba batch identifier this task is a part of
         method (unicode): The suffix string appended to all output files.
+        intermediate (bool): Writes the output in the configured intermediate
+                             format as it is only read by later tasks.
 
     Returns:
         (unicode, unicode): Storage tuple of the output file
     """
     input_path = storage.get_abs_path(*doc)
-    output_path = storage.insert_suffix(input_path, method)
+    output_path = _img_path(input_path, method)
+    if intermediate:
+        output_path = image.intermediate_path(output_path)
     return storage.get_storage_path(image.rgb_to_gray(input_path, output_path))
 
 
 @app.task(base=NidabaTask, name=u'nidaba.img.dewarp')
-def dewarp(doc, method=u'dewarp'):
+def dewarp(doc, method=u'dewarp', intermediate=False):
     """
     Removes perspective distortion (as commonly exhibited by overhead scans)
     from an 1bpp input image.
@@ -46,28 +60,124 @@ def dewarp(doc, method=u'dewarp'):
         doc (unicode, unicode): The input document tuple.
         id (unicode): The nidaba batch identifier this task is a part of
         method (unicode): The suffix string appended to all output files.
+        intermediate (bool): Writes the output in the configured intermediate
+                             format as it is only read by later tasks.
 
     Returns:
         (unicode, unicode): Storage tuple of the output file
     """
     input_path = storage.get_abs_path(*doc)
-    output_path = storage.insert_suffix(input_path, method)
+    output_path = _img_path(input_path, method)
+    if intermediate:
+        output_path = image.intermediate_path(output_path)
     return storage.get_storage_path(leper.dewarp(input_path, output_path))
 
 
 @app.task(base=NidabaTask, name=u'nidaba.img.deskew')
-def deskew(doc, method=u'deskew'):
+def deskew(doc, method=u'deskew', reduction=0, skew_angle=None,
+           intermediate=False):
     """
     Removes skew (rotational distortion) from an 1bpp input image.
 
+    By default leptonica's skew search is used. If a reduction factor is
+    given the skew angle is instead estimated on a binarized preview of
+    reduced resolution. The estimated angle is added to the tracking data
+    under the key 'skew_angle', the name of the argument skipping estimation,
+    so it is picked up by reruns of the task and later tasks of the sequence
+    accepting it.
+
     Args:
         doc (unicode, unicode): The input document tuple.
         id (unicode): The nidaba batch identifier this task is a part of
         method (unicode): The suffix string appended to all output files.
+        reduction (int): Reduction factor of the preview used for skew
+                         estimation (usually 2 or 4). 0 uses leptonica.
+        skew_angle (float): A previously estimated skew angle in degrees.
+                            Skips estimation if given.
+        intermediate (bool): Writes the output in the configured intermediate
+                             format as it is only read by later tasks.
 
     Returns:
         (unicode, unicode): Storage tuple of the output file
     """
     input_path = storage.get_abs_path(*doc)
-    output_path = storage.insert_suffix(input_path, method)
-    return storage.get_storage_path(leper.deskew(input_path, output_path))
+    output_path = _img_path(input_path, method)
+    if intermediate:
+        output_path = image.intermediate_path(output_path)
+    if not reduction and skew_angle is None:
+        return storage.get_storage_path(leper.deskew(input_path, output_path))
+    output_path, skew_angle = image.deskew(input_path, output_path, reduction,
+                                           skew_angle)
+    return {'doc': storage.get_storage_path(output_path),
+            'skew_angle': skew_angle}
+
+
+# Tasks that can be fused into a single pipeline task. Maps the task
+# identifier to the operation in nidaba.image and the function validating the
+# (complete) task arguments and calculating the output path from the input
+# path and them. They are shared with the stand-alone tasks so output names
+# and accepted parameters are identical.
+fusable = {
+    'img.rgb_to_gray': ('rgb_to_gray', _img_path),
+    'img.deskew': ('deskew', _img_path),
+    'img.dewarp': ('dewarp', _img_path),
+    'binarize.otsu': ('otsu', binarize._otsu_path),
+    'binarize.sauvola': ('sauvola', binarize._sauvola_path),
+    'binarize.nlbin': ('nlbin', binarize._nlbin_path),
+}
+
+
+@app.task(base=NidabaTask, name=u'nidaba.img.pipeline')
+def pipeline(doc, method=u'pipeline', steps=None, intermediate=False):
+    """
+    Runs a linear chain of image processing tasks in a single task, decoding
+    the input image only once and keeping intermediate results in memory.
+    Output file names are identical to the ones created by running the tasks
+    separately.
+
+    Args:
+        doc (unicode, unicode): The input document tuple
+        id (unicode): The nidaba batch identifier this task is a part of
+        method (unicode): Unused. Output file names are derived from the
+                          methods of the steps.
+        steps (list): A list of dictionaries each containing the task
+                      identifier under the key 'method' (see ``fusable`` for
+                      the valid ones) and its arguments. If the key 'keep' is
+                      set to True the intermediate result of the step is
+                      written to the storage medium. The output of the last
+                      step is always written.
+        intermediate (bool): Writes the output of the last step in the
+                             configured intermediate format as it is only read
+                             by later tasks.
+
+    Returns:
+        (unicode, unicode): Storage tuple of the output file. If a deskew
+        step estimated the skew angle a dictionary containing it under the key
+        'skew_angle' in addition to the storage tuple under the key 'doc' is
+        returned instead.
+
+    Raises:
+        NidabaInvalidParameterException: Parameters of a step are outside the
+                                         valid range.
+    """
+    input_path = storage.get_abs_path(*doc)
+    output_path = input_path
+    isteps = []
+    for idx, step in enumerate(steps):
+        step = dict(step)
+        keep = step.pop('keep', False) or idx == len(steps) - 1
+        task = app.tasks['nidaba.' + step['method']]
+        op, path = fusable[step['method']]
+        kwargs = getcallargs(task.run, doc, **{k: v for k, v in step.items()
+                                               if k in
+                                               getargspec(task.run).args})
+        del kwargs['doc'], kwargs['method']
+        kwargs.pop('intermediate', None)
+        output_path = path(output_path, step['method'], **kwargs)
+        if intermediate and idx == len(steps) - 1:
+            output_path = image.intermediate_path(output_path)
+        isteps.append((op, kwargs, output_path if keep else None))
+    written, tracking = image.pipeline(input_path, isteps)
+    if tracking:
+        return dict(tracking, doc=storage.get_storage_path(output_path))
+    return storage.get_storage_path(output_path)
@@ -11,10 +11,14 @@ a kind.
 from __future__ import absolute_import, unicode_literals
 
 from nidaba.tasks.helper import NidabaTask
+from nidaba.tasks import helper
 from nidaba.celery import app
+from celery import signature
 from nidaba import storage
 from nidaba import merge_hocr
 
+import json
+
 
 @app.task(base=NidabaTask, name=u'nidaba.util.blend_hocr')
 def blend_hocr(docs, method=u'blend_hocr', language=u''):
@@ -42,16 +46,162 @@ def blend_hocr(docs, method=u'blend_hocr', language=u''):
                             storage.get_storage_path(output_path))
 
 
+def _flatten(docs):
+    """
+    Flattens a nested list of tracking dictionaries.
+    """
+    flat = []
+    for doc in docs:
+        if isinstance(doc, list):
+            flat.extend(_flatten(doc))
+        else:
+            flat.append(doc)
+    return flat
+
+
 @app.task(base=NidabaTask, name=u'nidaba.util.sync')
 def sync(doc):
     """
     Takes ones argument and returns it. Used to synchronized stuff as
-    chaining groups is not possible with the current celery version.
+    chaining groups is not possible with the current celery version. Nested
+    lists produced by branching sequences (see gather) are flattened.
 
     Args:
         doc: An arbitrary input argument
 
     Returns:
-        The input argument unaltered
+        The input argument unaltered or flattened if it is a list
+    """
+    if isinstance(doc, list):
+        return _flatten(doc)
+    return doc
+
+
+@app.task(base=NidabaTask, name=u'nidaba.util.pick')
+def pick(doc, method=u'pick', index=0):
+    """
+    Selects a single document from the list of outputs of a task creating
+    multiple ones, e.g. binarize.nlbin_sweep.
+
+    Args:
+        doc (list): A list of storage tuples
+        method (unicode): Unused
+        index (int): Index of the document to select
+
+    Returns:
+        (unicode, unicode): The storage tuple at the index
+    """
+    return doc[index]
+
+
+@app.task(name=u'nidaba.util.gather')
+def gather(docs):
+    """
+    Flattens the (possibly nested) list of outputs of a group into a single
+    list. Used to join the branches of the prefix tree of a batch. As it does
+    not operate on documents it doesn't inherit from NidabaTask and returns
+    the list instead of wrapping it into a tracking dictionary.
+
+    Args:
+        docs (list): A list of tracking dictionaries or lists of them
+
+    Returns:
+        list: A flat list of tracking dictionaries
+    """
+    return _flatten(docs)
+
+
+def _storage_tuples(docs):
+    """
+    Extracts all storage tuples from a (possibly nested) result of a batch.
+    """
+    if isinstance(docs, dict):
+        return _storage_tuples(docs['doc'])
+    if (len(docs) == 2 and isinstance(docs[0], basestring) and
+            isinstance(docs[1], basestring)):
+        return [docs]
+    tuples = []
+    for doc in docs:
+        tuples.extend(_storage_tuples(doc))
+    return tuples
+
+
+@app.task(name=u'nidaba.util.collect')
+def collect(docs):
+    """
+    Joins the outputs of a step running once per batch. Only the storage
+    tuples of the outputs and the tracking value 'later_steps' are passed on
+    to the following step.
+
+    Args:
+        docs (list): A list of tracking dictionaries or lists of them
+
+    Returns:
+        dict: A tracking dictionary containing the list of storage tuples
+              under the key 'doc'.
+    """
+    return {u'doc': _storage_tuples(docs), u'later_steps': True}
+
+
+@app.task(name=u'nidaba.util.finish')
+def finish(result, id, index=None, count=None):
+    """
+    Records the result of a document of a batch in the document hash of the
+    batch (see nidaba.tasks.helper.documents_key). It is appended to the chain
+    of each document and to the chain of the later steps of a batch (with
+    index None).
+
+    The document finishing last, successfully or not (see
+    nidaba.tasks.helper.fail_document), starts the later steps of the batch.
+    Their input are the storage tuples of the outputs of all documents. If
+    any document failed they are marked as failed instead.
+
+    Args:
+        result: The result of the chain of the document
+        id (unicode): The batch identifier
+        index (int): Index of the document in the batch
+        count (int): Number of documents of a batch with later steps
+
+    Returns:
+        The result unaltered
+    """
+    key = helper.documents_key(id)
+    if index is None:
+        if isinstance(result, dict):
+            result.pop(u'later_steps', None)
+        helper.set_fields(key, {u'state': json.dumps(u'SUCCESS'),
+                                u'result': json.dumps(result)})
+        return result
+    helper.set_fields(key, {u'{}:state'.format(index): json.dumps(u'SUCCESS'),
+                            u'{}:result'.format(index): json.dumps(result)})
+    if helper.finish_document(id, index, count):
+        fields = [u'steps'] + [u'{}:{}'.format(idx, f) for idx in
+                               xrange(count) for f in (u'state', u'result')]
+        values = helper.get_fields(key, fields)
+        states = [json.loads(v) if v else None for v in values[1::2]]
+        if any(st != u'SUCCESS' for st in states):
+            helper.set_fields(key, {u'state': json.dumps(u'FAILURE')})
+            return result
+        docs = _storage_tuples([json.loads(v) for v in values[2::2]])
+        steps = signature(json.loads(values[0]), app=app)
+        steps.apply_async(({u'doc': docs, u'later_steps': True},),
+                          link_error=fail.s(id=id))
+    return result
+
+
+@app.task(name=u'nidaba.util.fail')
+def fail(task_id, id, index=None):
+    """
+    Marks a document of a batch or its later steps (with index None) as
+    failed. Used as the error callback of the chains of a batch.
+
+    Args:
+        task_id (unicode): ID of the failed task
+        id (unicode): The batch identifier
+        index (int): Index of the document in the batch
     """
-    return doc 
+    if index is None:
+        helper.set_fields(helper.documents_key(id),
+                          {u'state': json.dumps(u'FAILURE')})
+    else:
+        helper.fail_document(id, index)
@@ -0,0 +1,485 @@
+"""
+nidaba.tiles
+~~~~~~~~~~~~
+
+Tiled processing of very large images with bounded memory usage. Input images
+are accessed through memory-mapped uncompressed rasters (netpbm and
+uncompressed TIFF files), processed in square tiles with overlapping halos for
+local operations, and the results are written incrementally strip by strip as
+netpbm, PNG, or uncompressed TIFF files. Peak memory usage is therefore
+proportional to the tile size and the image width instead of the page size.
+
+Compressed inputs can not be read in parts. They are converted once into a
+temporary netpbm file beforehand which requires them to be decoded completely;
+images larger than a given limit are rejected instead. Outputs in other
+formats are converted after processing under the same limit. Configuring the
+``pnm`` intermediate format avoids both for all images created and consumed by
+nidaba.
+"""
+
+from __future__ import absolute_import, division
+
+from PIL import Image
+
+from nidaba.nidabaexceptions import NidabaAlgorithmException
+
+import nidaba.algorithms.sauvola as sauvola_alg
+
+import os
+import re
+import mmap
+import zlib
+import struct
+import shutil
+import tempfile
+import numpy as np
+
+# matches the header of binary netpbm files, i.e. magic number, width, height,
+# and maximum value (omitted by PBM) separated by whitespace and comments.
+_pnm_header = re.compile(br'(P[456])(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+'
+                         br'(\d+)(?:(?:\s|#[^\n]*\n)+(\d+))?\s')
+
+
+def map_raster(path):
+    """
+    Memory-maps the raster of a binary 8 bit netpbm file.
+
+    Args:
+        path: Path of the image
+
+    Returns:
+        None if the file is not a binary netpbm file with a maximum value of
+        255, otherwise a tuple (mode, raster) with mode being the PIL mode of
+        the image and raster a numpy array backed by the mapping. The raster
+        has the shape (height, width) for grayscale, (height, width, 3) for
+        RGB, and (height, ceil(width/8)) for packed bilevel images ('1').
+    """
+    with open(path, 'rb') as fp:
+        m = _pnm_header.match(fp.read(512))
+        if not m or (m.group(1) != b'P4' and m.group(4) != b'255'):
+            return None
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    width, height = int(m.group(2)), int(m.group(3))
+    offset = m.end()
+    if m.group(1) == b'P4':
+        # PBM has no maximum value field; the raster starts after the single
+        # whitespace character following the height.
+        offset = m.end(3) + 1
+        mode, shape = '1', (height, (width + 7) // 8)
+    elif m.group(1) == b'P5':
+        mode, shape = 'L', (height, width)
+    else:
+        mode, shape = 'RGB', (height, width, 3)
+    raster = np.frombuffer(mm, dtype=np.uint8, count=int(np.prod(shape)),
+                           offset=offset).reshape(shape)
+    return mode, raster
+
+
+def image_size(path):
+    """
+    Returns the dimensions of an image without decoding it.
+
+    Args:
+        path: Path of the image
+
+    Returns:
+        (int, int): Width and height of the image
+    """
+    return Image.open(path).size
+
+
+class RasterStrips(object):
+    """
+    A read-only view of an image composed of horizontal strips of raster data
+    (usually memory-mapped). Slicing it with a pair of row and column slices
+    returns the 8 bit grayscale or RGB values of the region; bilevel strips
+    are unpacked on access.
+    """
+
+    def __init__(self, size, strips):
+        """
+        Args:
+            size (tuple): Width and height of the image
+            strips (list): A list of tuples (y0, y1, raster, packed) with y0
+                           and y1 being the first and last row (exclusive) of
+                           the strip, raster a numpy array of its rows, and
+                           packed either None for 8 bit rasters or 'white' or
+                           'black' for bilevel rasters with 8 pixels per byte
+                           denoting the color of set bits.
+        """
+        self.strips = strips
+        self.shape = (size[1], size[0])
+
+    def __getitem__(self, idx):
+        ys, xs = idx
+        y0, y1, _ = ys.indices(self.shape[0])
+        x0, x1, _ = xs.indices(self.shape[1])
+        parts = []
+        for s0, s1, raster, packed in self.strips:
+            r0, r1 = max(y0, s0), min(y1, s1)
+            if r0 >= r1:
+                continue
+            rows = raster[r0 - s0:r1 - s0]
+            if packed:
+                rows = np.unpackbits(rows[:, x0 // 8:(x1 + 7) // 8], axis=1)
+                rows = rows[:, x0 % 8:x0 % 8 + x1 - x0]
+                if packed == 'black':
+                    rows = 1 - rows
+                rows = rows * np.uint8(255)
+            else:
+                rows = rows[:, x0:x1]
+            parts.append(rows)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+
+# raw modes of uncompressed TIFF strips that can be mapped. Maps to the number
+# of bands of 8 bit rasters or the color of set bits of bilevel ones.
+_tiff_rawmodes = {'L': 1, 'RGB': 3, '1': 'white', '1;I': 'black'}
+
+
+def map_strips(path):
+    """
+    Memory-maps the rasters of binary netpbm files and uncompressed TIFF
+    files.
+
+    Args:
+        path: Path of the image
+
+    Returns:
+        RasterStrips: The mapped image or None if its raster is compressed or
+                      in an unsupported format.
+    """
+    r = map_raster(path)
+    if r is not None:
+        mode, raster = r
+        size = image_size(path)
+        packed = 'black' if mode == '1' else None
+        return RasterStrips(size, [(0, size[1], raster, packed)])
+    img = Image.open(path)
+    width, height = img.size
+    if img.format != 'TIFF' or not img.tile:
+        return None
+    strips = []
+    for decoder, box, offset, args in img.tile:
+        if decoder != 'raw' or box[0] != 0 or box[2] != width:
+            return None
+        rawmode, stride = args[0], args[1]
+        bands = _tiff_rawmodes.get(rawmode)
+        if bands is None:
+            return None
+        if isinstance(bands, int):
+            shape = (box[3] - box[1], width, bands)
+        else:
+            shape = (box[3] - box[1], (width + 7) // 8)
+        if stride not in (0, int(np.prod(shape[1:]))):
+            return None
+        strips.append((box[1], box[3], offset, shape, bands))
+    with open(path, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    rasters = []
+    for y0, y1, offset, shape, bands in strips:
+        raster = np.frombuffer(mm, dtype=np.uint8, count=int(np.prod(shape)),
+                               offset=offset).reshape(shape)
+        if bands == 1:
+            raster = raster[..., 0]
+        rasters.append((y0, y1, raster, None if isinstance(bands, int) else
+                        bands))
+    return RasterStrips((width, height), rasters)
+
+
+class PNMWriter(object):
+    """
+    Writes binary netpbm files incrementally row by row.
+    """
+
+    def __init__(self, path, mode, size):
+        """
+        Opens a netpbm file for writing and writes its header.
+
+        Args:
+            path: Path of the output file
+            mode (str): PIL mode of the image; either '1' or 'L'
+            size (tuple): Width and height of the image
+        """
+        self.mode = mode
+        self.fp = open(path, 'wb')
+        if mode == '1':
+            self.fp.write(b'P4\n%d %d\n' % size)
+        else:
+            self.fp.write(b'P5\n%d %d\n255\n' % size)
+
+    def write(self, rows):
+        """
+        Appends rows to the image.
+
+        Args:
+            rows (numpy.array): A 2-dimensional array of uint8 values for
+                                grayscale images or of booleans for bilevel
+                                ones with True being white.
+        """
+        if self.mode == '1':
+            rows = np.packbits(~rows, axis=1)
+        self.fp.write(np.ascontiguousarray(rows, dtype=np.uint8).tostring())
+
+    def close(self):
+        self.fp.close()
+
+
+class PNGWriter(object):
+    """
+    Writes grayscale and bilevel PNG files incrementally row by row.
+    """
+
+    def __init__(self, path, mode, size):
+        """
+        Opens a PNG file for writing and writes its header.
+
+        Args:
+            path: Path of the output file
+            mode (str): PIL mode of the image; either '1' or 'L'
+            size (tuple): Width and height of the image
+        """
+        self.mode = mode
+        self.fp = open(path, 'wb')
+        self.z = zlib.compressobj()
+        self.fp.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1],
+                                         1 if mode == '1' else 8, 0, 0, 0,
+                                         0))
+
+    def _chunk(self, tag, data):
+        self.fp.write(struct.pack('>I', len(data)) + tag + data +
+                      struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def write(self, rows):
+        """
+        Appends rows to the image.
+
+        Args:
+            rows (numpy.array): A 2-dimensional array of uint8 values for
+                                grayscale images or of booleans for bilevel
+                                ones with True being white.
+        """
+        if self.mode == '1':
+            rows = np.packbits(rows, axis=1)
+        # each row is prefixed with the filter type (0, none)
+        rows = np.hstack((np.zeros((rows.shape[0], 1), dtype=np.uint8),
+                          np.asarray(rows, dtype=np.uint8)))
+        data = self.z.compress(rows.tostring())
+        if data:
+            self._chunk(b'IDAT', data)
+
+    def close(self):
+        self._chunk(b'IDAT', self.z.flush())
+        self._chunk(b'IEND', b'')
+        self.fp.close()
+
+
+class TIFFWriter(object):
+    """
+    Writes uncompressed grayscale and bilevel TIFF files incrementally row by
+    row. The raster is stored in a single strip.
+    """
+
+    def __init__(self, path, mode, size):
+        """
+        Opens a TIFF file for writing and writes its header.
+
+        Args:
+            path: Path of the output file
+            mode (str): PIL mode of the image; either '1' or 'L'
+            size (tuple): Width and height of the image
+        """
+        self.mode = mode
+        self.fp = open(path, 'wb')
+        width, height = size
+        rowbytes = (width + 7) // 8 if mode == '1' else width
+        # tag, type (3 short, 4 long), value
+        entries = [(256, 4, width),
+                   (257, 4, height),
+                   (258, 3, 1 if mode == '1' else 8),
+                   (259, 3, 1),
+                   (262, 3, 1),
+                   (273, 4, 8 + 2 + 9 * 12 + 4),
+                   (277, 3, 1),
+                   (278, 4, height),
+                   (279, 4, rowbytes * height)]
+        ifd = struct.pack('<H', len(entries))
+        for tag, typ, value in entries:
+            ifd += struct.pack('<HHI', tag, typ, 1)
+            ifd += struct.pack('<HH' if typ == 3 else '<I',
+                               *((value, 0) if typ == 3 else (value,)))
+        self.fp.write(b'II*\x00' + struct.pack('<I', 8) + ifd +
+                      struct.pack('<I', 0))
+
+    def write(self, rows):
+        """
+        Appends rows to the image.
+
+        Args:
+            rows (numpy.array): A 2-dimensional array of uint8 values for
+                                grayscale images or of booleans for bilevel
+                                ones with True being white.
+        """
+        if self.mode == '1':
+            rows = np.packbits(rows, axis=1)
+        self.fp.write(np.ascontiguousarray(rows, dtype=np.uint8).tostring())
+
+    def close(self):
+        self.fp.close()
+
+
+# Writers of the output formats supported by map_tiles() by file extension
+writers = {u'.pnm': PNMWriter,
+           u'.pbm': PNMWriter,
+           u'.pgm': PNMWriter,
+           u'.png': PNGWriter,
+           u'.tif': TIFFWriter,
+           u'.tiff': TIFFWriter}
+
+
+def _gray(tile):
+    """
+    Converts an RGB tile to grayscale using the ITU-R 601-2 luma transform in
+    the same fixed point form as PIL.
+    """
+    if tile.ndim == 2:
+        return tile
+    tile = tile.astype(np.uint32)
+    return ((tile[..., 0] * 19595 + tile[..., 1] * 38470 +
+             tile[..., 2] * 7471) >> 16).astype(np.uint8)
+
+
+def _check_decode(size, max_decode):
+    """
+    Raises an exception if an image is too large to be decoded completely.
+    """
+    if max_decode and size[0] * size[1] > max_decode:
+        raise NidabaAlgorithmException('Image of {}x{} pixels exceeds the '
+                                       'limit for complete decoding; use an '
+                                       'uncompressed TIFF or netpbm '
+                                       'file.'.format(*size))
+
+
+def _open(imagepath, tmpdir, max_decode=None):
+    """
+    Maps an image, converting it to a temporary netpbm file if necessary.
+    """
+    strips = map_strips(imagepath)
+    if strips is None:
+        _check_decode(image_size(imagepath), max_decode)
+        img = Image.open(imagepath)
+        if img.mode not in ('L', 'RGB'):
+            img = img.convert('L')
+        path = os.path.join(tmpdir, u'in.pnm')
+        img.save(path, format='PPM')
+        del img
+        strips = map_strips(path)
+    return strips
+
+
+def map_tiles(imagepath, resultpath, func, mode='L', halo=0, tile_size=1024,
+              max_decode=None):
+    """
+    Applies a function to all tiles of a grayscale version of an image and
+    writes the results incrementally.
+
+    Args:
+        imagepath: Path of the input image
+        resultpath: Path of the output image. Results are written directly
+                    if it has a netpbm, PNG, or TIFF extension, otherwise they
+                    are converted after processing which requires the output
+                    to be held in memory completely.
+        func (callable): A function mapping a 2-dimensional uint8 array (the
+                         tile including its halo) to an array of the same
+                         shape of either uint8 values (mode 'L') or booleans
+                         with True being white (mode '1').
+        mode (str): PIL mode of the output image
+        halo (int): Width of the context around each tile required by func
+        tile_size (int): Width and height of the tiles
+        max_decode (int): Maximum number of pixels of images which have to be
+                          decoded or encoded completely. None disables the
+                          limit.
+
+    Returns:
+        unicode: Path of the output file
+
+    Raises:
+        NidabaAlgorithmException: The input or output image can not be
+                                  processed incrementally and is larger than
+                                  max_decode.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        raster = _open(imagepath, tmpdir, max_decode)
+        height, width = raster.shape[:2]
+        writer = writers.get(os.path.splitext(resultpath)[1].lower())
+        if writer:
+            outpath = resultpath
+        else:
+            _check_decode((width, height), max_decode)
+            outpath = os.path.join(tmpdir, u'out.pnm')
+            writer = PNMWriter
+        writer = writer(outpath, mode, (width, height))
+        try:
+            for y0 in range(0, height, tile_size):
+                y1 = min(y0 + tile_size, height)
+                hy0, hy1 = max(y0 - halo, 0), min(y1 + halo, height)
+                strip = np.empty((y1 - y0, width),
+                                 dtype=bool if mode == '1' else np.uint8)
+                for x0 in range(0, width, tile_size):
+                    x1 = min(x0 + tile_size, width)
+                    hx0, hx1 = max(x0 - halo, 0), min(x1 + halo, width)
+                    res = func(_gray(raster[hy0:hy1, hx0:hx1]))
+                    strip[:, x0:x1] = res[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+                writer.write(strip)
+        finally:
+            writer.close()
+        if outpath != resultpath:
+            Image.open(outpath).save(resultpath)
+        return resultpath
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def rgb_to_gray(imagepath, resultpath, tile_size=1024, max_decode=None):
+    """
+    Converts an image into a 8bpp grayscale image tile by tile.
+
+    Args:
+        imagepath: Path of the input image
+        resultpath: Path of the output image
+        tile_size (int): Width and height of the tiles
+        max_decode (int): Maximum number of pixels of images which have to be
+                          decoded or encoded completely.
+
+    Returns:
+        unicode: Path of the output file
+    """
+    return map_tiles(imagepath, resultpath, lambda t: t, u'L', 0, tile_size,
+                     max_decode)
+
+
+def sauvola(imagepath, resultpath, whsize=10, factor=0.35, tile_size=1024,
+            max_decode=None):
+    """
+    Binarizes an image using Sauvola's method tile by tile. The result is
+    identical to processing the whole image at once.
+
+    Args:
+        imagepath: Path of the input image
+        resultpath: Path of the output image
+        whsize (int): Half width of the local window
+        factor (float): The threshold reduction factor due to variance.
+        tile_size (int): Width and height of the tiles
+        max_decode (int): Maximum number of pixels of images which have to be
+                          decoded or encoded completely.
+
+    Returns:
+        unicode: Path of the output file
+    """
+    return map_tiles(imagepath, resultpath,
+                     lambda t: sauvola_alg.sauvola_array(t, whsize, factor),
+                     u'1', whsize, tile_size, max_decode)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+from PIL import Image, ImageDraw
+
+from nidaba import image
+from nidaba import storage
+from nidaba.config import nidaba_cfg
+from nidaba.algorithms import sauvola, skew
+from nidaba.nidabaexceptions import NidabaAlgorithmException
+
+
+class SauvolaTests(unittest.TestCase):
+
+    """
+    Tests the numpy implementation of Sauvola's thresholding.
+    """
+
+    def test_uniform_image(self):
+        """
+        Test that a uniform image is binarized to all white.
+        """
+        im = Image.new('L', (40, 30), 200)
+        res = sauvola.sauvola(im, 5, 0.35)
+        self.assertEqual(res.mode, '1')
+        self.assertEqual(res.size, im.size)
+        self.assertTrue(numpy.all(numpy.asarray(res.convert('L')) == 255))
+
+    def test_dark_square(self):
+        """
+        Test that a dark square on a light background is black.
+        """
+        a = numpy.full((40, 40), 220, dtype=numpy.uint8)
+        a[15:25, 15:25] = 20
+        res = numpy.asarray(sauvola.sauvola(Image.fromarray(a), 10,
+                                            0.35).convert('L'))
+        self.assertTrue(numpy.all(res[15:25, 15:25] == 0))
+        self.assertTrue(numpy.all(res[:5, :5] == 255))
+
+
+class PipelineTests(unittest.TestCase):
+
+    """
+    Tests the in-process image pipeline.
+    """
+
+    def setUp(self):
+        self.tempdir = unicode(tempfile.mkdtemp())
+        self.input = os.path.join(self.tempdir, u'input.png')
+        a = numpy.random.randint(0, 255, (30, 40, 3)).astype(numpy.uint8)
+        Image.fromarray(a).save(self.input)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_only_requested_outputs(self):
+        """
+        Test that only steps with an output path are written.
+        """
+        out = os.path.join(self.tempdir, u'out.png')
+        ret = image.pipeline(self.input, [(u'rgb_to_gray', {}, None),
+                                          (u'nlbin', {u'zoom': 1.0}, out)])
+        self.assertEqual(ret, ([out], {}))
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         [u'input.png', u'out.png'])
+        self.assertTrue(set(Image.open(out).getdata()) <= set([0, 255]))
+
+    def test_unknown_operation(self):
+        """
+        Test that unknown operations raise an exception.
+        """
+        with self.assertRaises(NidabaAlgorithmException):
+            image.pipeline(self.input, [(u'foo', {}, None)])
+
+
+class IntermediateFormatTests(unittest.TestCase):
+
+    """
+    Tests writing and memory-mapped reading of intermediate images.
+    """
+
+    def setUp(self):
+        self.tempdir = unicode(tempfile.mkdtemp())
+        self.fmt = nidaba_cfg.get('intermediate_format')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        nidaba_cfg['intermediate_format'] = self.fmt
+
+    def _roundtrip(self, mode):
+        a = numpy.random.randint(0, 255, (31, 43, 3)).astype(numpy.uint8)
+        im = Image.fromarray(a).convert(mode)
+        path = os.path.join(self.tempdir, u'img.pnm')
+        image.save_image(im, path)
+        res = image.load_image(path)
+        self.assertEqual(res.mode, mode)
+        self.assertEqual(res.size, im.size)
+        self.assertEqual(list(res.getdata()), list(im.getdata()))
+
+    def test_roundtrip_pbm(self):
+        """
+        Test that 1bpp images survive a netpbm roundtrip.
+        """
+        self._roundtrip('1')
+
+    def test_roundtrip_pgm(self):
+        """
+        Test that 8bpp grayscale images survive a netpbm roundtrip.
+        """
+        self._roundtrip('L')
+
+    def test_roundtrip_ppm(self):
+        """
+        Test that RGB images survive a netpbm roundtrip.
+        """
+        self._roundtrip('RGB')
+
+    def test_intermediate_path(self):
+        """
+        Test that intermediate paths get the configured extension.
+        """
+        nidaba_cfg['intermediate_format'] = None
+        self.assertEqual(image.intermediate_path(u'/a/b_c.png'),
+                         u'/a/b_c.png')
+        nidaba_cfg['intermediate_format'] = u'pnm'
+        path = image.intermediate_path(u'/a/b_c.png')
+        self.assertEqual(path, u'/a/b_c.png.pnm')
+        self.assertEqual(storage.insert_suffix(path, u'd'), u'/a/b_c_d.png')
+        self.assertEqual(storage.insert_suffix(u'/a/b.pnm', u'd'),
+                         u'/a/b_d.pnm')
+
+    def test_insert_suffix_dotted(self):
+        """
+        Test that only the intermediate extension following an image
+        extension is removed from dotted file names.
+        """
+        self.assertEqual(storage.insert_suffix(u'/a/scan.v2.pnm', u'gray'),
+                         u'/a/scan.v2_gray.pnm')
+        self.assertEqual(storage.insert_suffix(u'/a/scan.v2.png.pnm',
+                                               u'gray'),
+                         u'/a/scan.v2_gray.png')
+        self.assertEqual(storage.insert_suffix(u'/a/scan.v2.png', u'gray'),
+                         u'/a/scan.v2_gray.png')
+
+
+class DeskewTests(unittest.TestCase):
+
+    """
+    Tests skew estimation on reduced previews.
+    """
+
+    def setUp(self):
+        self.tempdir = unicode(tempfile.mkdtemp())
+        self.input = os.path.join(self.tempdir, u'input.png')
+        im = Image.new('L', (800, 1000), 255)
+        draw = ImageDraw.Draw(im)
+        for y in range(100, 900, 40):
+            draw.rectangle((100, y, 700, y + 12), fill=0)
+        skew.rotate(im, 3.0).save(self.input)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_estimate_reduced(self):
+        """
+        Test that the skew angle is found on reduced previews.
+        """
+        im = Image.open(self.input)
+        for reduction in (1, 2, 4):
+            self.assertAlmostEqual(skew.estimate_skew(im, reduction), -3.0,
+                                   delta=0.3)
+
+    def test_deskew(self):
+        """
+        Test that the deskewed image has no remaining skew.
+        """
+        out = os.path.join(self.tempdir, u'out.png')
+        path, angle = image.deskew(self.input, out, 4)
+        self.assertEqual(path, out)
+        self.assertAlmostEqual(angle, -3.0, delta=0.3)
+        self.assertAlmostEqual(skew.estimate_skew(Image.open(out), 1), 0.0,
+                               delta=0.3)
+
+    def test_deskew_given_angle(self):
+        """
+        Test that a given angle is used without estimation.
+        """
+        out = os.path.join(self.tempdir, u'out.png')
+        self.assertEqual(image.deskew(self.input, out, 4, 1.5)[1], 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+from PIL import Image
+from nose.plugins.skip import SkipTest
+
+from nidaba import kraken
+from nidaba.algorithms import nlbin
+
+
+class NlbinTests(unittest.TestCase):
+
+    """
+    Tests for the nlbin wrappers.
+    """
+
+    def setUp(self):
+        self.tempdir = unicode(tempfile.mkdtemp())
+        self.input = os.path.join(self.tempdir, u'input.png')
+        a = numpy.full((120, 100), 200, dtype=numpy.uint8)
+        a[40:60, 20:80] = 30
+        a += numpy.random.randint(0, 40, a.shape).astype(numpy.uint8)
+        Image.fromarray(a).save(self.input)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sweep_equals_single(self):
+        """
+        Test that a sweep produces the same output as separate invocations.
+        """
+        variants = [{u'threshold': 0.3}, {u'threshold': 0.6, u'low': 10},
+                    {u'zoom': 0.25}]
+        sweep = [(os.path.join(self.tempdir, u'sweep_{}.png'.format(i)), v)
+                 for i, v in enumerate(variants)]
+        ret = kraken.nlbin_sweep(self.input, sweep)
+        self.assertEqual(ret, [x[0] for x in sweep])
+        for i, (path, v) in enumerate(sweep):
+            single = os.path.join(self.tempdir, u'single_{}.png'.format(i))
+            kraken.nlbin(self.input, single, **v)
+            self.assertEqual(list(Image.open(path).getdata()),
+                             list(Image.open(single).getdata()))
+
+    def test_shared_flattening(self):
+        """
+        Test that the background is estimated once per distinct set of zoom,
+        perc, and range parameters.
+        """
+        calls = []
+        flatten = nlbin.flatten
+
+        def counting_flatten(*args):
+            calls.append(args[1:])
+            return flatten(*args)
+
+        nlbin.flatten = counting_flatten
+        try:
+            variants = [{u'threshold': 0.3}, {u'zoom': 0.25},
+                        {u'threshold': 0.6}, {u'zoom': 0.25, u'low': 10}]
+            ret = kraken.nlbin_sweep(self.input, [
+                (os.path.join(self.tempdir, u'{}.png'.format(i)), v) for
+                i, v in enumerate(variants)])
+        finally:
+            nlbin.flatten = flatten
+        self.assertEqual(calls, [(0.5, 80, 20), (0.25, 80, 20)])
+        self.assertEqual(ret, [os.path.join(self.tempdir,
+                                            u'{}.png'.format(i)) for i in
+                               range(4)])
+
+    def test_equals_kraken(self):
+        """
+        Test that the output is identical to kraken's implementation.
+        """
+        try:
+            from kraken.binarization import nlbin as kraken_nlbin
+        except ImportError:
+            raise SkipTest
+        im = Image.open(self.input)
+        for v in [{}, {u'threshold': 0.3, u'low': 10}, {u'zoom': 0.25},
+                  {u'escale': 0.5, u'border': 0.2}, {u'escale': 0}]:
+            self.assertTrue(numpy.array_equal(
+                numpy.asarray(nlbin.nlbin(im, **v)),
+                numpy.asarray(kraken_nlbin(im, **v))))
+
+    def test_escale(self):
+        """
+        Test that the text region mask is disabled by non-positive escale
+        values and tiny ones don't fail.
+        """
+        im = Image.open(self.input)
+        flat = nlbin.flatten(im)
+        self.assertEqual(nlbin.estimate(flat, escale=0).size,
+                         nlbin.estimate(flat, escale=-1).size)
+        for escale in (0, 0.01, -1):
+            nlbin.nlbin(im, escale=escale)
+
+
+if __name__ == '__main__':
+    unittest.main()
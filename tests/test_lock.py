@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from nidaba.lock import lock, rwlock
+from nidaba.nidabaexceptions import NidabaLockTimeoutException
+
+
+class LockTest(unittest.TestCase):
+
+    """
+    Tests the symlink lock.
+    """
+
+    def setUp(self):
+        self.tempdir = unicode(tempfile.mkdtemp())
+        self.path = os.path.join(self.tempdir, u'file')
+        self.host = unicode(os.uname()[1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _hold(self, host, pid):
+        os.symlink(u'{}.{}.lock'.format(host, pid), self.path + u'.lock')
+
+    def test_acquire_release(self):
+        """
+        Test acquiring and releasing a lock.
+        """
+        l = lock(self.path)
+        self.assertTrue(l.acquire())
+        self.assertTrue(os.path.islink(self.path + u'.lock'))
+        self.assertTrue(l.release())
+        self.assertFalse(os.path.lexists(self.path + u'.lock'))
+        with l:
+            self.assertTrue(os.path.islink(self.path + u'.lock'))
+        self.assertFalse(os.path.lexists(self.path + u'.lock'))
+
+    def test_timeout(self):
+        """
+        Test that acquiring a lock held by a live process times out.
+        """
+        self._hold(self.host, os.getppid())
+        l = lock(self.path, inotify=False)
+        start = time.time()
+        self.assertFalse(l.acquire(timeout=0.2))
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(l.release())
+
+    def test_dead_holder(self):
+        """
+        Test that a lock held by a dead process on this host is broken.
+        """
+        p = subprocess.Popen(['true'])
+        p.wait()
+        self._hold(self.host, p.pid)
+        l = lock(self.path, timeout=1)
+        self.assertTrue(l.acquire())
+        self.assertTrue(l.release())
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_lease(self):
+        """
+        Test that a lock held on another host is broken after its lease.
+        """
+        self._hold(u'otherhost', 1)
+        self.assertFalse(lock(self.path, timeout=0.1).acquire())
+        time.sleep(0.2)
+        self.assertTrue(lock(self.path, timeout=0.1, lease=0.1).acquire())
+
+    def test_serialized_breakers(self):
+        """
+        Test that a stale lock isn't broken while another process breaks it.
+        """
+        p = subprocess.Popen(['true'])
+        p.wait()
+        self._hold(self.host, p.pid)
+        os.symlink(u'{}.{}.lock'.format(self.host, os.getppid()),
+                   self.path + u'.lock.break')
+        self.assertFalse(lock(self.path, timeout=0.1).acquire())
+        self.assertEqual(os.readlink(self.path + u'.lock'),
+                         u'{}.{}.lock'.format(self.host, p.pid))
+        os.remove(self.path + u'.lock.break')
+        self.assertTrue(lock(self.path, timeout=1).acquire())
+        self.assertEqual(sorted(os.listdir(self.tempdir)), [u'file.lock'])
+
+    def test_replaced_lock_kept(self):
+        """
+        Test that a lock replaced between reading and breaking it is neither
+        removed nor overwritten.
+        """
+        p = subprocess.Popen(['true'])
+        p.wait()
+        self._hold(self.host, p.pid)
+        live = u'{}.{}.lock'.format(self.host, os.getppid())
+        rename = os.rename
+
+        def replace(src, dst):
+            os.remove(src)
+            os.symlink(live, src)
+            rename(src, dst)
+
+        os.rename = replace
+        try:
+            self.assertFalse(lock(self.path, timeout=0).acquire())
+        finally:
+            os.rename = rename
+        self.assertEqual(os.readlink(self.path + u'.lock'), live)
+        self.assertEqual(os.listdir(self.tempdir), [u'file.lock'])
+
+    def test_inotify_wakeup(self):
+        """
+        Test that waiters are woken up on release instead of waiting for the
+        next poll.
+        """
+        self._hold(self.host, os.getppid())
+        t = threading.Timer(0.2, os.remove, [self.path + u'.lock'])
+        t.start()
+        l = lock(self.path, min_wait=10, max_wait=10, timeout=20,
+                 inotify=True)
+        start = time.time()
+        self.assertTrue(l.acquire())
+        t.join()
+        self.assertLess(time.time() - start, 5)
+
+
+class RWLockTest(unittest.TestCase):
+
+    """
+    Tests the reader-writer lock.
+    """
+
+    def setUp(self):
+        self.tempdir = unicode(tempfile.mkdtemp())
+        self.path = os.path.join(self.tempdir, u'file')
+        self.host = unicode(os.uname()[1])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _reader(self, host, pid):
+        readers = self.path + u'.lock.readers'
+        if not os.path.isdir(readers):
+            os.mkdir(readers)
+        reader = os.path.join(readers, u'{}.{}.0.shared'.format(host, pid))
+        os.symlink(u'{}.{}.lock'.format(host, pid), reader)
+        return reader
+
+    def test_shared(self):
+        """
+        Test that multiple shared locks are held at the same time.
+        """
+        a = rwlock(self.path, shared=True)
+        b = rwlock(self.path, shared=True)
+        self.assertTrue(a.acquire(timeout=0.1))
+        self.assertTrue(b.acquire(timeout=0.1))
+        self.assertEqual(os.listdir(self.tempdir), [u'file.lock.readers'])
+        self.assertEqual(len(os.listdir(self.path + u'.lock.readers')), 2)
+        self.assertTrue(a.release())
+        self.assertTrue(b.release())
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_writer_lists_own_readers(self):
+        """
+        Test that writers only list the reader links of their file.
+        """
+        for i in range(10):
+            os.symlink(u'foo', os.path.join(self.tempdir,
+                                            u'{}.shared'.format(i)))
+        self._reader(self.host, os.getppid())
+        listed = []
+        listdir = os.listdir
+
+        def count(path):
+            listed.append(path)
+            return listdir(path)
+
+        os.listdir = count
+        try:
+            self.assertFalse(rwlock(self.path).acquire(timeout=0.05))
+        finally:
+            os.listdir = listdir
+        self.assertTrue(listed)
+        self.assertEqual(set(listed), set([self.path + u'.lock.readers']))
+
+    def test_writer_excludes_readers(self):
+        """
+        Test that no shared lock is granted while a writer holds or waits for
+        the lock.
+        """
+        os.symlink(u'{}.{}.lock'.format(self.host, os.getppid()),
+                   self.path + u'.lock')
+        with self.assertRaises(NidabaLockTimeoutException):
+            with rwlock(self.path, shared=True, timeout=0.1):
+                pass
+        self.assertEqual(os.listdir(self.tempdir), [u'file.lock'])
+
+    def test_readers_exclude_writer(self):
+        """
+        Test that a writer waits for readers and withdraws on timeout.
+        """
+        self._reader(self.host, os.getppid())
+        w = rwlock(self.path)
+        self.assertFalse(w.acquire(timeout=0.1))
+        self.assertFalse(os.path.lexists(self.path + u'.lock'))
+        r = rwlock(self.path, shared=True)
+        self.assertTrue(r.acquire(timeout=0.1))
+        r.release()
+
+    def test_writer_preference(self):
+        """
+        Test that a waiting writer gets the lock once the readers have left,
+        before new readers.
+        """
+        reader = self._reader(self.host, os.getppid())
+        t = threading.Timer(0.2, os.remove, [reader])
+        t.start()
+        w = rwlock(self.path, timeout=5)
+        self.assertTrue(w.acquire())
+        t.join()
+        self.assertFalse(rwlock(self.path, shared=True).acquire(timeout=0))
+        self.assertTrue(w.release())
+
+    def test_stale_reader(self):
+        """
+        Test that links of dead readers are broken.
+        """
+        p = subprocess.Popen(['true'])
+        p.wait()
+        self._reader(self.host, p.pid)
+        w = rwlock(self.path, timeout=1)
+        self.assertTrue(w.acquire())
+        self.assertEqual(os.listdir(self.tempdir), [u'file.lock'])
+        w.release()
@@ -1,7 +1,39 @@
 # -*- coding: utf-8 -*-
 import unittest
+import os
+import shutil
+import tempfile
+import json
+
+from itertools import product
+from PIL import Image
+
+from celery import chain, group
+from celery.backends.redis import RedisBackend
 
 from nidaba import nidaba
+from nidaba.celery import app
+from nidaba.config import nidaba_cfg
+from nidaba.tasks import util, helper
+from nidaba.tasks.helper import NidabaTask
+from nidaba.nidabaexceptions import (NidabaInvalidParameterException,
+                                     NidabaStepException,
+                                     NidabaNoSuchAlgorithmException,
+                                     NidabaConfigException)
+
+
+@app.task(base=NidabaTask, name=u'nidaba.test.append')
+def append(doc, method=u'test.append', suffix=u''):
+    return doc + suffix
+
+
+joined = []
+
+
+@app.task(base=NidabaTask, name=u'nidaba.test.join')
+def join(doc, method=u'test.join'):
+    joined.append(doc)
+    return sorted(doc)
 
 
 class BatchTest(unittest.TestCase):
@@ -32,5 +64,528 @@ class BatchTest(unittest.TestCase):
     def test_multiple_steps(self):
         pass
 
+
+class RunTest(unittest.TestCase):
+
+    """Tests running batches eagerly."""
+
+    def setUp(self):
+        self.storage_path = nidaba_cfg['storage_path']
+        self.tempdir = unicode(tempfile.mkdtemp())
+        nidaba_cfg['storage_path'] = self.tempdir
+        os.mkdir(os.path.join(self.tempdir, u'job'))
+        im = Image.new('RGB', (40, 30), (200, 180, 160))
+        im.paste((20, 20, 20), (10, 10, 30, 20))
+        im.save(os.path.join(self.tempdir, u'job', u'input.png'))
+        self.records = {u'job': json.dumps({'task_ids': []})}
+        self.backend = app.backend.set, app.backend.get
+        app.backend.set = self.records.__setitem__
+        app.backend.get = self.records.get
+        app.conf.CELERY_ALWAYS_EAGER = True
+        app.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+        self.fmt = nidaba_cfg.get('intermediate_format')
+        helper._local_hashes.clear()
+        helper._local_lists.clear()
+        helper._local_sets.clear()
+
+    def tearDown(self):
+        nidaba_cfg['intermediate_format'] = self.fmt
+        app.conf.CELERY_ALWAYS_EAGER = False
+        app.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS = False
+        app.backend.set, app.backend.get = self.backend
+        nidaba_cfg['storage_path'] = self.storage_path
+        shutil.rmtree(self.tempdir)
+
+    def test_fuse_sequence(self):
+        """
+        Test that only runs of two or more fusable tasks are fused.
+        """
+        seq = [{u'method': u'img.rgb_to_gray', u'id': u'a'},
+               {u'method': u'binarize.otsu', u'id': u'a'},
+               {u'method': u'ocr.tesseract', u'id': u'a'},
+               {u'method': u'img.deskew', u'id': u'a'}]
+        fused = nidaba._fuse_sequence(seq)
+        self.assertEqual(fused[0], {u'method': u'img.pipeline', u'id': u'a',
+                                    u'steps': [{u'method': u'img.rgb_to_gray'},
+                                               {u'method': u'binarize.otsu'}]})
+        self.assertEqual(fused[1:], seq[2:])
+
+    def test_run_fused(self):
+        """
+        Test that a fused batch only writes the final output.
+        """
+        batch = nidaba.Batch(u'job')
+        batch.add_document((u'job', u'input.png'))
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        batch.add_tick()
+        batch.add_task(u'binarize.nlbin', zoom=1.0)
+        batch.run(fuse=True)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir,
+                                                        u'job'))),
+                         [u'input.png',
+                          u'input_img.rgb_to_gray_binarize.nlbin_0.5_1.0_1.0_'
+                          u'0.1_80_20_5_90.png'])
+
+    def test_run_sweep(self):
+        """
+        Test that the outputs of a merged nlbin sweep are passed on to their
+        following tasks.
+        """
+        batch = nidaba.Batch(u'job')
+        batch.add_document((u'job', u'input.png'))
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        batch.add_tick()
+        batch.add_task(u'binarize.nlbin', zoom=1.0, threshold=0.4)
+        batch.add_task(u'binarize.nlbin', zoom=1.0, threshold=0.6)
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        batch.run()
+        prefix = u'input_img.rgb_to_gray_binarize.nlbin_'
+        suffix = u'_1.0_1.0_0.1_80_20_5_90'
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir,
+                                                        u'job'))),
+                         [u'input.png', u'input_img.rgb_to_gray.png'] +
+                         [prefix + t + suffix + x for t in (u'0.4', u'0.6')
+                          for x in (u'.png', u'_img.rgb_to_gray.png')])
+
+    def test_run_intermediate(self):
+        """
+        Test that only outputs read by later tasks are intermediate.
+        """
+        nidaba_cfg['intermediate_format'] = u'pnm'
+        batch = nidaba.Batch(u'job')
+        batch.add_document((u'job', u'input.png'))
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        batch.add_tick()
+        batch.add_task(u'binarize.nlbin', zoom=1.0)
+        batch.run()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir,
+                                                        u'job'))),
+                         [u'input.png', u'input_img.rgb_to_gray.png.pnm',
+                          u'input_img.rgb_to_gray_binarize.nlbin_0.5_1.0_1.0_'
+                          u'0.1_80_20_5_90.png'])
+
+    def test_run_chunked(self):
+        """
+        Test that all documents are submitted when publishing chunks in
+        parallel.
+        """
+        shutil.copy(os.path.join(self.tempdir, u'job', u'input.png'),
+                    os.path.join(self.tempdir, u'job', u'input2.png'))
+        batch = nidaba.Batch(u'job')
+        batch.add_document((u'job', u'input.png'))
+        batch.add_document((u'job', u'input2.png'))
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        batch.run(chunk_size=1, threads=2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir,
+                                                        u'job'))),
+                         [u'input.png', u'input2.png', u'input2_img.'
+                          u'rgb_to_gray.png', u'input_img.rgb_to_gray.png'])
+        docs = batch.get_documents()
+        self.assertEqual([d[u'doc'] for d in docs], [[u'job', u'input.png'],
+                                                     [u'job', u'input2.png']])
+        self.assertEqual(len(set(d[u'task_id'] for d in docs)), 2)
+        self.assertEqual(batch.get_state(), u'SUCCESS')
+        self.assertEqual(len(batch.get_results()), 2)
+
+    def test_run_iterator(self):
+        """
+        Test that documents yielded by an iterator are submitted as they
+        become available.
+        """
+        batch = nidaba.Batch(u'job')
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        submitted = []
+
+        def docs():
+            for name in (u'input.png', u'input2.png', u'input3.png'):
+                # the previous document has already been processed
+                submitted.append(sorted(os.listdir(os.path.join(
+                    self.tempdir, u'job'))))
+                if name != u'input.png':
+                    shutil.copy(os.path.join(self.tempdir, u'job',
+                                             u'input.png'),
+                                os.path.join(self.tempdir, u'job', name))
+                yield (u'job', name)
+
+        batch.run(chunk_size=1, docs=docs(), count=3)
+        self.assertIn(u'input_img.rgb_to_gray.png', submitted[1])
+        self.assertEqual([d[u'doc'][1] for d in batch.get_documents()],
+                         [u'input.png', u'input2.png', u'input3.png'])
+        self.assertEqual(batch.get_state(), u'SUCCESS')
+        self.assertEqual(len(batch.get_results()), 3)
+
+    def test_run_later_steps(self):
+        """
+        Test that later steps run once on the outputs of all documents.
+        """
+        shutil.copy(os.path.join(self.tempdir, u'job', u'input.png'),
+                    os.path.join(self.tempdir, u'job', u'input2.png'))
+        del joined[:]
+        batch = nidaba.Batch(u'job')
+        batch.add_document((u'job', u'input.png'))
+        batch.add_document((u'job', u'input2.png'))
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'test.join')
+        batch.run()
+        outputs = [[u'job', u'input2_img.rgb_to_gray.png'],
+                   [u'job', u'input_img.rgb_to_gray.png']]
+        self.assertEqual(len(joined), 1)
+        self.assertEqual(sorted(joined[0]), outputs)
+        self.assertEqual(batch.get_state(), u'SUCCESS')
+        self.assertEqual(batch.get_results(), [{u'doc': outputs}])
+        self.assertEqual(list(batch.iter_results())[-1], {u'doc': outputs})
+
+    def test_compiled_pipeline(self):
+        """
+        Test that a compiled pipeline runs for different batches.
+        """
+        os.mkdir(os.path.join(self.tempdir, u'job2'))
+        shutil.copy(os.path.join(self.tempdir, u'job', u'input.png'),
+                    os.path.join(self.tempdir, u'job2', u'input.png'))
+        batch = nidaba.Batch(u'job')
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        batch.add_tick()
+        batch.add_task(u'binarize.otsu')
+        pipeline = batch.compile()
+        for id in (u'job', u'job2'):
+            pipeline.run(id, [(id, u'input.png')])
+            ret = nidaba.Batch(id).get_results()[0]
+            self.assertEqual(ret[u'doc'][0][u'id'], id)
+            self.assertEqual(ret[u'doc'][0][u'doc'],
+                             [id, u'input_img.rgb_to_gray_binarize.otsu_100_'
+                              u'50_255_2_2.png'])
+
+    def test_compile_invalid(self):
+        """
+        Test that invalid definitions are rejected on compilation.
+        """
+        with self.assertRaises(NidabaStepException):
+            nidaba.Pipeline([])
+        with self.assertRaises(NidabaNoSuchAlgorithmException):
+            nidaba.Pipeline([[[{u'method': u'img.nonexistent'}]]])
+
+    def test_progress(self):
+        """
+        Test that finished and failed tasks are counted per method.
+        """
+        batch = nidaba.Batch(u'job')
+        batch.add_document((u'job', u'input.png'))
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        batch.add_tick()
+        batch.add_task(u'binarize.otsu')
+        batch.add_task(u'binarize.sauvola', whsize=1, factor=5.0)
+        with self.assertRaises(NidabaInvalidParameterException):
+            batch.run()
+        progress = batch.get_progress()
+        self.assertEqual(progress[u'img.rgb_to_gray'],
+                         {u'running': 0, u'done': 1, u'failed': 0})
+        self.assertEqual(progress[u'binarize.sauvola'],
+                         {u'running': 0, u'done': 0, u'failed': 1})
+
+    def test_errors(self):
+        """
+        Test that errors are appended to the error list and read in pages.
+        """
+        batch = nidaba.Batch(u'job')
+        batch.add_document((u'job', u'input.png'))
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'binarize.sauvola', whsize=1, factor=5.0)
+        batch.add_task(u'binarize.sauvola', whsize=2, factor=5.0)
+        app.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS = False
+        with self.assertRaises(NidabaInvalidParameterException):
+            batch.run()
+        self.assertEqual(batch.get_state(), u'FAILURE')
+        errors = batch.get_errors()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(errors[0][1][u'id'], u'job')
+        self.assertEqual(batch.get_errors(1, 5), errors[1:])
+        self.assertEqual(batch.get_errors(0, 1), errors[:1])
+        self.assertIsNone(batch.get_errors(2))
+
+    def test_failure_inside_group(self):
+        """
+        Test that a document is marked as failed when a task before its last
+        one fails, so following its results terminates.
+        """
+        batch = nidaba.Batch(u'job')
+        batch.add_document((u'job', u'input.png'))
+        batch.add_step()
+        batch.add_tick()
+        batch.add_task(u'binarize.sauvola', whsize=1, factor=5.0)
+        batch.add_tick()
+        batch.add_task(u'img.rgb_to_gray')
+        app.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS = False
+        try:
+            batch.run()
+        except NidabaInvalidParameterException:
+            pass
+        self.assertEqual(batch.get_documents()[0][u'state'], u'FAILURE')
+        self.assertEqual(list(batch.iter_results(interval=0)), [])
+
+
+class TrieTest(unittest.TestCase):
+
+    """Tests the prefix tree expansion of batch definitions."""
+
+    def setUp(self):
+        self.ticks = [[{u'method': u'img.rgb_to_gray', u'id': u'a'}],
+                      [{u'method': u'binarize.otsu', u'id': u'a'},
+                       {u'method': u'binarize.sauvola', u'id': u'a'}],
+                      [{u'method': u'ocr.tesseract', u'id': u'a',
+                        u'languages': [l]} for l in (u'eng', u'grc')]]
+
+    def _count(self, level):
+        return sum(1 + self._count(c) for k, c in level.itervalues())
+
+    def test_shared_prefixes(self):
+        """
+        Test that each distinct task prefix is only expanded once.
+        """
+        trie = nidaba._build_trie(product(*self.ticks))
+        self.assertEqual(len(trie), 1)
+        kwargs, children = trie.values()[0]
+        self.assertEqual(kwargs[u'method'], u'img.rgb_to_gray')
+        self.assertEqual(len(children), 2)
+        self.assertEqual(self._count(trie), 7)
+
+    def test_fuse_single_child(self):
+        """
+        Test that a fusable node with a single fusable child is fused.
+        """
+        trie = nidaba._build_trie(product(self.ticks[0], self.ticks[1][:1],
+                                          self.ticks[2]), True)
+        self.assertEqual(len(trie), 1)
+        kwargs, children = trie.values()[0]
+        self.assertEqual(kwargs[u'method'], u'img.pipeline')
+        self.assertEqual([s[u'method'] for s in kwargs[u'steps']],
+                         [u'img.rgb_to_gray', u'binarize.otsu'])
+        self.assertEqual([k[u'method'] for k, c in children.itervalues()],
+                         [u'ocr.tesseract', u'ocr.tesseract'])
+
+    def test_no_fuse_multiple_children(self):
+        """
+        Test that a node with multiple children is not fused.
+        """
+        trie = nidaba._build_trie(product(*self.ticks[:2]), True)
+        kwargs, children = trie.values()[0]
+        self.assertEqual(kwargs[u'method'], u'img.rgb_to_gray')
+        self.assertEqual([k[u'method'] for k, c in children.itervalues()],
+                         [u'binarize.otsu', u'binarize.sauvola'])
+
+    def test_flatten(self):
+        """
+        Test that nested lists of outputs are flattened.
+        """
+        docs = [[{u'doc': 1}, [{u'doc': 2}]], {u'doc': 3}]
+        flat = [{u'doc': 1}, {u'doc': 2}, {u'doc': 3}]
+        self.assertEqual(util.gather(docs), flat)
+        self.assertEqual(util.sync(docs), {u'doc': flat})
+
+    def test_branch_signature(self):
+        """
+        Test that a branching node is chained to a group of its children
+        joined by gather.
+        """
+        trie = nidaba._build_trie(product(*self.ticks[:2]))
+        sig = nidaba._trie_signature(*trie.values()[0])
+        self.assertIsInstance(sig, chain)
+        self.assertEqual(len(sig.tasks), 3)
+        self.assertEqual(sig.tasks[0].task, u'nidaba.img.rgb_to_gray')
+        self.assertIsInstance(sig.tasks[1], group)
+        self.assertEqual(sig.tasks[2].task, u'nidaba.util.gather')
+
+    def test_intermediate_outputs(self):
+        """
+        Test that only outputs read by later tasks are intermediate.
+        """
+        trie = nidaba._build_trie(product(*self.ticks[:2]))
+        sig = nidaba._trie_signature(*trie.values()[0])
+        self.assertTrue(sig.tasks[0].kwargs[u'intermediate'])
+        for leaf in sig.tasks[1].tasks:
+            self.assertNotIn(u'intermediate', leaf.kwargs)
+        sig = nidaba._trie_signature(*trie.values()[0], consumed=True)
+        for leaf in sig.tasks[1].tasks:
+            self.assertTrue(leaf.kwargs[u'intermediate'])
+
+    def test_nlbin_sweep(self):
+        """
+        Test that nlbin tasks on the same input are merged into a sweep.
+        """
+        ticks = [self.ticks[0],
+                 [{u'method': u'binarize.nlbin', u'id': u'a',
+                   u'threshold': t} for t in (0.3, 0.6)] + self.ticks[1][:1]]
+        trie = nidaba._build_trie(product(*ticks))
+        sig = nidaba._trie_signature(*trie.values()[0])
+        subs = sig.tasks[1].tasks
+        self.assertEqual(subs[0].task, u'nidaba.binarize.otsu')
+        sweep = subs[1]
+        self.assertEqual(sweep.tasks[0].task, u'nidaba.binarize.nlbin_sweep')
+        self.assertEqual([v[u'threshold'] for v in
+                          sweep.tasks[0].kwargs[u'variants']], [0.3, 0.6])
+        self.assertEqual([p.kwargs[u'index'] for p in sweep.tasks[1].tasks],
+                         [0, 1])
+
+    def test_branch_execution(self):
+        """
+        Test that the outputs of all leaves of a prefix tree nested in an
+        outer group are joined into a single flat list.
+        """
+        ticks = [[{u'method': u'test.append', u'suffix': s}] for s in u'ab']
+        ticks[1].append({u'method': u'test.append', u'suffix': u'c'})
+        ticks.append([{u'method': u'test.append', u'suffix': s} for s in
+                      u'de'])
+        trie = nidaba._build_trie(product(*ticks))
+        tick = [nidaba._trie_signature(k, c, doc=u'x') for k, c in
+                trie.itervalues()]
+        res = chain(group(tick), util.sync.s()).apply().get()
+        self.assertEqual(sorted(d[u'doc'] for d in res[u'doc']),
+                         [u'xabd', u'xabe', u'xacd', u'xace'])
+
+
+class ResultBackendTest(unittest.TestCase):
+
+    """Tests the selection of the storage of records and counters."""
+
+    def tearDown(self):
+        app.conf.CELERY_ALWAYS_EAGER = False
+        helper.RedisBackend = RedisBackend
+
+    def test_eager(self):
+        """
+        Test that records are kept in the process when running eagerly.
+        """
+        app.conf.CELERY_ALWAYS_EAGER = True
+        helper._local_lists.clear()
+        helper.append_records(u'job-errors', [u'a'])
+        self.assertEqual(helper.get_records(u'job-errors'), [u'a'])
+
+    def test_unsupported_backend(self):
+        """
+        Test that other result backends are rejected instead of keeping
+        records in the process.
+        """
+        helper.RedisBackend = type('OtherBackend', (object,), {})
+        with self.assertRaises(NidabaConfigException):
+            helper.append_records(u'job-errors', [u'a'])
+        with self.assertRaises(NidabaConfigException):
+            helper.incr_counters(u'job-progress', {u'a:done': 1})
+
+
+class StateTest(unittest.TestCase):
+
+    """Tests retrieving the state and results from the batch record."""
+
+    def setUp(self):
+        self.records = {}
+        self.backend = app.backend.get
+        app.backend.get = self.records.get
+        self.records[u'job'] = json.dumps({u'documents': 2})
+        app.conf.CELERY_ALWAYS_EAGER = True
+        helper._local_lists.clear()
+        helper._local_hashes.clear()
+        helper._local_sets.clear()
+
+    def tearDown(self):
+        app.conf.CELERY_ALWAYS_EAGER = False
+        app.backend.get = self.backend
+
+    def test_state(self):
+        """
+        Test that the batch state follows the finished documents.
+        """
+        batch = nidaba.Batch(u'job')
+        self.assertEqual(batch.get_state(), u'PENDING')
+        util.finish([u'job', u'a.png'], u'job', 0)
+        self.assertEqual(batch.get_state(), u'PENDING')
+        util.finish([u'job', u'b.png'], u'job', 1)
+        self.assertEqual(batch.get_state(), u'SUCCESS')
+        self.assertEqual(batch.get_results(), [[u'job', u'a.png'],
+                                               [u'job', u'b.png']])
+        self.assertEqual(nidaba.Batch(u'unknown').get_state(), u'NONE')
+
+    def test_documents(self):
+        """
+        Test that slices of document entries are retrieved.
+        """
+        util.fail(u'task', u'job', 1)
+        docs = nidaba.Batch(u'job').get_documents(1, 5)
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0][u'state'], u'FAILURE')
+        self.assertIsNone(docs[0][u'result'])
+
+    def test_iter_results(self):
+        """
+        Test that results are yielded in order of completion.
+        """
+        util.finish([u'job', u'b.png'], u'job', 1)
+        batch = nidaba.Batch(u'job')
+        results = batch.iter_results(interval=0, max_interval=0)
+        self.assertEqual(next(results), [u'job', u'b.png'])
+        util.finish([u'job', u'a.png'], u'job', 0)
+        self.assertEqual(list(results), [[u'job', u'a.png']])
+
+    def _later_steps(self):
+        self.records[u'job'] = json.dumps({u'documents': 2,
+                                           u'later_steps': True})
+        helper.set_fields(helper.documents_key(u'job'), {
+            u'steps': json.dumps(dict(join.s(id=u'job')))})
+        del joined[:]
+
+    def test_later_steps_redelivery(self):
+        """
+        Test that later steps start once when documents finish repeatedly.
+        """
+        self._later_steps()
+        util.finish({u'doc': [u'job', u'a.png']}, u'job', 0, 2)
+        util.finish({u'doc': [u'job', u'a.png']}, u'job', 0, 2)
+        self.assertEqual(nidaba.Batch(u'job').get_state(), u'PENDING')
+        util.finish({u'doc': [u'job', u'b.png']}, u'job', 1, 2)
+        util.finish({u'doc': [u'job', u'b.png']}, u'job', 1, 2)
+        self.assertEqual(joined, [[[u'job', u'a.png'], [u'job', u'b.png']]])
+
+    def test_later_steps_failure(self):
+        """
+        Test that failed documents count towards completion and fail the
+        later steps.
+        """
+        self._later_steps()
+        batch = nidaba.Batch(u'job')
+        util.finish({u'doc': [u'job', u'a.png']}, u'job', 0, 2)
+        helper.fail_document(u'job', 1)
+        self.assertEqual(joined, [])
+        self.assertEqual(batch.get_state(), u'FAILURE')
+        self.assertEqual(batch.get_documents()[1][u'state'], u'FAILURE')
+        self.assertEqual(list(batch.iter_results(interval=0)),
+                         [{u'doc': [u'job', u'a.png']}])
+
+    def test_iter_results_failure(self):
+        """
+        Test that failed documents are skipped.
+        """
+        util.fail(u'task', u'job', 0)
+        util.finish([u'job', u'b.png'], u'job', 1)
+        batch = nidaba.Batch(u'job')
+        self.assertEqual(list(batch.iter_results()), [[u'job', u'b.png']])
+
 if __name__ == '__main__':
     unittest.main()
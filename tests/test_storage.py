@@ -0,0 +1,601 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import gzip
+import tempfile
+import numpy
+
+from lxml import etree
+from PIL import Image
+
+from nidaba import storage
+from nidaba.config import nidaba_cfg
+from nidaba.lock import rwlock
+from nidaba.nidabaexceptions import (NidabaStorageViolationException,
+                                     NidabaLockTimeoutException)
+
+
+class FilesystemBackendTest(unittest.TestCase):
+
+    """
+    Tests the storage functions on the filesystem backend.
+    """
+
+    def setUp(self):
+        self.storage_path = nidaba_cfg['storage_path']
+        self.tempdir = unicode(tempfile.mkdtemp())
+        nidaba_cfg['storage_path'] = self.tempdir
+        storage.prepare_filestore(u'job')
+
+    def tearDown(self):
+        nidaba_cfg['storage_path'] = self.storage_path
+        shutil.rmtree(self.tempdir)
+
+    def test_roundtrip(self):
+        """
+        Test that written content is read back and listed.
+        """
+        self.assertEqual(storage.write_content(u'job', u'a.txt', b'abc'), 3)
+        self.assertTrue(storage.is_file(u'job', u'a.txt'))
+        self.assertEqual(storage.retrieve_content(u'job', u'a.txt'),
+                         {u'a.txt': b'abc'})
+        self.assertEqual(storage.list_content(u'job'), [u'a.txt'])
+        self.assertEqual(storage.get_storage_path(
+            storage.get_abs_path(u'job', u'a.txt')), (u'job', u'a.txt'))
+
+    def test_path_violation(self):
+        """
+        Test that paths outside of the job directory are rejected.
+        """
+        with self.assertRaises(NidabaStorageViolationException):
+            storage.get_abs_path(u'job', u'../other/a.txt')
+
+    def test_resolve(self):
+        """
+        Test that the string concatenation fast path agrees with
+        _sanitize_path.
+        """
+        for path in ([u'a.txt'], [u'sub/a.txt'], [u'sub', u'a.txt'],
+                     [u'./a.txt'], [u'sub/../a.txt'], [u'sub//a.txt'],
+                     [u'sub/']):
+            self.assertEqual(storage.get_abs_path(u'job', *path),
+                             storage._sanitize_path(storage._sanitize_path(
+                                 self.tempdir, u'job'), *path))
+        for job, path in ((u'job', u'/a.txt'), (u'job', u'..'),
+                          (u'job', u'sub/../../a.txt'), (u'..', u'a.txt'),
+                          (u'../job', u'a.txt'), (u'/', u'a.txt')):
+            with self.assertRaises(NidabaStorageViolationException):
+                storage.get_abs_path(job, path)
+        for path in (u'a.txt', u'sub/a.txt', u'./sub/../a.txt'):
+            self.assertEqual(storage.get_storage_path(
+                os.path.join(self.tempdir, u'job', path)),
+                (u'job', path))
+
+    def test_valid_job_cache(self):
+        """
+        Test that existing job directories are only checked once.
+        """
+        backend = storage.get_backend()
+        self.assertIn((self.tempdir, u'job'), backend._valid_jobs)
+        self.assertFalse(storage.is_valid_job(u'other'))
+        self.assertNotIn((self.tempdir, u'other'), backend._valid_jobs)
+        os.mkdir(os.path.join(self.tempdir, u'other'))
+        self.assertTrue(storage.is_valid_job(u'other'))
+        self.assertIn((self.tempdir, u'other'), backend._valid_jobs)
+
+    def test_atomic_replace(self):
+        """
+        Test that writes replace the file by renaming, leaving no temporary
+        files behind.
+        """
+        storage.write_content(u'job', u'a.txt', b'abc')
+        path = storage.get_abs_path(u'job', u'a.txt')
+        with open(path, 'rb') as fp:
+            storage.write_content(u'job', u'a.txt', b'defg')
+            # an open reader keeps the previous content
+            self.assertEqual(fp.read(), b'abc')
+        self.assertEqual(storage.retrieve_content(u'job', u'a.txt'),
+                         {u'a.txt': b'defg'})
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         [u'.manifest', u'a.txt'])
+
+    def test_fsync(self):
+        """
+        Test writing with fsync enabled.
+        """
+        nidaba_cfg['storage_fsync'] = True
+        try:
+            self.assertEqual(storage.write_content(u'job', u'a.txt', b'abc'),
+                             3)
+        finally:
+            del nidaba_cfg['storage_fsync']
+        self.assertEqual(storage.retrieve_content(u'job', u'a.txt'),
+                         {u'a.txt': b'abc'})
+
+    def test_locking(self):
+        """
+        Test that reads and writes take reader-writer locks if enabled.
+        """
+        nidaba_cfg['storage_locking'] = True
+        nidaba_cfg['lock'] = {u'timeout': 0.1}
+        try:
+            storage.write_content(u'job', u'a.txt', b'abc')
+            storage.write_content(u'job', u'b.txt', b'def')
+            path = storage.get_abs_path(u'job', u'a.txt')
+            with rwlock(path, shared=True):
+                self.assertEqual(storage.retrieve_content(u'job', [u'a.txt',
+                                                                   u'b.txt']),
+                                 {u'a.txt': b'abc', u'b.txt': b'def'})
+                self.assertIsNone(storage.write_content(u'job', u'a.txt',
+                                                        b'ghi'))
+            with rwlock(path):
+                with self.assertRaises(NidabaLockTimeoutException):
+                    storage.retrieve_content(u'job', u'a.txt')
+            self.assertEqual(storage.write_content(u'job', u'a.txt', b'ghi'),
+                             3)
+            self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                             [u'.manifest', u'a.txt', u'b.txt'])
+        finally:
+            del nidaba_cfg['storage_locking']
+            del nidaba_cfg['lock']
+
+    def test_retrieve_buffer(self):
+        """
+        Test that buffers map the files and keep their content when the files
+        are replaced.
+        """
+        storage.write_content(u'job', u'a.raw', b'\x00\x01\x02\x03\x04\x05')
+        storage.write_content(u'job', u'empty', b'')
+        bufs = storage.retrieve_buffer(u'job', [u'a.raw', u'empty'])
+        self.assertEqual(bufs[u'empty'].tobytes(), b'')
+        buf = bufs[u'a.raw']
+        self.assertTrue(buf.readonly)
+        storage.write_content(u'job', u'a.raw', b'abc')
+        self.assertEqual(buf.tobytes(), b'\x00\x01\x02\x03\x04\x05')
+        a = numpy.asarray(buf)
+        self.assertEqual(a.sum(), 15)
+        im = Image.frombuffer('L', (3, 2), buf, 'raw', 'L', 0, 1)
+        self.assertEqual(im.getpixel((2, 1)), 5)
+        self.assertIsNone(storage.retrieve_buffer(u'nojob', u'a.raw'))
+
+    def test_open_stream(self):
+        """
+        Test reading a document as a stream.
+        """
+        storage.write_content(u'job', u'a.xml', b'<a><b/></a>')
+        with storage.open_stream(u'job', u'a.xml', chunk_size=4) as fp:
+            self.assertEqual(etree.parse(fp).getroot()[0].tag, 'b')
+        with storage.open_stream(u'job', u'a.xml') as fp:
+            self.assertEqual(fp.read(3), b'<a>')
+
+    def test_manifest(self):
+        """
+        Test that writes and persisted task outputs are recorded in the
+        manifest.
+        """
+        storage.write_content(u'job', u'a.txt', b'abc')
+        os.mkdir(storage.get_abs_path(u'job', u'sub'))
+        storage.write_content(u'job', u'sub/b.txt', b'de')
+        with open(storage.get_abs_path(u'job', u'c.txt'), 'wb') as fp:
+            fp.write(b'f')
+        storage.persist(u'job', u'c.txt', u'nidaba.test')
+        # not written through the storage module
+        with open(storage.get_abs_path(u'job', u'd.txt'), 'wb') as fp:
+            fp.write(b'g')
+        storage.write_content(u'job', u'a.txt', b'abcd')
+        manifest = storage.get_manifest(u'job')
+        self.assertEqual(sorted(manifest), [u'a.txt', u'c.txt', u'sub/b.txt'])
+        self.assertEqual(manifest[u'a.txt'][u'size'], 4)
+        self.assertEqual(manifest[u'c.txt'][u'task'], u'nidaba.test')
+        self.assertEqual(storage.list_content(u'job', u'sub/*'),
+                         [u'sub/b.txt'])
+
+    def test_manifest_rebuild(self):
+        """
+        Test that the manifest of a job without one is built from the job
+        directory.
+        """
+        os.mkdir(os.path.join(self.tempdir, u'old'))
+        os.mkdir(os.path.join(self.tempdir, u'old', u'sub'))
+        for path in (u'a.txt', u'sub/b.txt', u'c.txt' + storage.tmp_suffix):
+            with open(os.path.join(self.tempdir, u'old', path), 'wb') as fp:
+                fp.write(b'abc')
+        self.assertEqual(sorted(storage.list_content(u'old')),
+                         [u'a.txt', u'sub/b.txt'])
+        storage.write_content(u'old', u'd.txt', b'abc')
+        self.assertEqual(sorted(storage.list_content(u'old')),
+                         [u'a.txt', u'd.txt', u'sub/b.txt'])
+
+    def test_ingest(self):
+        """
+        Test adding files by hard linking and copying.
+        """
+        src = os.path.join(self.tempdir, u'src.txt')
+        with open(src, 'wb') as fp:
+            fp.write(b'abc')
+        self.assertEqual(storage.ingest(src, u'job', u'a.txt', u'link'),
+                         u'link')
+        self.assertEqual(storage.ingest(src, u'job', u'b.txt', u'copy',
+                                        buffer_size=2), u'copy')
+        self.assertIn(storage.ingest(src, u'job', u'c.txt'),
+                      (u'reflink', u'copy'))
+        a = os.stat(storage.get_abs_path(u'job', u'a.txt'))
+        b = os.stat(storage.get_abs_path(u'job', u'b.txt'))
+        c = os.stat(storage.get_abs_path(u'job', u'c.txt'))
+        self.assertNotEqual(c.st_ino, os.stat(src).st_ino)
+        self.assertEqual(a.st_ino, os.stat(src).st_ino)
+        self.assertNotEqual(b.st_ino, os.stat(src).st_ino)
+        self.assertEqual(int(b.st_mtime), int(os.stat(src).st_mtime))
+        self.assertEqual(storage.retrieve_content(u'job', u'b.txt'),
+                         {u'b.txt': b'abc'})
+        self.assertEqual(sorted(storage.list_content(u'job')),
+                         [u'a.txt', u'b.txt', u'c.txt'])
+        with self.assertRaises(OSError):
+            storage.ingest(src, u'job', u'a.txt', u'link')
+
+    def test_failed_write(self):
+        """
+        Test that failed writes leave neither the destination nor a temporary
+        file.
+        """
+        self.assertIsNone(storage.write_content(u'job', u'no/a.txt', b'abc'))
+        self.assertEqual(storage.list_content(u'job'), [])
+
+    def test_unknown_job(self):
+        """
+        Test that operations on unknown jobs fail.
+        """
+        self.assertFalse(storage.is_valid_job(u'nojob'))
+        self.assertIsNone(storage.write_content(u'nojob', u'a.txt', b'abc'))
+        self.assertIsNone(storage.list_content(u'nojob'))
+
+
+class CompressionTest(unittest.TestCase):
+
+    """
+    Tests transparent compression of designated documents.
+    """
+
+    def setUp(self):
+        self.storage_path = nidaba_cfg['storage_path']
+        self.tempdir = unicode(tempfile.mkdtemp())
+        nidaba_cfg['storage_path'] = self.tempdir
+        nidaba_cfg['compression'] = {u'codec': u'gzip',
+                                     u'patterns': [u'*.hocr', u'*.txt']}
+        storage.prepare_filestore(u'job')
+        self.text = u'<html>{}</html>'.format(u'Ἐν ἀρχῇ ἦν ὁ λόγος' * 100)
+
+    def tearDown(self):
+        nidaba_cfg['storage_path'] = self.storage_path
+        del nidaba_cfg['compression']
+        shutil.rmtree(self.tempdir)
+
+    def test_roundtrip(self):
+        """
+        Test that designated documents are stored compressed and read back
+        decompressed.
+        """
+        data = self.text.encode('utf-8')
+        self.assertEqual(storage.write_text(u'job', u'a.hocr', self.text),
+                         len(data))
+        path = storage.get_abs_path(u'job', u'a.hocr')
+        self.assertLess(os.path.getsize(path), len(data))
+        with gzip.open(path) as fp:
+            self.assertEqual(fp.read(), data)
+        self.assertEqual(storage.retrieve_text(u'job', u'a.hocr'),
+                         {u'a.hocr': self.text})
+        self.assertEqual(storage.retrieve_buffer(u'job', u'a.hocr')
+                         [u'a.hocr'].tobytes(), data)
+        with storage.open_stream(u'job', u'a.hocr', chunk_size=16) as fp:
+            self.assertEqual(fp.read(10), data[:10])
+            self.assertEqual(fp.read(), data[10:])
+        # lxml reads gzip compressed files itself
+        self.assertEqual(etree.parse(path).getroot().tag, 'html')
+
+    def test_zlib(self):
+        """
+        Test the zlib codec.
+        """
+        nidaba_cfg['compression'][u'codec'] = u'zlib'
+        storage.write_text(u'job', u'a.txt', self.text)
+        with open(storage.get_abs_path(u'job', u'a.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(1), b'\x78')
+        self.assertEqual(storage.retrieve_text(u'job', u'a.txt'),
+                         {u'a.txt': self.text})
+        with storage.open_stream(u'job', u'a.txt') as fp:
+            self.assertEqual(fp.read().decode('utf-8'), self.text)
+
+    def test_persist(self):
+        """
+        Test that designated task outputs are compressed when persisted.
+        """
+        data = self.text.encode('utf-8')
+        for doc in (u'a.hocr', u'a.xml'):
+            with open(storage.get_abs_path(u'job', doc), 'wb') as fp:
+                fp.write(data)
+            storage.persist(u'job', doc)
+        self.assertLess(os.path.getsize(storage.get_abs_path(u'job',
+                                                             u'a.hocr')),
+                        len(data))
+        self.assertEqual(os.path.getsize(storage.get_abs_path(u'job',
+                                                              u'a.xml')),
+                         len(data))
+        self.assertEqual(storage.retrieve_content(u'job', [u'a.hocr',
+                                                           u'a.xml']),
+                         {u'a.hocr': data, u'a.xml': data})
+        # persisting again doesn't compress twice
+        storage.persist(u'job', u'a.hocr')
+        self.assertEqual(storage.retrieve_content(u'job', u'a.hocr'),
+                         {u'a.hocr': data})
+
+    def test_opt_out(self):
+        """
+        Test that other and opted-out documents are stored uncompressed and
+        that uncompressed designated documents are read as is.
+        """
+        data = self.text.encode('utf-8')
+        storage.write_content(u'job', u'a.xml', data)
+        storage.write_content(u'job', u'b.xml', data, compress=True)
+        storage.write_content(u'job', u'a.txt', data, compress=False)
+        # looks like a zlib header
+        storage.write_content(u'job', u'b.txt', b'x^abc', compress=False)
+        for doc in (u'a.xml', u'b.xml', u'a.txt'):
+            self.assertEqual(os.path.getsize(storage.get_abs_path(u'job',
+                                                                  doc)),
+                             len(data))
+        self.assertEqual(storage.retrieve_content(u'job', [u'a.txt',
+                                                           u'b.txt']),
+                         {u'a.txt': data, u'b.txt': b'x^abc'})
+        with storage.open_stream(u'job', u'a.txt') as fp:
+            self.assertEqual(fp.read(), data)
+
+
+class ObjectStoreBackendTest(unittest.TestCase):
+
+    """
+    Tests the object store backend with an in-memory and a local store.
+    """
+
+    def setUp(self):
+        self.storage_path = nidaba_cfg['storage_path']
+        self.tempdir = unicode(tempfile.mkdtemp())
+        nidaba_cfg['storage_path'] = os.path.join(self.tempdir, u'local')
+        os.mkdir(nidaba_cfg['storage_path'])
+        nidaba_cfg['storage_backend'] = {u'type': u'objectstore',
+                                         u'store': u'memory'}
+        storage._backends.clear()
+
+    def tearDown(self):
+        nidaba_cfg['storage_path'] = self.storage_path
+        del nidaba_cfg['storage_backend']
+        storage._backends.clear()
+        shutil.rmtree(self.tempdir)
+
+    def test_roundtrip(self):
+        """
+        Test that written content is read back and listed.
+        """
+        self.assertEqual(storage.prepare_filestore(u'job'), u'job')
+        self.assertIsNone(storage.prepare_filestore(u'job'))
+        storage.write_content(u'job', u'a.txt', b'abc')
+        storage.write_content(u'job', u'sub/b.txt', b'abc')
+        self.assertTrue(storage.is_file(u'job', u'sub/b.txt'))
+        self.assertFalse(storage.is_file(u'job', u'c.txt'))
+        self.assertEqual(storage.retrieve_content(u'job', [u'a.txt',
+                                                           u'sub/b.txt']),
+                         {u'a.txt': b'abc', u'sub/b.txt': b'abc'})
+        self.assertEqual(sorted(storage.list_content(u'job')),
+                         [u'a.txt', u'sub/b.txt'])
+        self.assertEqual(storage.list_content(u'job', u'sub/*'),
+                         [u'sub/b.txt'])
+
+    def test_manifest(self):
+        """
+        Test that the manifest is built from the refs of a job.
+        """
+        storage.prepare_filestore(u'job')
+        storage.write_content(u'job', u'a.txt', b'abc')
+        with open(storage.get_abs_path(u'job', u'out.txt'), 'wb') as fp:
+            fp.write(b'defg')
+        storage.persist(u'job', u'out.txt', u'nidaba.test')
+        manifest = storage.get_manifest(u'job')
+        self.assertEqual(sorted(manifest), [u'a.txt', u'out.txt'])
+        self.assertEqual(manifest[u'a.txt'][u'size'], 3)
+        self.assertIsNone(manifest[u'a.txt'][u'task'])
+        self.assertEqual(manifest[u'out.txt'][u'size'], 4)
+        self.assertEqual(manifest[u'out.txt'][u'task'], u'nidaba.test')
+        self.assertIsNone(storage.get_manifest(u'nojob'))
+
+    def test_content_addressed(self):
+        """
+        Test that identical content is stored once.
+        """
+        storage.prepare_filestore(u'job')
+        storage.write_content(u'job', u'a.txt', b'abc')
+        storage.write_content(u'job', u'b.txt', b'abc')
+        store = storage.get_backend().store
+        self.assertEqual(len(store.list(u'objects/')), 1)
+
+    def test_materialize(self):
+        """
+        Test that stored files are materialized in the local storage path and
+        that local outputs are persisted.
+        """
+        storage.prepare_filestore(u'job')
+        storage.write_content(u'job', u'a.txt', b'abc')
+        shutil.rmtree(os.path.join(nidaba_cfg['storage_path'], u'job'))
+        path = storage.get_abs_path(u'job', u'a.txt')
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'abc')
+        with open(storage.get_abs_path(u'job', u'out.txt'), 'wb') as fp:
+            fp.write(b'def')
+        storage.persist(u'job', u'out.txt')
+        self.assertEqual(storage.retrieve_content(u'job', u'out.txt'),
+                         {u'out.txt': b'def'})
+
+    def test_rematerialize(self):
+        """
+        Test that materialized copies of replaced documents are updated
+        while unpersisted local files are kept.
+        """
+        storage.prepare_filestore(u'job')
+        storage.write_content(u'job', u'a.txt', b'abc')
+        path = storage.get_abs_path(u'job', u'a.txt')
+        # replaced by another worker
+        backend = storage.get_backend()
+        backend.store.put(u'objects/x', b'defg')
+        backend.store.put(u'refs/job/a.txt', b'x')
+        self.assertEqual(storage.get_abs_path(u'job', u'a.txt'), path)
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'defg')
+        self.assertEqual(storage.retrieve_buffer(u'job', u'a.txt')[u'a.txt']
+                         .tobytes(), b'defg')
+        backend.store.put(u'objects/y', b'hi')
+        backend.store.put(u'refs/job/a.txt', b'y')
+        with storage.open_stream(u'job', u'a.txt') as fp:
+            self.assertEqual(fp.read(), b'hi')
+        # written locally by a task
+        with open(path, 'wb') as fp:
+            fp.write(b'local')
+        storage.get_abs_path(u'job', u'a.txt')
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'local')
+        storage.persist(u'job', u'a.txt')
+        self.assertEqual(storage.retrieve_content(u'job', u'a.txt'),
+                         {u'a.txt': b'local'})
+        self.assertEqual(os.stat(storage.get_abs_path(u'job',
+                                                      u'a.txt')).st_ino,
+                         os.stat(path).st_ino)
+
+    def test_buffer_stream(self):
+        """
+        Test that buffers and streams materialize stored files.
+        """
+        storage.prepare_filestore(u'job')
+        storage.write_content(u'job', u'a.txt', b'abc')
+        self.assertEqual(storage.retrieve_buffer(u'job', u'a.txt')[u'a.txt']
+                         .tobytes(), b'abc')
+        with storage.open_stream(u'job', u'a.txt') as fp:
+            self.assertEqual(fp.read(), b'abc')
+
+    def test_local_store(self):
+        """
+        Test the object store backend with a directory.
+        """
+        nidaba_cfg['storage_backend'] = {u'type': u'objectstore',
+                                         u'store': os.path.join(self.tempdir,
+                                                                u'objects')}
+        storage.prepare_filestore(u'job')
+        storage.write_content(u'job', u'a.txt', b'abc')
+        self.assertEqual(storage.list_content(u'job'), [u'a.txt'])
+        self.assertEqual(storage.retrieve_content(u'job', u'a.txt'),
+                         {u'a.txt': b'abc'})
+        with self.assertRaises(NidabaStorageViolationException):
+            storage.get_abs_path(u'job', u'../other/a.txt')
+
+
+class StagingTest(unittest.TestCase):
+
+    """
+    Tests the worker-local staging cache of the filesystem backend.
+    """
+
+    def setUp(self):
+        self.storage_path = nidaba_cfg['storage_path']
+        self.tempdir = unicode(tempfile.mkdtemp())
+        self.shared = os.path.join(self.tempdir, u'shared')
+        self.staging = os.path.join(self.tempdir, u'staging')
+        os.mkdir(self.shared)
+        nidaba_cfg['storage_path'] = self.shared
+        nidaba_cfg['staging'] = {u'path': self.staging}
+        storage.prepare_filestore(u'job')
+
+    def tearDown(self):
+        nidaba_cfg['storage_path'] = self.storage_path
+        del nidaba_cfg['staging']
+        shutil.rmtree(self.tempdir)
+
+    def test_read(self):
+        """
+        Test that reads are served from fresh copies in the staging cache.
+        """
+        storage.write_content(u'job', u'a.txt', b'abc')
+        path = storage.get_abs_path(u'job', u'a.txt')
+        self.assertEqual(path, os.path.join(self.staging, u'job', u'a.txt'))
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'abc')
+        self.assertEqual(storage.get_storage_path(path), (u'job', u'a.txt'))
+        # modified on the storage medium by another machine
+        shared = os.path.join(self.shared, u'job', u'a.txt')
+        with open(shared, 'wb') as fp:
+            fp.write(b'defg')
+        self.assertEqual(storage.retrieve_content(u'job', u'a.txt'),
+                         {u'a.txt': b'defg'})
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'defg')
+
+    def test_write_through(self):
+        """
+        Test that task outputs written to the staging cache are persisted to
+        the storage medium.
+        """
+        path = storage.get_abs_path(u'job', u'out.txt')
+        with open(path, 'wb') as fp:
+            fp.write(b'abc')
+        self.assertFalse(storage.is_file(u'job', u'out.txt'))
+        storage.persist(u'job', u'out.txt', u'nidaba.test')
+        with open(os.path.join(self.shared, u'job', u'out.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'abc')
+        self.assertEqual(storage.get_manifest(u'job')[u'out.txt'][u'task'],
+                         u'nidaba.test')
+        # the staged copy stays fresh
+        self.assertEqual(storage.get_abs_path(u'job', u'out.txt'), path)
+        self.assertEqual(os.stat(path).st_ino,
+                         os.stat(storage.get_abs_path(u'job',
+                                                      u'out.txt')).st_ino)
+
+    def test_evict(self):
+        """
+        Test that least recently used files are evicted.
+        """
+        nidaba_cfg['staging'][u'max_size'] = 5
+        for name in (u'a.txt', u'b.txt', u'c.txt'):
+            storage.write_content(u'job', name, b'abc')
+            os.remove(os.path.join(self.staging, u'job', name))
+        storage.get_abs_path(u'job', u'a.txt')
+        storage.get_abs_path(u'job', u'b.txt')
+        self.assertEqual(os.listdir(os.path.join(self.staging, u'job')),
+                         [u'b.txt'])
+        self.assertEqual(storage.retrieve_content(u'job', u'a.txt'),
+                         {u'a.txt': b'abc'})
+
+    def test_evict_index(self):
+        """
+        Test that the staging directory is only walked once and that
+        unpersisted outputs aren't evicted.
+        """
+        nidaba_cfg['staging'][u'max_size'] = 5
+        walk = os.walk
+        walks = []
+
+        def counting_walk(*args, **kwargs):
+            walks.append(args)
+            return walk(*args, **kwargs)
+
+        os.walk = counting_walk
+        try:
+            path = storage.get_abs_path(u'job', u'out.txt')
+            with open(path, 'wb') as fp:
+                fp.write(b'abcd')
+            for name in (u'a.txt', u'b.txt', u'c.txt'):
+                storage.write_content(u'job', name, b'abc')
+                os.remove(os.path.join(self.staging, u'job', name))
+                storage.get_abs_path(u'job', name)
+        finally:
+            os.walk = walk
+        # os.walk() calls itself for subdirectories
+        self.assertEqual(walks.count((self.staging,)), 1)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.staging,
+                                                        u'job'))),
+                         [u'c.txt', u'out.txt'])
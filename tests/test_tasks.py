@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+import json
+
+from PIL import Image, ImageDraw
+
+from nidaba import storage
+from nidaba.config import nidaba_cfg
+from nidaba.celery import app
+from nidaba.tasks import img, binarize, helper
+from nidaba.algorithms import skew
+from nidaba.nidabaexceptions import NidabaInvalidParameterException
+
+
+class PipelineTaskTests(unittest.TestCase):
+
+    """
+    Tests the fused image pipeline task against the stand-alone tasks.
+    """
+
+    def setUp(self):
+        self.storage_path = nidaba_cfg['storage_path']
+        self.tempdir = unicode(tempfile.mkdtemp())
+        nidaba_cfg['storage_path'] = self.tempdir
+        a = numpy.full((60, 50, 3), 200, dtype=numpy.uint8)
+        a[20:30, 10:40] = 30
+        for job in (u'single', u'fused'):
+            os.mkdir(os.path.join(self.tempdir, job))
+            Image.fromarray(a).save(os.path.join(self.tempdir, job,
+                                                 u'input.png'))
+
+    def tearDown(self):
+        nidaba_cfg['storage_path'] = self.storage_path
+        shutil.rmtree(self.tempdir)
+
+    def test_output_names(self):
+        """
+        Test that fused and stand-alone tasks create identical files.
+        """
+        doc = img.rgb_to_gray.run((u'single', u'input.png'),
+                                  method=u'img.rgb_to_gray')
+        doc = binarize.nlbin.run(doc, method=u'binarize.nlbin',
+                                 threshold=0.4)
+        ret = img.pipeline.run((u'fused', u'input.png'),
+                               steps=[{u'method': u'img.rgb_to_gray'},
+                                      {u'method': u'binarize.nlbin',
+                                       u'threshold': 0.4}])
+        self.assertEqual(ret[1], doc[1])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir,
+                                                        u'fused'))),
+                         sorted([u'input.png', ret[1]]))
+        single = numpy.asarray(Image.open(os.path.join(self.tempdir,
+                                                       *doc)).convert('L'))
+        fused = numpy.asarray(Image.open(os.path.join(self.tempdir,
+                                                      *ret)).convert('L'))
+        self.assertTrue(numpy.array_equal(single, fused))
+
+    def test_kept_steps(self):
+        """
+        Test that kept intermediate steps are named like stand-alone outputs.
+        """
+        gray = img.rgb_to_gray.run((u'single', u'input.png'),
+                                   method=u'img.rgb_to_gray')
+        img.pipeline.run((u'fused', u'input.png'),
+                         steps=[{u'method': u'img.rgb_to_gray',
+                                 u'keep': True},
+                                {u'method': u'binarize.nlbin'}])
+        self.assertTrue(os.path.isfile(os.path.join(self.tempdir, u'fused',
+                                                    gray[1])))
+
+    def test_invalid_parameters(self):
+        """
+        Test that fused steps are validated like stand-alone tasks.
+        """
+        steps = [{u'method': u'img.rgb_to_gray'},
+                 {u'method': u'binarize.sauvola', u'whsize': 1,
+                  u'factor': 5.0}]
+        with self.assertRaises(NidabaInvalidParameterException):
+            binarize.sauvola.run((u'single', u'input.png'),
+                                 method=u'binarize.sauvola', whsize=1,
+                                 factor=5.0)
+        with self.assertRaises(NidabaInvalidParameterException):
+            img.pipeline.run((u'fused', u'input.png'), steps=steps)
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, u'fused')),
+                         [u'input.png'])
+
+    def test_tiled_sauvola_suffix(self):
+        """
+        Test that outputs of the tiled Sauvola implementation are marked.
+        """
+        tiling = nidaba_cfg.get('tiling')
+        nidaba_cfg['tiling'] = {u'max_pixels': 1000, u'tile_size': 16}
+        try:
+            doc = img.rgb_to_gray.run((u'single', u'input.png'),
+                                      method=u'img.rgb_to_gray')
+            ret = binarize.sauvola.run(doc, method=u'binarize.sauvola')
+        finally:
+            nidaba_cfg['tiling'] = tiling
+        self.assertEqual(ret, (u'single', u'input_img.rgb_to_gray_binarize.'
+                                          u'sauvola_10_035_tiled.png'))
+
+
+class DeskewTaskTests(unittest.TestCase):
+
+    """
+    Tests propagation of skew estimates through tracking data.
+    """
+
+    def setUp(self):
+        self.storage_path = nidaba_cfg['storage_path']
+        self.tempdir = unicode(tempfile.mkdtemp())
+        nidaba_cfg['storage_path'] = self.tempdir
+        os.mkdir(os.path.join(self.tempdir, u'job'))
+        im = Image.new('L', (400, 500), 255)
+        draw = ImageDraw.Draw(im)
+        for y in range(50, 450, 20):
+            draw.rectangle((50, y, 350, y + 6), fill=0)
+        skew.rotate(im, 3.0).save(os.path.join(self.tempdir, u'job',
+                                               u'input.png'))
+        app.conf.CELERY_ALWAYS_EAGER = True
+
+    def tearDown(self):
+        app.conf.CELERY_ALWAYS_EAGER = False
+        nidaba_cfg['storage_path'] = self.storage_path
+        shutil.rmtree(self.tempdir)
+
+    def test_tracking(self):
+        """
+        Test that the estimated angle is merged into the tracking data.
+        """
+        ret = img.deskew((u'job', u'input.png'), method=u'img.deskew',
+                         reduction=2, id=u'job', root=(u'job', u'input.png'))
+        self.assertEqual(ret[u'doc'], (u'job', u'input_img.deskew.png'))
+        self.assertEqual(ret[u'id'], u'job')
+        self.assertEqual(ret[u'root'], (u'job', u'input.png'))
+        self.assertAlmostEqual(ret[u'skew_angle'], -3.0, delta=0.3)
+
+    def test_reuse(self):
+        """
+        Test that a propagated estimate is used instead of estimating again.
+        """
+        ret = img.deskew({u'doc': (u'job', u'input.png'), u'id': u'job',
+                          u'skew_angle': 1.5}, method=u'img.deskew',
+                         reduction=2)
+        self.assertEqual(ret[u'skew_angle'], 1.5)
+
+    def test_pipeline(self):
+        """
+        Test that the fused pipeline returns the estimated angle.
+        """
+        ret = img.pipeline.run((u'job', u'input.png'),
+                               steps=[{u'method': u'img.deskew',
+                                       u'reduction': 2}])
+        self.assertEqual(ret[u'doc'], (u'job', u'input_img.deskew.png'))
+        self.assertAlmostEqual(ret[u'skew_angle'], -3.0, delta=0.3)
+
+
+class CacheTests(unittest.TestCase):
+
+    """
+    Tests the task result cache of NidabaTask.
+    """
+
+    def setUp(self):
+        self.storage_path = nidaba_cfg['storage_path']
+        self.tempdir = unicode(tempfile.mkdtemp())
+        nidaba_cfg['storage_path'] = self.tempdir
+        self.cache = nidaba_cfg.get('cache')
+        nidaba_cfg['cache'] = {u'max_age': 3600}
+        helper._local_hashes.clear()
+        helper._local_zsets.clear()
+        app.conf.CELERY_ALWAYS_EAGER = True
+        a = numpy.full((60, 50, 3), 200, dtype=numpy.uint8)
+        a[20:30, 10:40] = 30
+        for job in (u'a', u'b'):
+            os.mkdir(os.path.join(self.tempdir, job))
+            Image.fromarray(a).save(os.path.join(self.tempdir, job,
+                                                 u'input.png'))
+
+    def tearDown(self):
+        app.conf.CELERY_ALWAYS_EAGER = False
+        nidaba_cfg['cache'] = self.cache
+        nidaba_cfg['storage_path'] = self.storage_path
+        shutil.rmtree(self.tempdir)
+
+    def _inode(self, doc):
+        return os.stat(os.path.join(self.tempdir, *doc)).st_ino
+
+    def test_hit(self):
+        """
+        Test that a cached output is linked into the job of the input.
+        """
+        a = img.rgb_to_gray((u'a', u'input.png'), method=u'img.rgb_to_gray',
+                            id=u'a')
+        b = img.rgb_to_gray((u'b', u'input.png'), method=u'img.rgb_to_gray',
+                            id=u'b')
+        self.assertEqual(b[u'doc'], (u'b', a[u'doc'][1]))
+        self.assertEqual(b[u'id'], u'b')
+        self.assertEqual(self._inode(a[u'doc']), self._inode(b[u'doc']))
+
+    def test_tracking_data(self):
+        """
+        Test that cached tracking data is returned on a hit.
+        """
+        a = img.deskew((u'a', u'input.png'), method=u'img.deskew',
+                       skew_angle=1.5, id=u'a')
+        b = img.deskew((u'b', u'input.png'), method=u'img.deskew',
+                       skew_angle=1.5, id=u'b')
+        self.assertEqual(b[u'skew_angle'], 1.5)
+        self.assertEqual(self._inode(a[u'doc']), self._inode(b[u'doc']))
+
+    def test_force(self):
+        """
+        Test that forced executions ignore the cache.
+        """
+        a = img.rgb_to_gray((u'a', u'input.png'), method=u'img.rgb_to_gray',
+                            id=u'a')
+        b = img.rgb_to_gray((u'b', u'input.png'), method=u'img.rgb_to_gray',
+                            id=u'b', force=True)
+        self.assertNotEqual(self._inode(a[u'doc']), self._inode(b[u'doc']))
+
+    def test_miss(self):
+        """
+        Test that changed input content misses the cache.
+        """
+        Image.new('RGB', (50, 60)).save(os.path.join(self.tempdir, u'b',
+                                                     u'input.png'))
+        a = img.rgb_to_gray((u'a', u'input.png'), method=u'img.rgb_to_gray',
+                            id=u'a')
+        b = img.rgb_to_gray((u'b', u'input.png'), method=u'img.rgb_to_gray',
+                            id=u'b')
+        self.assertNotEqual(self._inode(a[u'doc']), self._inode(b[u'doc']))
+
+    def test_eviction(self):
+        """
+        Test that the oldest entries exceeding max_entries are evicted.
+        """
+        nidaba_cfg['cache'] = {u'max_entries': 1}
+        img.rgb_to_gray((u'a', u'input.png'), method=u'img.rgb_to_gray',
+                        id=u'a')
+        ret = binarize.otsu((u'a', u'input.png'), method=u'binarize.otsu',
+                            id=u'a')
+        index = helper._local_hashes[helper.cache_key]
+        self.assertEqual(len(index), 1)
+        self.assertEqual(json.loads(index.values()[0])[0],
+                         list(ret[u'doc']))
+        self.assertEqual(len(helper._local_zsets[helper.cache_key +
+                                                 u'-age']), 1)
+
+    def test_stored_digest(self):
+        """
+        Test that digests of unchanged input documents are not calculated
+        again.
+        """
+        img.rgb_to_gray((u'a', u'input.png'), method=u'img.rgb_to_gray',
+                        id=u'a')
+        digests = helper._local_hashes[helper.digests_key]
+        size, mtime, digest = json.loads(digests[u'a/input.png'])
+        digests[u'a/input.png'] = json.dumps([size, mtime, u'stored'])
+        self.assertEqual(helper._digest((u'a', u'input.png')), u'stored')
+        path = os.path.join(self.tempdir, u'a', u'input.png')
+        os.utime(path, (mtime + 10, mtime + 10))
+        self.assertEqual(helper._digest((u'a', u'input.png')), digest)
+
+    def test_object_store(self):
+        """
+        Test that cached outputs are linked on the object store backend.
+        """
+        nidaba_cfg['storage_backend'] = {u'type': u'objectstore',
+                                         u'store': u'memory'}
+        storage._backends.clear()
+        try:
+            for job in (u'a', u'b'):
+                storage.prepare_filestore(job)
+                with open(os.path.join(self.tempdir, job, u'input.png'),
+                          'rb') as fp:
+                    storage.write_content(job, u'input.png', fp.read())
+            a = img.rgb_to_gray((u'a', u'input.png'),
+                                method=u'img.rgb_to_gray', id=u'a')
+            shutil.rmtree(os.path.join(self.tempdir, u'a'))
+            b = img.rgb_to_gray((u'b', u'input.png'),
+                                method=u'img.rgb_to_gray', id=u'b')
+            self.assertEqual(b[u'doc'], (u'b', a[u'doc'][1]))
+            self.assertEqual(storage.get_digest(*a[u'doc']),
+                             storage.get_digest(*b[u'doc']))
+            self.assertFalse(os.path.exists(os.path.join(self.tempdir,
+                                                         *b[u'doc'])))
+        finally:
+            del nidaba_cfg['storage_backend']
+            storage._backends.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
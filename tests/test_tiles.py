@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+from PIL import Image
+
+from nidaba import tiles
+from nidaba.algorithms import sauvola
+from nidaba.nidabaexceptions import NidabaAlgorithmException
+
+
+class TilesTests(unittest.TestCase):
+
+    """
+    Tests that tiled processing produces the same results as processing
+    whole images.
+    """
+
+    def setUp(self):
+        self.tempdir = unicode(tempfile.mkdtemp())
+        a = numpy.random.randint(0, 255, (75, 101, 3)).astype(numpy.uint8)
+        a[20:40, 10:90] //= 4
+        self.rgb = Image.fromarray(a)
+        self.gray = self.rgb.convert('L')
+        self.png = os.path.join(self.tempdir, u'input.png')
+        self.pnm = os.path.join(self.tempdir, u'input.pnm')
+        self.rgb.save(self.png)
+        self.rgb.save(self.pnm, format='PPM')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _compare(self, path, ref):
+        res = numpy.asarray(Image.open(path).convert('L'))
+        self.assertTrue(numpy.array_equal(res,
+                                          numpy.asarray(ref.convert('L'))))
+
+    def test_map_raster(self):
+        """
+        Test that netpbm rasters are mapped and other formats are not.
+        """
+        mode, raster = tiles.map_raster(self.pnm)
+        self.assertEqual(mode, 'RGB')
+        self.assertEqual(raster.shape, (75, 101, 3))
+        self.assertIsNone(tiles.map_raster(self.png))
+
+    def test_rgb_to_gray(self):
+        """
+        Test tiled grayscale conversion from netpbm and png inputs.
+        """
+        for inp in (self.pnm, self.png):
+            out = os.path.join(self.tempdir, u'gray.pnm')
+            tiles.rgb_to_gray(inp, out, 16)
+            self._compare(out, self.gray)
+
+    def test_sauvola(self):
+        """
+        Test that tile halos make tiled Sauvola identical to untiled.
+        """
+        ref = sauvola.sauvola(self.gray, 5, 0.3)
+        for ext in (u'.pbm', u'.png'):
+            out = os.path.join(self.tempdir, u'sauvola' + ext)
+            tiles.sauvola(self.pnm, out, 5, 0.3, 16)
+            self._compare(out, ref)
+
+    def test_map_tiff(self):
+        """
+        Test that uncompressed TIFF rasters are mapped.
+        """
+        for mode in ('L', 'RGB', '1'):
+            path = os.path.join(self.tempdir, u'input.tif')
+            im = self.rgb.convert(mode)
+            im.save(path)
+            strips = tiles.map_strips(path)
+            self.assertTrue(numpy.array_equal(strips[2:70, 3:97],
+                                              numpy.asarray(im.convert(
+                                                  'L' if mode == '1' else
+                                                  mode))[2:70, 3:97]))
+        self.rgb.save(path, compression='tiff_lzw')
+        self.assertIsNone(tiles.map_strips(path))
+
+    def test_multiple_strips(self):
+        """
+        Test that regions spanning multiple strips are assembled.
+        """
+        a = numpy.asarray(self.gray)
+        b = numpy.asarray(self.gray.convert('1').convert('L'))
+        packed = numpy.packbits(b == 255, axis=1)
+        strips = tiles.RasterStrips((101, 75), [(0, 30, a[:30], None),
+                                                (30, 75, a[30:], None)])
+        self.assertTrue(numpy.array_equal(strips[20:50, 5:17], a[20:50, 5:17]))
+        strips = tiles.RasterStrips((101, 75), [(0, 30, packed[:30], 'white'),
+                                                (30, 75, packed[30:],
+                                                 'white')])
+        self.assertTrue(numpy.array_equal(strips[20:50, 5:17], b[20:50, 5:17]))
+
+    def test_writers(self):
+        """
+        Test incrementally written PNG and TIFF outputs.
+        """
+        ref = sauvola.sauvola(self.gray, 5, 0.3)
+        for ext in (u'.png', u'.tif'):
+            out = os.path.join(self.tempdir, u'gray' + ext)
+            tiles.rgb_to_gray(self.pnm, out, 16)
+            self._compare(out, self.gray)
+            out = os.path.join(self.tempdir, u'sauvola' + ext)
+            tiles.sauvola(self.pnm, out, 5, 0.3, 16)
+            self.assertEqual(Image.open(out).mode, '1')
+            self._compare(out, ref)
+
+    def test_decode_limit(self):
+        """
+        Test that images which can't be processed incrementally are rejected
+        above the limit.
+        """
+        out = os.path.join(self.tempdir, u'gray.pnm')
+        with self.assertRaises(NidabaAlgorithmException):
+            tiles.rgb_to_gray(self.png, out, 16, 1000)
+        with self.assertRaises(NidabaAlgorithmException):
+            tiles.rgb_to_gray(self.pnm, os.path.join(self.tempdir,
+                                                     u'gray.bmp'), 16, 1000)
+        tif = os.path.join(self.tempdir, u'input.tif')
+        self.rgb.save(tif)
+        tiles.rgb_to_gray(tif, out, 16, 1000)
+        self._compare(out, self.gray)
+
+
+if __name__ == '__main__':
+    unittest.main()